@@ -145,6 +145,15 @@ command     varchar     # Command to execute.
 status      char        # 'a' = active (queued),
                         # 'r' = running (in progress),
                         # 'd' = deactive (done)
+worker      varchar     # Id of worker that claimed the job, eg host:pid
+lease_expires datetime  # Claim expiry. Expired claims are requeued.
+exit_status integer     # Exit status of the job command.
+stdout      text        # Output of the job command.
+stderr      text        # Error output of the job command.
+queued_on   datetime    # Time the job was added to the queue.
+claimed_on  datetime    # Time the job was claimed.
+started_on  datetime    # Time the job command was started.
+finished_on datetime    # Time the job finished.
 """
 db.define_table('job',
     Field('start',
@@ -163,6 +172,33 @@ db.define_table('job',
         requires=IS_IN_SET([('a', 'Enabled'), ('r', 'In Progress'),
             ('d', 'Disabled')], zero=None),
         ),
+    Field('worker',
+        'string',
+        ),
+    Field('lease_expires',
+        'datetime',
+        ),
+    Field('exit_status',
+        'integer',
+        ),
+    Field('stdout',
+        'text',
+        ),
+    Field('stderr',
+        'text',
+        ),
+    Field('queued_on',
+        'datetime',
+        ),
+    Field('claimed_on',
+        'datetime',
+        ),
+    Field('started_on',
+        'datetime',
+        ),
+    Field('finished_on',
+        'datetime',
+        ),
     )
 
 """
@@ -6,10 +6,21 @@ Classes for handling database tables.
 
 """
 
+import collections
+import contextlib
+import copy
+import cPickle
 import cStringIO
 import csv
 import datetime
+import hashlib
+import itertools
+import operator
+import sqlite3
 import sys
+import threading
+import time
+import weakref
 
 # C0103 Invalid name "id" (should match [a-z_][a-z0-9_]{2,30}$)
 # E0203 Access to member 'creation_date' before its definition line 318
@@ -20,6 +31,15 @@ import sys
 
 # pylint: disable=C0103,E0203,E1101,W0142,W0201,W0622
 
+COMPACT_CLASSES = {}        # Cache of CompactRow classes, see compact_class()
+TABLE_METAS = {}            # Cache of TableMeta instances, see table_meta()
+MUTABLE_TYPES = (dict, list, set)    # See DbObject._mark_clean()
+OBJECT_CACHES = {'process': None}   # See set_object_cache()
+QUERY_CACHES = {'process': None}    # See set_query_cache()
+REQUEST_OBJECT_CACHE = threading.local()    # See set_object_cache()
+SAVEPOINT_DBNAMES = ['mysql', 'postgres']   # See unit_of_work()
+UNITS_OF_WORK = threading.local()           # See unit_of_work()
+
 
 class Collection(object):
 
@@ -27,12 +47,16 @@ class Collection(object):
 
     """
 
+    bulk_chunk_size = 500  # Number of records written per bulk commit
+    iter_chunk_size = 1000  # Number of records read per iter() query
+
     def __init__(
         self,
         tbl_,
         db_=None,
         class_=None,
         objects=None,
+        compact=False,
         ):
         """Constructor
 
@@ -42,6 +66,9 @@ class Collection(object):
                 Optional. If not provided, tbl_['_db'] is used.
             class_: the class the objects will be created as
             objects: list of DbObject object instances
+            compact: If True, records are read as CompactRow object
+                instances instead of class_ object instances. See
+                CompactRow.
         """
 
         self.tbl_ = tbl_
@@ -54,6 +81,8 @@ class Collection(object):
         else:
             self.class_ = DbObject
         self.objects = objects or []
+        self.errors = []
+        self.compact = compact
         return
 
     def __getitem__(self, i):
@@ -89,11 +118,453 @@ class Collection(object):
     def __str__(self):
         return self.__repr__()
 
+    def _get_objects(self):
+        """Return the objects of the collection."""
+
+        return self.__dict__['_objects']
+
+    def _set_objects(self, value):
+        """Set the objects of the collection.
+
+        Notes:
+            The objects are stored in an ObjectList so the indexes, see
+            index(), are rebuilt when the list changes.
+        """
+
+        if not isinstance(value, ObjectList):
+            value = ObjectList(value)
+        self.__dict__['_objects'] = value
+        self.__dict__['_indexes'] = {}
+
+    objects = property(_get_objects, _set_objects)
+
+    def _as_object(self, row):
+        """Return an object instance for a row.
+
+        Args:
+            row: gluon.dal.Row instance
+
+        Returns:
+            self.class_ object instance, or CompactRow object instance if
+            self.compact is True.
+        """
+
+        if self.compact:
+            return compact_class(self.tbl_, class_=self.class_,
+                    db_=self.db_).from_row(row)
+        db_obj = self.class_(self.tbl_)
+        obj_dict = db_obj.__dict__
+        meta = table_meta(self.tbl_)
+        for field in meta.fields:
+            if field in row:
+                obj_dict[field] = row[field]
+        db_obj._mark_clean()
+        return db_obj
+
+    def _consecutive_ids(self):
+        """Return whether the records of a multi-row INSERT get consecutive
+        ids.
+
+        Notes:
+            SQLite writes one statement at a time. MySQL InnoDB guarantees
+            consecutive ids only with innodb_autoinc_lock_mode 0 or 1, the
+            default of MySQL 8, 2, interleaves the ids of concurrent
+            statements. PostgreSQL sequences interleave too.
+
+        Returns:
+            boolean
+        """
+
+        if self.db_._dbname in ['sqlite', 'sqlite:memory']:
+            return True
+        if self.db_._dbname != 'mysql':
+            return False
+        try:
+            rows = self.db_.executesql('SELECT @@innodb_autoinc_lock_mode;')
+        except Exception:
+            return False
+        return rows[0][0] in [0, 1]
+
+    def _error(self, obj, message):
+        """Record an error for an object of a bulk operation.
+
+        Args:
+            obj: DbObject object instance
+            message: string, error message
+        """
+
+        self.errors.append((obj, DbIOError(self.tbl_._tablename, 'id',
+                           obj.id, message)))
+        return
+
+    def _first_insert_id(self, count):
+        """Return the id of the first record of a multi-row insert.
+
+        Notes:
+            The records of the INSERT must get consecutive ids, see
+            _consecutive_ids(). MySQL reports the id of the first record
+            inserted, other databases report the id of the last.
+
+        Args:
+            count: integer, number of records inserted.
+
+        Returns:
+            integer, id of first record.
+        """
+
+        last_id = self.db_._adapter.lastrowid(self.tbl_)
+        if self.db_._dbname == 'mysql':
+            return last_id
+        return last_id - count + 1
+
+    def _group_rows(self, rows):
+        """Group rows by the fields they set.
+
+        Args:
+            rows: list of (DbObject, args) tuples, args is a dict of
+                field/value pairs.
+
+        Returns:
+            list of (columns, rows) tuples, columns is a tuple of field names
+            in table order. Groups are in the order they first appear.
+        """
+
+        groups = {}
+        columns_order = []
+        for obj, args in rows:
+            columns = tuple([f for f in self.tbl_.fields if f in args])
+            if columns not in groups:
+                groups[columns] = []
+                columns_order.append(columns)
+            groups[columns].append((obj, args))
+        return [(columns, groups[columns]) for columns in columns_order]
+
+    def _insert_rows(self, rows):
+        """Insert records with multi-row INSERT statements.
+
+        Args:
+            rows: list of (DbObject, args) tuples, args is a dict of
+                field/value pairs to insert.
+
+        Notes:
+            Rows are grouped by the fields they set, one statement per group,
+            so fields left as None still get their column DEFAULT value. The
+            id of each object is set. If the ids of a multi-row INSERT can't
+            be known, see _consecutive_ids(), records are inserted one at a
+            time.
+        """
+
+        consecutive = self._consecutive_ids()
+        for columns, group in self._group_rows(rows):
+            if not columns or not consecutive:
+                for obj, args in group:
+                    obj.id = self.tbl_.insert(**args)
+                continue
+            values = []
+            for unused_obj, args in group:
+                values.append('({v})'.format(v=', '.join(
+                    [sql_value(self.db_, self.tbl_[f], args[f]) for f in
+                     columns])))
+            sql = 'INSERT INTO {table} ({cols}) VALUES {values};'.format(
+                    table=self.tbl_._tablename, cols=', '.join(columns),
+                    values=', '.join(values))
+            self.db_.executesql(sql)
+            first_id = self._first_insert_id(len(group))
+            for (count, (obj, unused_args)) in enumerate(group):
+                obj.id = first_id + count
+        return
+
+    def _key(self, key_fields, record):
+        """Return the key of a record.
+
+        Notes:
+            Key values are compared as SQL literals so, eg, '1010' and 1010
+            for an integer field match.
+
+        Args:
+            key_fields: list of field names.
+            record: DbObject object instance or gluon.dal.Row instance.
+
+        Returns:
+            tuple of SQL literals, one per key field.
+        """
+
+        return tuple([sql_value(self.db_, self.tbl_[f], getattr(record, f))
+                      for f in key_fields])
+
+    def _native_upsert(self, key_fields):
+        """Return whether records keyed on fields can be written with a
+        single statement upsert.
+
+        Notes:
+            The statement requires a unique index on exactly the key fields.
+            Without one, MySQL would insert duplicates, or update records
+            matched on another unique index, and PostgreSQL and SQLite
+            would raise an error.
+
+        Args:
+            key_fields: list of field names.
+
+        Returns:
+            True for MySQL (INSERT ... ON DUPLICATE KEY UPDATE), PostgreSQL
+            and SQLite 3.24+ (INSERT ... ON CONFLICT) if the key fields are
+            the id or have a unique index.
+        """
+
+        if self.db_._dbname == 'sqlite':
+            driver = getattr(self.db_._adapter, 'driver', None)
+            if getattr(driver, 'sqlite_version_info', (0, )) < (3, 24, 0):
+                return False
+        elif self.db_._dbname not in ['mysql', 'postgres']:
+            return False
+        if list(key_fields) == ['id']:
+            return True
+        return frozenset(key_fields) in self._unique_indexes()
+
+    def _refresh(self, objects):
+        """Re-read object field values from the database.
+
+        Notes:
+            The records of all objects are read with a single query.
+
+        Args:
+            objects: list of DbObject object instances
+        """
+
+        ids = [obj.id for obj in objects if obj.id]
+        if not ids:
+            return
+        rows = self.db_(self.tbl_.id.belongs(ids)).select()
+        rows_by_id = dict([(row.id, row) for row in rows])
+        for obj in objects:
+            if obj.id not in rows_by_id:
+                continue
+            row = rows_by_id[obj.id]
+            for field in table_meta(self.tbl_).fields:
+                if field in row:
+                    setattr(obj, field, row[field])
+            obj._mark_clean()
+        return
+
+    def _rows_by_key(self, key_fields, objects, fields=None):
+        """Read the records matching the keys of objects.
+
+        Notes:
+            The records are read with a single query.
+
+        Args:
+            key_fields: list of field names.
+            objects: list of DbObject object instances
+            fields: list of gluon.dal.Field instances to select. Defaults to
+                all fields.
+
+        Returns:
+            dict, {key: gluon.dal.Row, ...}, see _key().
+        """
+
+        if not objects:
+            return {}
+        query = None
+        for field in key_fields:
+            values = set([getattr(obj, field) for obj in objects])
+            belongs = self.tbl_[field].belongs(values)
+            query = query & belongs if query else belongs
+        rows = self.db_(query).select(*(fields or []))
+        return dict([(self._key(key_fields, row), row) for row in rows])
+
+    def _select(self, dal_set, fields, select_args, cached=False):
+        """Select the records of a query.
+
+        Args:
+            dal_set: gluon.dal.Set object instance
+            fields: list of fields to select.
+            select_args: dict, keyword arguments of the select, eg orderby.
+            cached: If True, the records are read through the query cache.
+                Queries involving other tables are not cached.
+
+        Returns:
+            gluon.dal.Rows instance, or list of dicts, {field: value, ...},
+                if read through the query cache.
+        """
+
+        caches = query_caches() if cached else []
+        if caches and dal_set.query:
+            tables = set(self.db_._adapter.tables(dal_set.query))
+            if tables != set([self.tbl_._tablename]):
+                caches = []
+        if not caches:
+            return dal_set.select(*fields, **select_args)
+
+        cache = caches[0]
+        sql = dal_set._select(*fields, **select_args)
+        version = cache.version(self.db_, self.tbl_._tablename)
+        records = cache.get(self.db_, sql, version)
+        if records is None:
+            meta = table_meta(self.tbl_)
+            records = [dict([(f, row[f]) for f in meta.fields if f in row])
+                       for row in dal_set.select(*fields, **select_args)]
+            cache.set(self.db_, sql, version, records)
+        return records
+
+    def _unique_indexes(self):
+        """Return the columns of the unique indexes of the table.
+
+        Returns:
+            list of frozensets of column names, one per index. Empty if the
+            indexes cannot be read on the database.
+        """
+
+        table = self.tbl_._tablename
+        if self.db_._dbname == 'mysql':
+            rows = self.db_.executesql("""
+                SELECT index_name, column_name
+                FROM information_schema.statistics
+                WHERE table_schema = DATABASE()
+                    AND table_name = '{t}'
+                    AND non_unique = 0;
+                """.format(t=table))
+        elif self.db_._dbname == 'postgres':
+            rows = self.db_.executesql("""
+                SELECT i.relname, a.attname
+                FROM pg_index x
+                JOIN pg_class t ON t.oid = x.indrelid
+                JOIN pg_class i ON i.oid = x.indexrelid
+                JOIN pg_attribute a ON a.attrelid = t.oid
+                    AND a.attnum = ANY(x.indkey)
+                WHERE x.indisunique AND t.relname = '{t}';
+                """.format(t=table))
+        elif self.db_._dbname == 'sqlite':
+            rows = []
+            for index in self.db_.executesql(
+                    "PRAGMA index_list('{t}');".format(t=table)):
+                if not index[2]:
+                    continue
+                for column in self.db_.executesql(
+                        "PRAGMA index_info('{i}');".format(i=index[1])):
+                    rows.append((index[1], column[2]))
+        else:
+            return []
+        columns = collections.defaultdict(set)
+        for index_name, column_name in rows:
+            columns[index_name].add(column_name)
+        return [frozenset(x) for x in columns.values()]
+
+    def _update_rows(self, rows):
+        """Update records with a single UPDATE statement.
+
+        Args:
+            rows: list of (DbObject, args) tuples, args is a dict of
+                field/value pairs to update.
+
+        Notes:
+            Values are set with CASE id WHEN ... expressions so all records
+            are updated in one statement.
+        """
+
+        if not rows:
+            return
+        sets = []
+        for field in self.tbl_.fields:
+            if field == 'id':
+                continue
+            whens = ['WHEN {id} THEN {value}'.format(id=int(obj.id),
+                     value=sql_value(self.db_, self.tbl_[field],
+                     args[field])) for (obj, args) in rows if field in args]
+            if not whens:
+                continue
+            sets.append('{f} = CASE id {whens} ELSE {f} END'.format(f=field,
+                        whens=' '.join(whens)))
+        if not sets:
+            return
+        sql = 'UPDATE {table} SET {sets} WHERE id IN ({ids});'.format(
+                table=self.tbl_._tablename, sets=', '.join(sets),
+                ids=', '.join([str(int(obj.id)) for (obj, unused) in rows]))
+        self.db_.executesql(sql)
+        return
+
+    def _upsert_rows(self, rows, key_fields):
+        """Insert or update records with multi-row upsert statements.
+
+        Notes:
+            MySQL uses INSERT ... ON DUPLICATE KEY UPDATE, other databases
+            INSERT ... ON CONFLICT. Either requires a unique index on the key
+            fields. Created timestamp fields are not updated.
+
+        Args:
+            rows: list of (DbObject, args) tuples, args is a dict of
+                field/value pairs to write.
+            key_fields: list of field names.
+        """
+
+        created_fields = table_meta(self.tbl_).created_fields
+        for columns, group in self._group_rows(rows):
+            updates = [f for f in columns if f not in key_fields
+                       and f not in created_fields]
+            if self.db_._dbname == 'mysql':
+                clause = 'ON DUPLICATE KEY UPDATE {sets}'.format(
+                    sets=', '.join(['{f} = VALUES({f})'.format(f=f)
+                                    for f in updates]) or 'id = id')
+            else:
+                action = 'NOTHING'
+                if updates:
+                    action = 'UPDATE SET {sets}'.format(sets=', '.join(
+                        ['{f} = excluded.{f}'.format(f=f) for f in updates]))
+                clause = 'ON CONFLICT ({keys}) DO {action}'.format(
+                    keys=', '.join(key_fields), action=action)
+            values = []
+            for unused_obj, args in group:
+                values.append('({v})'.format(v=', '.join(
+                    [sql_value(self.db_, self.tbl_[f], args[f]) for f in
+                     columns])))
+            sql = 'INSERT INTO {table} ({cols}) VALUES {values} {clause};'\
+                .format(table=self.tbl_._tablename, cols=', '.join(columns),
+                        values=', '.join(values), clause=clause)
+            self.db_.executesql(sql)
+        return
+
+    def _upsert_split(self, rows, key_fields):
+        """Insert or update records by reading the existing keys first.
+
+        Notes:
+            The existing keys are read with a single query. The rows are then
+            split into inserts, see _insert_rows(), and updates, see
+            _update_rows(). Created timestamp fields are not updated. If
+            several rows have the same key, the last one is written.
+
+        Args:
+            rows: list of (DbObject, args) tuples, args is a dict of
+                field/value pairs to write.
+            key_fields: list of field names.
+        """
+
+        created_fields = table_meta(self.tbl_).created_fields
+        fields = [self.tbl_.id] + [self.tbl_[f] for f in key_fields]
+        existing = self._rows_by_key(key_fields, [x[0] for x in rows],
+                fields=fields)
+        by_key = collections.OrderedDict()
+        for obj, args in rows:
+            key = self._key(key_fields, obj)
+            by_key.pop(key, None)
+            by_key[key] = (obj, args)
+        inserts = []
+        updates = []
+        for key, (obj, args) in by_key.items():
+            if key in existing:
+                obj.id = existing[key].id
+                updates.append((obj, dict([(k, v) for k, v in args.items()
+                                           if k not in created_fields])))
+            else:
+                inserts.append((obj, args))
+        self._insert_rows(inserts)
+        self._update_rows(updates)
+        return
+
     def as_dict(self):
         """Return object as a dict
 
         The dict has the form { id: Object, id2, Object3, ...}
-        The dict can be used as a lookup table.
+        The dict can be used as a lookup table. For repeated lookups use
+        index_by('id'), it is built once.
         """
 
         if not self.objects:
@@ -103,13 +574,228 @@ class Collection(object):
             obj_dict[obj.id] = obj
         return obj_dict
 
-    def export_as_csv(self, out=None, header=0):
+    def bulk_add(self, objects, chunk_size=None):
+        """Add to the database records for a list of objects.
+
+        Args:
+            objects: list of DbObject object instances
+            chunk_size: integer, number of records written per commit.
+                Defaults to Collection.bulk_chunk_size.
+
+        Returns:
+            self    The "objects" property is set to the objects added.
+                    The "errors" property is set to a list of
+                    (object, DbIOError) tuples, one for each object that could
+                    not be added.
+
+        Notes:
+            Each chunk is inserted with multi-row INSERT statements and
+            committed once. Column DEFAULT values are then re-read for the
+            whole chunk with a single query. If the chunk cannot be inserted,
+            its records are inserted one at a time so one bad record does not
+            drop the batch. Inside a unit_of_work(), chunks and records are
+            savepoints committed when the unit exits. On databases without
+            savepoints, eg SQLite, the chunk's exception is raised instead.
+        """
+
+        self.objects = []
+        self.errors = []
+        for chunk in chunks(objects, chunk_size or self.bulk_chunk_size):
+            rows = [(obj, obj._add_args()) for obj in chunk]
+            try:
+                with unit_of_work(self.db_):
+                    self._insert_rows(rows)
+                added = chunk
+            except Exception:
+                if not can_roll_back_unit(self.db_):
+                    # The chunk's writes were not rolled back, retrying
+                    # its records would write them twice.
+                    raise
+                added = []
+                for obj, args in rows:
+                    try:
+                        with unit_of_work(self.db_):
+                            obj.id = self.tbl_.insert(**args)
+                    except Exception, err:
+                        obj.id = None
+                        self._error(obj, str(err))
+                        continue
+                    added.append(obj)
+            self._refresh(added)
+            table_changed(self.db_, self.tbl_)
+            for cache in object_caches():
+                for obj in added:
+                    cache.set(obj)
+            self.objects.extend(added)
+        return self
+
+    def bulk_modify(self, objects, chunk_size=None):
+        """Modify in the database the records associated with a list of
+        objects.
+
+        Args:
+            objects: list of DbObject object instances
+            chunk_size: integer, number of records written per commit.
+                Defaults to Collection.bulk_chunk_size.
+
+        Returns:
+            self    The "objects" property is set to the objects modified.
+                    The "errors" property is set to a list of
+                    (object, DbIOError) tuples, one for each object that could
+                    not be modified.
+
+        Notes:
+            The existence of the records of a chunk is checked with a single
+            query. The chunk is then updated with one UPDATE statement and
+            committed once. If the chunk cannot be updated, its records are
+            updated one at a time so one bad record does not drop the batch.
+            Inside a unit_of_work(), chunks and records are savepoints
+            committed when the unit exits. On databases without savepoints,
+            eg SQLite, the chunk's exception is raised instead.
+        """
+
+        self.objects = []
+        self.errors = []
+        for chunk in chunks(objects, chunk_size or self.bulk_chunk_size):
+            ids = [obj.id for obj in chunk if obj.id]
+            existing = set()
+            if ids:
+                existing = set([row.id for row in
+                               self.db_(self.tbl_.id.belongs(ids)).select(
+                               self.tbl_.id)])
+            rows = []
+            for obj in chunk:
+                if not obj.id:
+                    self._error(obj, 'Unable to modify, no id.')
+                elif obj.id not in existing:
+                    self._error(obj, 'No such record.')
+                else:
+                    rows.append((obj, obj._modify_args()))
+            unchanged = [obj for (obj, args) in rows if not args]
+            rows = [(obj, args) for (obj, args) in rows if args]
+            try:
+                with unit_of_work(self.db_):
+                    self._update_rows(rows)
+                modified = [obj for (obj, unused_args) in rows]
+            except Exception:
+                if not can_roll_back_unit(self.db_):
+                    raise
+                modified = []
+                for obj, args in rows:
+                    try:
+                        with unit_of_work(self.db_):
+                            self.db_(self.tbl_.id == obj.id).update(**args)
+                    except Exception, err:
+                        self._error(obj, str(err))
+                        continue
+                    modified.append(obj)
+            for obj in modified:
+                obj._mark_clean()
+            modified.extend(unchanged)
+            table_changed(self.db_, self.tbl_)
+            for cache in object_caches():
+                for obj in modified:
+                    cache.set(obj)
+            self.objects.extend(modified)
+        return self
+
+    def bulk_upsert(self, objects, key_fields, chunk_size=None):
+        """Add or modify in the database the records for a list of objects.
+
+        Records are matched to objects on key fields, similar to
+        DbObject.update(key_fields).
+
+        Args:
+            objects: list of DbObject object instances
+            key_fields: list of field names used to match records.
+            chunk_size: integer, number of records written per commit.
+                Defaults to Collection.bulk_chunk_size.
+
+        Returns:
+            self    The "objects" property is set to the objects written,
+                    with ids and values re-read from the database.
+                    The "errors" property is set to a list of
+                    (object, DbIOError) tuples, one for each object that could
+                    not be written.
+
+        Notes:
+            On MySQL, PostgreSQL and SQLite 3.24+ each chunk is written with
+            multi-row upsert statements if the key fields are the id or have
+            a unique index, see _native_upsert(). Otherwise, the existing
+            keys of a chunk are read with a single query and the chunk is
+            split into inserts and updates. If the chunk cannot be written,
+            its records are written one at a time so one bad record does not
+            drop the batch. Inside a unit_of_work() on databases without
+            savepoints, eg SQLite, the chunk's exception is raised instead.
+
+            The creation_date and created_on fields of existing records are
+            not overwritten. The modified timestamp fields are set to now.
+            Fields left as None are not written; they get their column
+            DEFAULT on insert and keep their value on update.
+        """
+
+        self.objects = []
+        self.errors = []
+        native = self._native_upsert(key_fields)
+        for chunk in chunks(objects, chunk_size or self.bulk_chunk_size):
+            rows = []
+            for obj in chunk:
+                if [f for f in key_fields if getattr(obj, f, None) is None]:
+                    self._error(obj, 'Unable to upsert, no key value.')
+                    continue
+                now = datetime_now()
+                for field in table_meta(self.tbl_).modified_fields:
+                    setattr(obj, field, now)
+                args = obj._add_args()
+                for field in key_fields:
+                    args[field] = getattr(obj, field)   # Eg, id
+                rows.append((obj, args))
+            try:
+                with unit_of_work(self.db_):
+                    if native:
+                        self._upsert_rows(rows, key_fields)
+                    else:
+                        self._upsert_split(rows, key_fields)
+                written = [obj for (obj, unused_args) in rows]
+            except Exception:
+                if not can_roll_back_unit(self.db_):
+                    raise
+                written = []
+                for obj, args in rows:
+                    try:
+                        with unit_of_work(self.db_):
+                            self._upsert_split([(obj, args)], key_fields)
+                    except Exception, err:
+                        self._error(obj, str(err))
+                        continue
+                    written.append(obj)
+            records = self._rows_by_key(key_fields, written)
+            for obj in written:
+                row = records.get(self._key(key_fields, obj))
+                if not row:
+                    continue
+                for field in table_meta(self.tbl_).fields:
+                    if field in row:
+                        setattr(obj, field, row[field])
+                obj._mark_clean()
+            table_changed(self.db_, self.tbl_)
+            for cache in object_caches():
+                for obj in written:
+                    cache.set(obj)
+            self.objects.extend(written)
+        return self
+
+    def export_as_csv(self, out=None, header=0, objects=None):
         """Write object in csv format.
 
         Args:
             out     File like object that has write method.
                     Defaults sys.stdout.
             header  Boolean, If True, print a header of field names.
+            objects Iterable of DbObject object instances to write instead
+                    of the "objects" property, eg self.iter(). Objects are
+                    written as they are returned so an iterator is never
+                    loaded into memory as a whole.
 
         Raises:
             SyntaxError, if record is not in database.
@@ -121,7 +807,9 @@ class Collection(object):
         csv_writer = csv.writer(out, quoting=csv.QUOTE_NONNUMERIC)
         if header:
             csv_writer.writerow(self.tbl_.fields)
-        for obj in self.objects:
+        if objects is None:
+            objects = self.objects
+        for obj in objects:
             csv_writer.writerow(obj.as_list())
         return
 
@@ -138,6 +826,7 @@ class Collection(object):
         query=None,
         orderby=None,
         limitby=None,
+        cached=False,
         ):
         """Get the collection of DbObject object instances.
 
@@ -158,6 +847,8 @@ class Collection(object):
                         limitby=(0, 100)    return first 100 records
                         limitby=(100, 199)  return 99 records starting at
                                                 number 100
+            cached: If True, the query result is read through the query
+                    cache. See Notes.
 
         Returns:
             self    The object itself is returned. A successful get populates
@@ -180,6 +871,13 @@ class Collection(object):
             None    ''      0   records (SQL call is not made)
             None    query   x   records
             None    None    all records
+
+            If an ObjectCache is in use (see set_object_cache), a get by id
+            is served from the cache when possible.
+
+            If cached is True and a QueryCache is in use (see
+            set_query_cache), the result is served from the cache when
+            possible.
         """
 
         self.objects = []
@@ -196,29 +894,186 @@ class Collection(object):
             # Convert integer to tuple
             limitby = (0, int(limitby))
 
+        caches = []
+        if id != None and not self.compact:
+            caches = object_caches()
+            for (count, cache) in enumerate(caches):
+                obj = cache.get(self.tbl_, id, class_=self.class_,
+                        db_=self.db_)
+                if obj is not None:
+                    for earlier_cache in caches[:count]:
+                        earlier_cache.set(obj)
+                    self.objects.append(obj)
+                    return self
+
         rows = None
         if id != None:
-            rows = self.db_(self.tbl_.id == id).select()
+            rows = self._select(self.db_(self.tbl_.id == id), [], {},
+                    cached=cached)
         else:
             if query != None:
                 if query:
-                    rows = self.db_(query).select(orderby=orderby,
-                            limitby=limitby)
+                    rows = self._select(self.db_(query), [],
+                            dict(orderby=orderby, limitby=limitby),
+                            cached=cached)
             else:
-                rows = self.db_().select(self.tbl_.ALL, orderby=orderby,
-                        limitby=limitby)
+                rows = self._select(self.db_(), [self.tbl_.ALL],
+                        dict(orderby=orderby, limitby=limitby),
+                        cached=cached)
 
         if not rows:
             return self
 
-        for row in rows:
-            db_obj = self.class_(self.tbl_)
-            for field in db_obj.tbl_.fields:
-                if hasattr(row, field):
-                    setattr(db_obj, field, row[field])
-            self.objects.append(db_obj)
+        self.objects.extend([self._as_object(row) for row in rows])
+        for cache in caches:
+            for obj in self.objects:
+                cache.set(obj)
         return self
 
+    def group_by(self, key):
+        """Return the objects grouped by key.
+
+        Args:
+            key: string, field name, tuple of field names, or callable
+                returning the key of an object.
+
+        Returns:
+            dict, {key value: [object, ...], ...}. Objects are in collection
+                order. For field keys, the dict is a copy of the cached
+                index, see index(), and may be modified.
+        """
+
+        if not callable(key):
+            return dict([(k, list(v)) for k, v in self.index(key).items()])
+        groups = {}
+        for obj in self.objects:
+            groups.setdefault(key(obj), []).append(obj)
+        return groups
+
+    def index(self, fields, unique=False):
+        """Return an index of the objects on one or more fields.
+
+        Notes:
+            The index is built on first use and cached until the "objects"
+            property is changed, eg by get(). Changing the field values of
+            an object does not update the index, call reindex() to do so.
+
+        Args:
+            fields: string, field name, or tuple of field names. With a tuple,
+                keys are tuples of values.
+            unique: If True, each key maps to a single object. Otherwise each
+                key maps to a list of objects.
+
+        Returns:
+            dict, {key value: object, ...} if unique, else
+                {key value: [object, ...], ...}. The dict must not be
+                modified.
+
+        Raises:
+            ValueError, if unique is True and objects share a key.
+        """
+
+        objects = self.objects
+        index_key = (fields, unique)
+        cached = self.__dict__['_indexes'].get(index_key)
+        if cached is not None and cached[0] == objects.version:
+            return cached[1]
+        if isinstance(fields, tuple):
+            get_key = operator.attrgetter(*fields)
+            if len(fields) == 1:
+                get_key = lambda x, f=fields[0]: (getattr(x, f), )
+        else:
+            get_key = operator.attrgetter(fields)
+        index = {}
+        if unique:
+            for obj in objects:
+                key = get_key(obj)
+                if key in index:
+                    raise ValueError('Duplicate key {k} in unique index on'
+                        ' {f}'.format(k=key, f=fields))
+                index[key] = obj
+        else:
+            for obj in objects:
+                key = get_key(obj)
+                if key in index:
+                    index[key].append(obj)
+                else:
+                    index[key] = [obj]
+        self.__dict__['_indexes'][index_key] = (objects.version, index)
+        return index
+
+    def index_by(self, key):
+        """Return the objects keyed by a unique key.
+
+        Args:
+            key: string, field name, tuple of field names, or callable
+                returning the key of an object.
+
+        Returns:
+            dict, {key value: object, ...}. For field keys, the dict is a
+                copy of the cached index, see index(), and may be modified.
+
+        Raises:
+            ValueError, if objects share a key.
+        """
+
+        if not callable(key):
+            return dict(self.index(key, unique=True))
+        index = {}
+        for obj in self.objects:
+            key_value = key(obj)
+            if key_value in index:
+                raise ValueError('Duplicate key {k}'.format(k=key_value))
+            index[key_value] = obj
+        return index
+
+    def iter(self, query=None, chunk_size=None):
+        """Generator returning DbObject object instances for records.
+
+        Args:
+            query: SQLQuery representing an SQL where clause, for
+                   example: db.person.name=='John'
+                   defaults None, ie all records
+            chunk_size: integer, number of records read per query.
+                   Defaults to Collection.iter_chunk_size.
+
+        Returns:
+            generator of self.class_ object instances, in id order.
+
+        Notes:
+            Records are read in chunks using the id of the last record read,
+            ie WHERE id > last_id ORDER BY id LIMIT chunk_size, so every chunk
+            costs the same and only one chunk is in memory at a time. The
+            "objects" property is not changed.
+
+            As with get(), query set to empty string returns no objects.
+
+        Usage:
+            for obj in Collection(db.person).iter(query=query):
+                print obj.name
+
+            Collection(db.person).export_as_csv(out=f,
+                    objects=Collection(db.person).iter())
+        """
+
+        if not hasattr(self, 'db_') or not hasattr(self, 'tbl_'):
+            return
+        if query != None and not query:
+            return
+        chunk_size = chunk_size or self.iter_chunk_size
+        last_id = 0
+        while True:
+            chunk_query = self.tbl_.id > last_id
+            if query != None:
+                chunk_query = chunk_query & query
+            rows = self.db_(chunk_query).select(self.tbl_.ALL,
+                    orderby=self.tbl_.id, limitby=(0, chunk_size))
+            for row in rows:
+                yield self._as_object(row)
+            if len(rows) < chunk_size:
+                return
+            last_id = rows[-1].id
+
     def last(self):
         """Return last object"""
 
@@ -226,11 +1081,22 @@ class Collection(object):
             return None
         return self[-1]
 
+    def reindex(self):
+        """Discard the cached indexes so they are rebuilt on next use.
+
+        Notes:
+            Call this after changing field values of objects in the
+            collection.
+        """
+
+        self.__dict__['_indexes'] = {}
+
     def only(
         self,
         id=None,
         query=None,
         orderby=None,
+        cached=False,
         ):
         """Get the collection of DbObject object instances.
 
@@ -243,7 +1109,7 @@ class Collection(object):
 
         """
 
-        self.get(id=id, query=query, orderby=orderby)
+        self.get(id=id, query=query, orderby=orderby, cached=cached)
         if len(self.objects) == 0:
             raise DbIOError('', '', '', 'Expected one. No record found.')
         if len(self.objects) > 1:
@@ -252,23 +1118,178 @@ class Collection(object):
         return self
 
 
-class DbIOError(Exception):
+class CompactRow(object):
 
-    """General exception for database IO errors"""
+    """Base class representing a compact, read-mostly DbObject.
 
-    def __init__(
-        self,
-        table_name,
-        field_name,
-        field_value,
-        message,
-        ):
-        """Constructor.
+    A CompactRow stores its field values in __slots__. It has no __dict__
+    and no per instance table, database or Collection references, so it is
+    far cheaper to create and hold than a DbObject. Use compact_class() to
+    get the class for a table. The class references the table and database
+    weakly, so it does not keep them alive.
 
-        Args:
-            table_name: string, name of database table
-            field_name: string, name of the table field
-            field_value: string, value of the table field
+    CompactRow supports the DbObject methods as_dict, as_list, export_as_csv
+    and equality. The mutating methods add, modify, remove and update
+    upgrade the row to a full DbObject (see as_object) and call the method
+    of that object. The upgraded object is returned, the row is not changed.
+
+    Usage:
+        c = Collection(db.account, class_=Account, compact=True)
+        for row in c.get(query=query):
+            print row.name
+        account = c.first().modify()    # account is an Account instance
+    """
+
+    __slots__ = ()
+
+    # These are set on each generated class. See compact_class().
+    _fields = ()        # Tuple of table field names
+    _db_ref = None      # weakref.ref of the gluon.dal.DAL object instance
+    _tbl_ref = None     # weakref.ref of the gluon.dal.Table object instance
+    class_ = None       # Class the row is upgraded to
+
+    def __init__(self, **kwargs):
+        """Constructor
+
+        Args:
+            kwargs: any number of database table field/value pairs.
+                Fields not provided are set to their table default.
+        """
+
+        tbl_ = None
+        for field in self._fields:
+            if field in kwargs:
+                setattr(self, field, kwargs[field])
+            else:
+                if tbl_ is None:
+                    tbl_ = self.tbl_
+                setattr(self, field, tbl_[field].default)
+        return
+
+    def __copy__(self):
+        return self.__class__(**self.as_dict())
+
+    def __deepcopy__(self, unused_memo):
+        # There is no deepness to copy, so just return __copy__()
+        return self.__copy__()
+
+    def __eq__(self, other):
+        for field in self._fields:
+            if getattr(self, field) != getattr(other, field):
+                return False
+        return True
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        output = cStringIO.StringIO()
+        self.export_as_csv(out=output)
+        return output.getvalue()
+
+    def __str__(self):
+        return self.__repr__()
+
+    @property
+    def db_(self):
+        """gluon.dal.DAL object instance of the row."""
+        return self._db_ref()
+
+    @property
+    def tbl_(self):
+        """gluon.dal.Table object instance of the row."""
+        return self._tbl_ref()
+
+    @classmethod
+    def from_row(cls, row):
+        """Return a row object instance created from a record.
+
+        Args:
+            row: gluon.dal.Row instance
+
+        Returns:
+            CompactRow object instance
+        """
+
+        obj = cls.__new__(cls)
+        tbl_ = None
+        for field in cls._fields:
+            if field in row:
+                setattr(obj, field, row[field])
+            else:
+                if tbl_ is None:
+                    tbl_ = cls._tbl_ref()
+                setattr(obj, field, tbl_[field].default)
+        return obj
+
+    def add(self):
+        """Upgrade the row and add it. See DbObject.add()."""
+        return self.as_object().add()
+
+    def as_dict(self):
+        """Return a dict representation of the object.
+
+        See DbObject.as_dict().
+        """
+        return dict([(f, getattr(self, f)) for f in self._fields])
+
+    def as_list(self):
+        """Return a list representation of the object.
+
+        See DbObject.as_list().
+        """
+        return [getattr(self, f) for f in self._fields]
+
+    def as_object(self):
+        """Return the row upgraded to a full object.
+
+        Returns:
+            self.class_ object instance with the field values of the row.
+        """
+        return self.class_(self.tbl_, db_=self.db_, **self.as_dict())
+
+    def export_as_csv(self, out=None):
+        """Write object in csv format.
+
+        See DbObject.export_as_csv().
+        """
+
+        if not out:
+            out = sys.stdout
+        csv_writer = csv.writer(out, quoting=csv.QUOTE_NONNUMERIC)
+        csv_writer.writerow(self.as_list())
+        return
+
+    def modify(self):
+        """Upgrade the row and modify it. See DbObject.modify()."""
+        return self.as_object().modify()
+
+    def remove(self):
+        """Upgrade the row and remove it. See DbObject.remove()."""
+        return self.as_object().remove()
+
+    def update(self, key_fields=None):
+        """Upgrade the row and update it. See DbObject.update()."""
+        return self.as_object().update(key_fields=key_fields)
+
+
+class DbIOError(Exception):
+
+    """General exception for database IO errors"""
+
+    def __init__(
+        self,
+        table_name,
+        field_name,
+        field_value,
+        message,
+        ):
+        """Constructor.
+
+        Args:
+            table_name: string, name of database table
+            field_name: string, name of the table field
+            field_value: string, value of the table field
             message: string, error message
 
         Example:
@@ -314,23 +1335,29 @@ class DbObject(object):
         """
 
         self.tbl_ = tbl_
-        for field in self.tbl_.fields:
-            self.__dict__[field] = self.tbl_[field].default
-        for key in kwargs.keys():
-            if key in self.tbl_.fields:
-                self.__dict__[key] = kwargs[key]
+        meta = table_meta(tbl_)
+        obj_dict = self.__dict__
+        for field in meta.fields:
+            # Defaults are read from the Field each time as controllers may
+            # change them.
+            obj_dict[field] = tbl_[field].default
+        for key, value in kwargs.iteritems():
+            if key in meta.field_set:
+                obj_dict[key] = value
             elif key == 'db_':
-                self.db_ = kwargs[key]
+                self.db_ = value
         if not hasattr(self, 'db_'):
             self.db_ = self.tbl_['_db']
-        self.set_ = Collection(tbl_=self.tbl_, db_=self.db_,
-                               class_=self.__class__)
         return
 
     def __copy__(self):
         table = self.__class__(self.tbl_)
-        for field in self.tbl_.fields:
-            table.__dict__[field] = self.__dict__[field]
+        table_dict = table.__dict__
+        obj_dict = self.__dict__
+        for field in table_meta(self.tbl_).fields:
+            table_dict[field] = obj_dict[field]
+        if '_clean_values' in obj_dict:
+            table_dict['_clean_values'] = obj_dict['_clean_values']
         return table
 
     def __deepcopy__(self, unused_memo):
@@ -338,10 +1365,8 @@ class DbObject(object):
         return self.__copy__()
 
     def __eq__(self, other):
-        for field in self.tbl_.fields:
-            if self.__dict__[field] != other.__dict__[field]:
-                return False
-        return True
+        meta = table_meta(self.tbl_)
+        return meta.values(self) == meta.values(other)
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -354,55 +1379,116 @@ class DbObject(object):
     def __str__(self):
         return self.__repr__()
 
-    def add(self):
-        """Add a record to the database.
+    def _get_set(self):
+        """Return the Collection used to get objects of the same class.
 
-        Returns:
-            The object itself if add succeeds, nothing otherwise.
+        Notes:
+            The Collection is created on first access, most objects never
+            use it.
+        """
+
+        if '_set' not in self.__dict__:
+            self.__dict__['_set'] = Collection(tbl_=self.tbl_, db_=self.db_,
+                    class_=self.__class__)
+        return self.__dict__['_set']
+
+    def _set_set(self, value):
+        """Set the Collection used to get objects of the same class."""
+        self.__dict__['_set'] = value
+
+    set_ = property(_get_set, _set_set)
+
+    def _add_args(self):
+        """Return the field/value pairs used to insert the object.
+
+        Notes:
+            The timestamp fields, if defined and not set, are set to now.
 
+        Returns:
+            dict, {field: value, ...}
         """
 
+        meta = table_meta(self.tbl_)
         now = None
-        if hasattr(self, 'creation_date') and not self.creation_date:
-            if not now:
-                now = datetime_now()
-            self.creation_date = now
-        if hasattr(self, 'created_on') and not self.created_on:
-            if not now:
-                now = datetime_now()
-            self.created_on = now
-        if hasattr(self, 'modified_date') and not self.modified_date:
-            if not now:
-                now = datetime_now()
-            self.modified_date = now
-        if hasattr(self, 'modified_on') and not self.modified_on:
-            if not now:
-                now = datetime_now()
-            self.modified_on = now
-        if hasattr(self, 'updated_on') and not self.updated_on:
-            if not now:
-                now = datetime_now()
-            self.updated_on = now
+        for field in meta.timestamp_fields:
+            if not getattr(self, field, None):
+                if not now:
+                    now = datetime_now()
+                setattr(self, field, now)
 
         args = {}
-        for field in self.tbl_.fields:
 
-            # Ignore the id field, it will get set
+        # The id field is ignored, it will get set
 
-            if field == 'id':
-                continue
+        for field in meta.data_fields:
+            value = getattr(self, field, None)
+
+            # Do not set if value is None so the defaults defined in
+            # the db.table definition will be used
+
+            if value != None:
+                args[field] = value
+        return args
+
+    def _mark_clean(self):
+        """Record the field values as those stored in the database.
+
+        Notes:
+            dirty_fields() compares the field values to these. Mutable
+            values, eg list:string fields, are copied so changes made to
+            them in place are detected.
+        """
+
+        try:
+            values = table_meta(self.tbl_).values(self)
+        except AttributeError:
+            # A field attribute has been deleted, all fields are dirty.
+            self.__dict__.pop('_clean_values', None)
+            return
+        self.__dict__['_clean_values'] = tuple([
+                copy.deepcopy(x) if isinstance(x, MUTABLE_TYPES) else x
+                for x in values])
+
+    def _modify_args(self):
+        """Return the field/value pairs used to update the object record.
+
+        Notes:
+            Only the dirty fields are included, see dirty_fields(). If any
+            are, the modified timestamp fields, if defined, are set to now
+            and included.
+
+        Returns:
+            dict, {field: value, ...}, empty if no fields are dirty.
+        """
+
+        dirty = self.dirty_fields()
+        if not dirty:
+            return {}
+
+        meta = table_meta(self.tbl_)
+        now = datetime_now()
+        for field in meta.modified_fields:
+            setattr(self, field, now)
+
+        args = {}
+        for field in dirty + list(meta.modified_fields):
             if hasattr(self, field):
-                value = getattr(self, field)
+                args[field] = getattr(self, field)
+        return args
 
-                # Do not set if value is None so the defaults defined in
-                # the db.table definition will be used
+    def add(self):
+        """Add a record to the database.
+
+        Returns:
+            The object itself if add succeeds, nothing otherwise.
 
-                if value != None:
-                    args[field] = value
+        """
 
+        args = self._add_args()
         id = self.tbl_.insert(**args)
         self.id = id
-        self.db_.commit()
+        commit(self.db_)
+        table_changed(self.db_, self.tbl_)
 
         # The database may have changed some field values with its column
         # DEFAULT definitions. Re-read the object to ensure they are in synch.
@@ -411,9 +1497,12 @@ class DbObject(object):
         except IndexError:
             return self
 
-        for field in self.tbl_.fields:
-            if hasattr(row, field):
+        for field in table_meta(self.tbl_).fields:
+            if field in row:
                 setattr(self, field, row[field])
+        self._mark_clean()
+        for cache in object_caches():
+            cache.set(self)
         return self
 
     def as_dict(self):
@@ -429,8 +1518,14 @@ class DbObject(object):
 
         """
 
+        meta = table_meta(self.tbl_)
+        try:
+            return dict(itertools.izip(meta.fields, meta.values(self)))
+        except AttributeError:
+            # A field attribute has been deleted, skip it.
+            pass
         obj_dict = {}
-        for field in self.tbl_.fields:
+        for field in meta.fields:
             if hasattr(self, field):
                 obj_dict[field] = getattr(self, field)
         return obj_dict
@@ -446,12 +1541,39 @@ class DbObject(object):
 
         """
 
+        meta = table_meta(self.tbl_)
+        try:
+            return list(meta.values(self))
+        except AttributeError:
+            # A field attribute has been deleted, skip it.
+            pass
         obj_list = []
-        for field in self.tbl_.fields:
+        for field in meta.fields:
             if hasattr(self, field):
                 obj_list.append(getattr(self, field))
         return obj_list
 
+    def dirty_fields(self):
+        """Return the fields changed since the object was read from, or last
+        written to, the database.
+
+        Returns:
+            list, list of field names. The id field is never included. If the
+            object was not read from the database, all fields with an
+            attribute are included.
+        """
+
+        meta = table_meta(self.tbl_)
+        clean = self.__dict__.get('_clean_values')
+        try:
+            if clean is not None and len(clean) == meta.field_count:
+                return [f for f, old, new in itertools.izip(meta.fields,
+                        clean, meta.values(self)) if old != new and f != 'id']
+        except AttributeError:
+            # A field attribute has been deleted, fall through.
+            pass
+        return [f for f in meta.data_fields if hasattr(self, f)]
+
     def export_as_csv(self, out=None):
         """Write object in csv format.
 
@@ -473,6 +1595,10 @@ class DbObject(object):
     def modify(self):
         """Modify in the database the record associated with the object.
 
+        Notes:
+            Only the dirty fields are written, see dirty_fields(). If no
+            fields are dirty, nothing is written but the record must exist.
+
         Returns:
             The object itself if modify succeeds, nothing otherwise.
 
@@ -486,30 +1612,25 @@ class DbObject(object):
         if not self.id:
             return
 
-        rows = self.db_(self.tbl_.id == self.id).select()
-        if not rows:
-            raise SyntaxError('No such record, id = {id}'.format(id=self.id))
-        row = rows[0]
-
-        if hasattr(self, 'modified_date'):
-            self.modified_date = datetime_now()
-        if hasattr(self, 'modified_on'):
-            self.modified_on = datetime_now()
-        if hasattr(self, 'updated_on'):
-            self.updated_on = datetime_now()
-
-        args = {}
-        for field in self.tbl_.fields:
-
-            # Ignore the id field, it will have been set
-
-            if field == 'id':
-                continue
-            if hasattr(self, field):
-                args[field] = getattr(self, field)
+        query = self.tbl_.id == self.id
+        args = self._modify_args()
+        if not args:
+            if not self.db_(query).count():
+                raise SyntaxError('No such record, id = {id}'.format(
+                    id=self.id))
+            return self
 
-        row.update_record(**args)
-        self.db_.commit()
+        if not self.db_(query).update(**args):
+            # MySQL reports no rows updated if the values are unchanged, so
+            # only then is a missing record checked for.
+            if not self.db_(query).count():
+                raise SyntaxError('No such record, id = {id}'.format(
+                    id=self.id))
+        commit(self.db_)
+        table_changed(self.db_, self.tbl_)
+        self._mark_clean()
+        for cache in object_caches():
+            cache.set(self)
         return self
 
     def remove(self):
@@ -533,7 +1654,10 @@ class DbObject(object):
         except:
             raise SyntaxError('Unable to delete record, id = {id}'.format(
                 id=self.id))
-        self.db_.commit()
+        commit(self.db_)
+        table_changed(self.db_, self.tbl_)
+        for cache in object_caches():
+            cache.invalidate(self.tbl_, id=self.id)
         return 1
 
     def update(self, key_fields=None):
@@ -541,7 +1665,7 @@ class DbObject(object):
 
         !!! DEPECATED this method is not recommended. Unless all table fields
         are defined in the object instance, the record may not be updated as
-        expected  !!!
+        expected  !!! For many records, see Collection.bulk_upsert().
 
         Notes:
             If the object 'id' property is defined, the record is assumed to
@@ -606,6 +1730,648 @@ class DbObject(object):
         return self
 
 
+class MemoryCacheBackend(object):
+
+    """Class representing a QueryCache backend storing entries in memory.
+
+    Entries are evicted least recently used first. Entries and table
+    versions are local to the process, so writes in other processes are
+    not seen. Use a shared backend, eg SqliteCacheBackend, if records are
+    written by more than one process.
+    """
+
+    def __init__(self, size=1000):
+        """Constructor
+
+        Args:
+            size: integer, maximum number of entries.
+        """
+
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def clear(self):
+        """Remove all entries. Table versions are kept."""
+
+        with self.lock:
+            self.entries.clear()
+
+    def get(self, key):
+        """Return the value of an entry, None if there is no entry."""
+
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value       # Most recently used
+            return value
+
+    def get_version(self, key):
+        """Return the value of a version counter."""
+
+        return self.versions.get(key, 0)
+
+    def incr_version(self, key):
+        """Increment a version counter."""
+
+        with self.lock:
+            self.versions[key] = self.versions.get(key, 0) + 1
+
+    def set(self, key, value):
+        """Store an entry."""
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class ObjectCache(object):
+
+    """Class representing an LRU cache of DbObject instances keyed by table
+    and id.
+
+    The cache is used by Collection.get(id=...) and kept in synch by the
+    DbObject add, modify and remove methods and the Collection bulk methods.
+    See set_object_cache() for using a cache per request or per process.
+
+    Modes:
+        identity_map=True: The cache stores object instances. A get returns
+            the same instance for a table and id. Use this per request.
+        identity_map=False: The cache stores field values. A get returns a
+            new instance created with the caller's table and database. Use
+            this per process, objects are never shared across requests.
+    """
+
+    def __init__(self, size=1000, ttl=None, identity_map=False):
+        """Constructor
+
+        Args:
+            size: integer, maximum number of entries. The least recently used
+                entry is discarded when the cache is full.
+            ttl: integer, seconds an entry is valid. If None, entries do not
+                expire.
+            identity_map: boolean, see Modes above.
+        """
+
+        self.size = size
+        self.ttl = ttl
+        self.identity_map = identity_map
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        return
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        """Remove all entries from the cache."""
+
+        with self.lock:
+            self.entries.clear()
+        return
+
+    def get(self, tbl_, id, class_=None, db_=None):
+        """Return the cached object for a table record.
+
+        Args:
+            tbl_: gluon.dal.Table object instance
+            id: integer, id of record
+            class_: the class of the object returned. Defaults to DbObject.
+                An identity map entry of a different class is a miss.
+            db_: gluon.dal.DAL object instance, the database of new
+                instances. Optional. If not provided, tbl_['_db'] is used.
+
+        Returns:
+            class_ object instance, None if the record is not cached.
+        """
+
+        if not class_:
+            class_ = DbObject
+        key = self.key(tbl_, id)
+        with self.lock:
+            entry = self.entries.pop(key, None) if key else None
+            if entry is not None and self.ttl is not None \
+                    and entry[1] < time.time():
+                self.expirations += 1
+                entry = None
+            if entry is not None and self.identity_map \
+                    and entry[0].__class__ is not class_:
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = entry       # Most recently used
+            self.hits += 1
+        if self.identity_map:
+            return entry[0]
+        obj = class_(tbl_, db_=db_ or tbl_['_db'], **entry[0])
+        obj._mark_clean()
+        return obj
+
+    def invalidate(self, tbl_, id=None):
+        """Remove the entries of a table record.
+
+        Args:
+            tbl_: gluon.dal.Table object instance
+            id: integer, id of record. If None, all entries of the table are
+                removed.
+        """
+
+        with self.lock:
+            if id is not None:
+                self.entries.pop(self.key(tbl_, id), None)
+                return
+            table_key = self.key(tbl_, 0)[:2]
+            for key in [k for k in self.entries if k[:2] == table_key]:
+                del self.entries[key]
+        return
+
+    def key(self, tbl_, id):
+        """Return the cache key of a table record.
+
+        Notes:
+            The key uses the database uri and table name, not the objects,
+            as web2py defines tables anew for every request.
+
+        Returns:
+            tuple, (uri, table name, id), None if id is not an integer.
+        """
+        # R0201: *Method could be a function*
+        # pylint: disable=R0201
+
+        try:
+            id = int(id)
+        except (TypeError, ValueError):
+            return None
+        return (getattr(tbl_['_db'], '_uri', None), tbl_._tablename, id)
+
+    def set(self, obj):
+        """Store an object in the cache.
+
+        Args:
+            obj: DbObject object instance. Objects without an id are ignored.
+        """
+
+        key = self.key(obj.tbl_, obj.id)
+        if not key:
+            return
+        value = obj if self.identity_map else obj.as_dict()
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, expires)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return
+
+    def stats(self):
+        """Return cache statistics.
+
+        Returns:
+            dict, {'hits': integer, 'misses': integer, 'hit_rate': float,
+                'entries': integer, 'size': integer, 'evictions': integer,
+                'expirations': integer}
+        """
+
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            'entries': len(self.entries),
+            'size': self.size,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            }
+
+
+class ObjectList(list):
+
+    """Class representing the list of objects of a Collection.
+
+    The list counts its changes in the version property so indexes built on
+    it can tell when they are stale, see Collection.index().
+    """
+
+    def __init__(self, *args):
+        list.__init__(self, *args)
+        self.version = 0
+
+
+def _versioned(method):
+    """Return a list method wrapped to increment ObjectList.version."""
+
+    def wrapped(self, *args, **kwargs):
+        self.version += 1
+        return method(self, *args, **kwargs)
+    wrapped.__name__ = method.__name__
+    wrapped.__doc__ = method.__doc__
+    return wrapped
+
+for _name in ['__delitem__', '__delslice__', '__iadd__', '__imul__',
+              '__setitem__', '__setslice__', 'append', 'extend', 'insert',
+              'pop', 'remove', 'reverse', 'sort']:
+    setattr(ObjectList, _name, _versioned(getattr(list, _name)))
+del _name
+
+
+class QueryCache(object):
+
+    """Class representing a cache of Collection.get() query results.
+
+    Results are keyed by the SQL of the query and tagged with the version of
+    the table they were read from. Writes through this module, eg
+    DbObject.add(), modify(), remove() and the Collection bulk methods, bump
+    the table version, see table_changed(), so stale results are not
+    returned. Writes made any other way, eg db().update(), are not seen;
+    use the ttl to bound how stale such results can be.
+
+    Only queries of a single table are cached.
+    """
+
+    def __init__(self, backend=None, ttl=None):
+        """Constructor
+
+        Args:
+            backend: object storing the entries and table versions, eg
+                MemoryCacheBackend or SqliteCacheBackend. Defaults to
+                MemoryCacheBackend().
+            ttl: integer, seconds an entry is valid. None, valid until the
+                table changes.
+        """
+
+        self.backend = backend if backend is not None else \
+            MemoryCacheBackend()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def bump(self, db_, tablename):
+        """Increment the version of a table, invalidating its entries.
+
+        Args:
+            db_: gluon.dal.DAL object instance
+            tablename: string, name of table.
+        """
+
+        self.backend.incr_version(self.version_key(db_, tablename))
+
+    def clear(self):
+        """Remove all entries."""
+
+        self.backend.clear()
+
+    def get(self, db_, sql, version):
+        """Return the cached result of a query.
+
+        Args:
+            db_: gluon.dal.DAL object instance
+            sql: string, SQL of the query.
+            version: integer, the current version of the table, see
+                version().
+
+        Returns:
+            list of dicts, {field: value, ...}, one per record. None if the
+                result is not cached.
+        """
+
+        entry = self.backend.get(self.key(db_, sql))
+        if entry is None or entry[0] != version \
+                or (entry[1] is not None and entry[1] < time.time()):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[2]
+
+    def key(self, db_, sql):
+        """Return the cache key of a query.
+
+        Notes:
+            The key is a hash so the database uri, which may include a
+            password, is not stored.
+
+        Returns:
+            string
+        """
+
+        return hashlib.sha1('{u}\0{s}'.format(u=db_._uri, s=sql)).hexdigest()
+
+    def set(self, db_, sql, version, records):
+        """Store the result of a query.
+
+        Args:
+            db_: gluon.dal.DAL object instance
+            sql: string, SQL of the query.
+            version: integer, the version of the table read before the query
+                was run, see version().
+            records: list of dicts, {field: value, ...}, one per record.
+        """
+
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        self.backend.set(self.key(db_, sql), (version, expires, records))
+
+    def stats(self):
+        """Return cache statistics.
+
+        Returns:
+            dict, {'hits': integer, 'misses': integer, 'hit_rate': float}
+        """
+
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            }
+
+    def version(self, db_, tablename):
+        """Return the version of a table.
+
+        Args:
+            db_: gluon.dal.DAL object instance
+            tablename: string, name of table.
+
+        Returns:
+            integer
+        """
+
+        return self.backend.get_version(self.version_key(db_, tablename))
+
+    def version_key(self, db_, tablename):
+        """Return the key of a table version counter."""
+
+        return hashlib.sha1('{u}\0{t}'.format(u=db_._uri,
+                            t=tablename)).hexdigest()
+
+
+class SqliteCacheBackend(object):
+
+    """Class representing a QueryCache backend storing entries in a SQLite
+    database file.
+
+    The file can be shared by all the web2py processes on a host so a write
+    in one process invalidates the entries of every process.
+    """
+
+    prune_every = 100           # Number of sets between prunes
+
+    def __init__(self, filename, size=10000):
+        """Constructor
+
+        Args:
+            filename: string, name of SQLite database file including path.
+                It is created if it does not exist.
+            size: integer, maximum number of entries. Older entries are
+                pruned every prune_every sets.
+        """
+
+        self.filename = filename
+        self.size = size
+        self.sets = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, timeout=10,
+                check_same_thread=False, isolation_level=None)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS entry (
+                key TEXT PRIMARY KEY,
+                value BLOB,
+                stored REAL
+            );""")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS version (
+                key TEXT PRIMARY KEY,
+                value INTEGER
+            );""")
+
+    def clear(self):
+        """Remove all entries. Table versions are kept."""
+
+        with self.lock:
+            self.connection.execute('DELETE FROM entry;')
+
+    def get(self, key):
+        """Return the value of an entry, None if there is no entry."""
+
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT value FROM entry WHERE key = ?;', (key, )).fetchone()
+        if row is None:
+            return None
+        return cPickle.loads(str(row[0]))
+
+    def get_version(self, key):
+        """Return the value of a version counter."""
+
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT value FROM version WHERE key = ?;', (key, )
+                ).fetchone()
+        return row[0] if row else 0
+
+    def incr_version(self, key):
+        """Increment a version counter."""
+
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR IGNORE INTO version (key, value) VALUES (?, 0);',
+                (key, ))
+            self.connection.execute(
+                'UPDATE version SET value = value + 1 WHERE key = ?;',
+                (key, ))
+
+    def set(self, key, value):
+        """Store an entry."""
+
+        data = sqlite3.Binary(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO entry (key, value, stored)'
+                ' VALUES (?, ?, ?);', (key, data, time.time()))
+            self.sets += 1
+            if self.sets % self.prune_every == 0:
+                self.connection.execute("""
+                    DELETE FROM entry WHERE key NOT IN (
+                        SELECT key FROM entry ORDER BY stored DESC LIMIT ?
+                    );""", (self.size, ))
+
+
+class TableMeta(object):
+
+    """Class representing the field metadata of a table.
+
+    DbObject and Collection methods walk the table fields for every object.
+    The metadata is computed once per table and cached, see table_meta().
+    It holds field names only, no table or Field references, so it can be
+    shared by the Table objects web2py defines on every request.
+    """
+
+    # Fields set when a record is created and when it is modified, in the
+    # order they are set.
+    created_field_names = ('creation_date', 'created_on')
+    modified_field_names = ('modified_date', 'modified_on', 'updated_on')
+
+    def __init__(self, tbl_):
+        """Constructor
+
+        Args:
+            tbl_: gluon.dal.Table object instance
+        """
+
+        self.source_fields = list(tbl_.fields)  # Used to detect changes
+        self.fields = tuple(tbl_.fields)
+        self.field_set = frozenset(self.fields)
+        self.data_fields = tuple([f for f in self.fields if f != 'id'])
+        self.created_fields = tuple([f for f in self.created_field_names
+                                    if f in self.field_set])
+        self.modified_fields = tuple([f for f in self.modified_field_names
+                                     if f in self.field_set])
+        self.timestamp_fields = self.created_fields + self.modified_fields
+        self.field_count = len(self.fields)
+
+        # Getters return a tuple of field values from an object __dict__ and
+        # from an object attributes respectively, eg CompactRow instances.
+        self.item_getter = operator.itemgetter(*self.fields)
+        self.attr_getter = operator.attrgetter(*self.fields)
+        if self.field_count == 1:
+            self.item_getter = lambda x, f=self.fields[0]: (x[f], )
+            self.attr_getter = lambda x, f=self.fields[0]: (getattr(x, f), )
+        return
+
+    def values(self, obj):
+        """Return the field values of an object.
+
+        Args:
+            obj: DbObject or CompactRow object instance
+
+        Returns:
+            tuple, values in table field order.
+
+        Raises:
+            AttributeError, if the object has no attribute for a field.
+        """
+
+        try:
+            return self.item_getter(obj.__dict__)
+        except (AttributeError, KeyError):
+            # No __dict__, eg CompactRow, or some values are not in it.
+            return self.attr_getter(obj)
+
+
+def can_roll_back_unit(db_):
+    """Return whether a unit_of_work() opened now would roll back its own
+    writes on an exception.
+
+    Notes:
+        An outermost unit rolls back the transaction. A nested unit rolls
+        back its writes only if it is a savepoint, see unit_of_work().
+
+    Args:
+        db_: gluon.dal.DAL object instance
+
+    Returns:
+        True if the unit's writes would be rolled back.
+    """
+
+    return not in_unit_of_work(db_) or db_._dbname in SAVEPOINT_DBNAMES
+
+
+def chunks(items, size):
+    """Generator returning lists of items of the given size.
+
+    Args:
+        items: iterable
+        size: integer, maximum number of items per list.
+
+    Returns:
+        generator of lists. The last list may have fewer than size items.
+    """
+
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def commit(db_):
+    """Commit the database transaction unless a unit of work is open.
+
+    Args:
+        db_: gluon.dal.DAL object instance
+
+    Returns:
+        True if committed, False if the commit is deferred to the unit of
+        work, see unit_of_work().
+    """
+
+    if in_unit_of_work(db_):
+        return False
+    db_.commit()
+    return True
+
+
+def compact_class(tbl_, class_=None, db_=None):
+    """Return the CompactRow subclass for a table.
+
+    Notes:
+        Classes are generated once per table, class and database, and cached.
+        If the table fields change, a new class is generated. The cache
+        references the table and database weakly, a cached class is dropped
+        when either is garbage collected, eg at the end of a request.
+
+    Args:
+        tbl_: gluon.dal.Table object instance
+        class_: the class rows are upgraded to. Defaults to DbObject.
+        db_: gluon.dal.DAL object instance
+            Optional. If not provided, tbl_['_db'] is used.
+
+    Returns:
+        CompactRow subclass with a slot for each table field.
+    """
+
+    if not class_:
+        class_ = DbObject
+    if not db_:
+        db_ = tbl_['_db']
+    fields = table_meta(tbl_).fields
+    key = (id(tbl_), id(db_), class_, fields)
+    row_class = COMPACT_CLASSES.get(key)
+    if row_class is None or row_class._tbl_ref() is not tbl_ \
+            or row_class._db_ref() is not db_:
+        def forget(ref, key=key):
+            """Remove the class of a collected table or database. The ids
+            of collected objects are reused, so entries must not outlive
+            them."""
+            cached = COMPACT_CLASSES.get(key)
+            if cached is not None \
+                    and (ref is cached._tbl_ref or ref is cached._db_ref):
+                del COMPACT_CLASSES[key]
+
+        row_class = type(
+            '{name}CompactRow'.format(name=class_.__name__),
+            (CompactRow, ),
+            {
+                '__slots__': fields,
+                '_db_ref': weakref.ref(db_, forget),
+                '_fields': fields,
+                '_tbl_ref': weakref.ref(tbl_, forget),
+                'class_': class_,
+            })
+        COMPACT_CLASSES[key] = row_class
+    return row_class
+
+
 def datetime_now():
     """Now with microseconds removed"""
 
@@ -621,6 +2387,49 @@ def datetime_now():
         )
 
 
+def in_unit_of_work(db_):
+    """Return whether a unit of work is open on the database in the current
+    thread.
+
+    Args:
+        db_: gluon.dal.DAL object instance
+
+    Returns:
+        True if a unit of work is open.
+    """
+
+    return bool(getattr(UNITS_OF_WORK, 'stacks', {}).get(id(db_)))
+
+
+def object_caches():
+    """Return the ObjectCache instances in use.
+
+    Returns:
+        list, the request cache, if set, followed by the process cache, if
+            set.
+    """
+
+    caches = []
+    request_cache = getattr(REQUEST_OBJECT_CACHE, 'cache', None)
+    if request_cache is not None:
+        caches.append(request_cache)
+    if OBJECT_CACHES['process'] is not None:
+        caches.append(OBJECT_CACHES['process'])
+    return caches
+
+
+def query_caches():
+    """Return the QueryCache instances in use.
+
+    Returns:
+        list, the process cache, if set.
+    """
+
+    if QUERY_CACHES['process'] is not None:
+        return [QUERY_CACHES['process']]
+    return []
+
+
 def rows_to_objects(rows, objects):
     """Convert rows to object instances.
 
@@ -694,3 +2503,177 @@ def rows_to_objects(rows, objects):
                 d[k] = obj_class(obj_dal, **r[k])
         instances.append(d)
     return instances
+
+
+def set_object_cache(cache, per_request=False):
+    """Set the ObjectCache used by Collection and DbObject.
+
+    Args:
+        cache: ObjectCache object instance. None removes the cache.
+        per_request: If True, the cache is used by the current thread only.
+            Otherwise it is used by the process.
+
+    Usage:
+        # models/db.py, a new identity map for every request
+        set_object_cache(ObjectCache(identity_map=True), per_request=True)
+
+        # models/0.py, a process wide cache of reference records
+        if not object_caches():
+            set_object_cache(ObjectCache(size=5000, ttl=300))
+    """
+
+    if per_request:
+        REQUEST_OBJECT_CACHE.cache = cache
+    else:
+        OBJECT_CACHES['process'] = cache
+    return
+
+
+def set_query_cache(cache):
+    """Set the QueryCache used by Collection.get(cached=True).
+
+    Args:
+        cache: QueryCache object instance. None removes the cache.
+
+    Usage:
+        # models/0.py, a cache shared by the web2py processes of the host
+        if not query_caches():
+            set_query_cache(QueryCache(backend=SqliteCacheBackend(
+                os.path.join(request.folder, 'cache', 'query_cache.db'))))
+    """
+
+    QUERY_CACHES['process'] = cache
+    return
+
+
+def sql_value(db_, field, value):
+    """Return the SQL representation of a field value.
+
+    Args:
+        db_: gluon.dal.DAL object instance
+        field: gluon.dal.Field object instance
+        value: the field value
+
+    Returns:
+        string, SQL literal, eg 'abc', 123, NULL
+    """
+
+    return db_._adapter.represent(value, field.type)
+
+
+def table_changed(db_, tbl_):
+    """Record that records of a table were written.
+
+    Notes:
+        The table version of the query caches is bumped. If a unit of work
+        is open, the version is bumped again when the outermost unit exits
+        so results read by other requests before the commit are not kept.
+
+    Args:
+        db_: gluon.dal.DAL object instance
+        tbl_: gluon.dal.Table object instance
+    """
+
+    caches = query_caches()
+    if not caches:
+        return
+    for cache in caches:
+        cache.bump(db_, tbl_._tablename)
+    if in_unit_of_work(db_):
+        if not hasattr(UNITS_OF_WORK, 'pending'):
+            UNITS_OF_WORK.pending = {}
+        UNITS_OF_WORK.pending.setdefault(id(db_), set()).add(
+            tbl_._tablename)
+
+
+def table_meta(tbl_):
+    """Return the cached field metadata for a table.
+
+    Notes:
+        The metadata is cached by database uri and table name, so the Table
+        objects of every request share it. It is recomputed if the table
+        definition changes, eg the table is redefined or fields are added.
+
+    Args:
+        tbl_: gluon.dal.Table object instance
+
+    Returns:
+        TableMeta object instance
+    """
+
+    key = (str(tbl_['_db']._uri), tbl_._tablename)
+    meta = TABLE_METAS.get(key)
+    if meta is None or tbl_.fields != meta.source_fields:
+        meta = TableMeta(tbl_)
+        TABLE_METAS[key] = meta
+    return meta
+
+
+@contextlib.contextmanager
+def unit_of_work(db_):
+    """Context manager grouping database writes into a single transaction.
+
+    Usage:
+        with unit_of_work(db):
+            for obj in objects:
+                obj.modify()
+
+    Notes:
+        Inside the unit, DbObject add(), modify() and remove() and the
+        Collection bulk methods do not commit. The transaction is committed
+        once when the outermost unit exits, or rolled back if it exits with
+        an exception.
+
+        Units can be nested. On MySQL and PostgreSQL a nested unit is a
+        savepoint, an exception rolls back only the nested unit's writes.
+        Other databases, eg SQLite whose python 2 driver commits before a
+        SAVEPOINT statement, nest without savepoints; a nested unit's writes
+        are rolled back only if the exception reaches the outermost unit.
+        See can_roll_back_unit().
+
+        After a rollback the object caches are cleared as they may hold
+        values written by the unit. Objects added in the unit keep the ids
+        they were given. The table versions of the query cache are bumped
+        again when the outermost unit exits, see table_changed().
+
+    Args:
+        db_: gluon.dal.DAL object instance
+    """
+
+    # W0702: *No exception type(s) specified*
+    # pylint: disable=W0702
+
+    if not hasattr(UNITS_OF_WORK, 'stacks'):
+        UNITS_OF_WORK.stacks = {}
+    stack = UNITS_OF_WORK.stacks.setdefault(id(db_), [])
+    savepoint = None
+    if stack and db_._dbname in SAVEPOINT_DBNAMES:
+        savepoint = 'unit_of_work_{n}'.format(n=len(stack))
+        db_.executesql('SAVEPOINT {s};'.format(s=savepoint))
+    stack.append(savepoint)
+    try:
+        yield db_
+    except:
+        stack.pop()
+        if savepoint:
+            db_.executesql('ROLLBACK TO SAVEPOINT {s};'.format(s=savepoint))
+        elif not stack:
+            db_.rollback()
+        for cache in object_caches():
+            cache.clear()
+        raise
+    else:
+        stack.pop()
+        if savepoint:
+            db_.executesql('RELEASE SAVEPOINT {s};'.format(s=savepoint))
+        elif not stack:
+            db_.commit()
+    finally:
+        if not stack:
+            UNITS_OF_WORK.stacks.pop(id(db_), None)
+            # Tables written in the unit are changed again now the writes
+            # are committed (or rolled back), see table_changed().
+            pending = getattr(UNITS_OF_WORK, 'pending', {}).pop(id(db_), [])
+            for tablename in pending:
+                for cache in query_caches():
+                    cache.bump(db_, tablename)
@@ -25,6 +25,54 @@ class DbSequenceField(object):
         self.db_ = self.field._db
         self.table = self.field._db[self.field._tablename]
 
+    def _tidy_by_row(self):
+        """Tidy up values in sequence field one record at a time.
+
+        Used for databases without a set based tidy. See tidy().
+        """
+
+        # Update records with non-NULL sequence values first, then NULL ones
+
+        count = 1
+        queries = [self.field != None, self.field == None]
+        for query in queries:
+            rows = self.db_(query).select(self.table.ALL,
+                    orderby=self.field | self.table.id)
+            for row in rows:
+                if row[self.field.name] != count:
+                    row.update_record(**dict([[self.field.name,
+                            count]]))
+                count += 1
+        return count
+
+    def is_tidy(self):
+        """Determine whether the sequence is tidy.
+
+        Notes:
+            The sequence is tidy if every record has a value, and the values
+            run from 1 to the number of records without duplicates. A single
+            aggregate query is used.
+
+        Returns:
+            tuple, (tidy, records) where tidy is True if the sequence is tidy
+                and records is the number of records.
+        """
+
+        # pylint: disable=W0212
+
+        sql = """
+            SELECT COUNT(*), COUNT({f}), COUNT(DISTINCT {f}), MIN({f}),
+                MAX({f})
+            FROM {t};
+            """.format(f=self.field.name, t=self.table._tablename)
+        (records, values, distinct, minimum, maximum) = \
+            self.db_.executesql(sql)[0]
+        if records == 0:
+            return (True, 0)
+        tidy = records == values == distinct and minimum == 1 \
+            and maximum == records
+        return (tidy, records)
+
     def move(self, record_id, position='end'):
         """
         Move a record within the sequence to the indicated position.
@@ -33,14 +81,22 @@ class DbSequenceField(object):
                    can be an integer or a key word
                    'start' - move to start of sequence
                    'end'   - move to end of sequence
+
+        Only the records between the current and new positions are updated.
+        If the sequence is not tidy, it is tidied first. Positions outside
+        the sequence are moved to the start or end.
         """
 
         if not record_id:
             return
 
+        (tidy, records) = self.is_tidy()
+        if not tidy:
+            self.tidy()
+
         # Determine the current position
 
-        rows = self.db_(self.table.id == record_id).select()
+        rows = self.db_(self.table.id == record_id).select(self.field)
 
         if not len(rows) > 0:
             return
@@ -50,7 +106,7 @@ class DbSequenceField(object):
             if position == 'start':
                 position = 1
             elif position == 'end':
-                position = self.tidy() + 1
+                position = records
             elif position == 'up':
                 position = current_pos - 1
             elif position == 'down':
@@ -58,26 +114,27 @@ class DbSequenceField(object):
             else:
                 return
 
+        position = max(1, min(position, records))
+
         if position == current_pos:
             return   # nothing to do
 
         # Increment(decrement) the value of the sequence field for all records
         # where the current value is between the position and the current
-        # position inclusive.
+        # position.
 
-        query = self.field != None
+        query = self.table.id != record_id
         delta = 1
         if position < current_pos:
             query = query & (self.field >= position)
-            query = query & (self.field <= current_pos)
+            query = query & (self.field < current_pos)
         else:
             query = query & (self.field <= position)
-            query = query & (self.field >= current_pos)
+            query = query & (self.field > current_pos)
             delta = -1
 
         self.db_(query).update(**dict([[self.field.name, self.field
                                + delta * 1]]))
-        self.db_.commit()
 
         # Update the moved record
 
@@ -85,10 +142,6 @@ class DbSequenceField(object):
                  == record_id).update(**dict([[self.field.name,
                 position]]))
         self.db_.commit()
-
-        # Tidy up
-
-        self.tidy()
         return
 
     def tidy(self):
@@ -104,23 +157,59 @@ class DbSequenceField(object):
         If two records have the same sequence value, the one with the lower id
         is given a lower sequence value.
 
-        Returns the number of records in the sequence.
-        """
+        The records are renumbered with a single set based UPDATE (MySQL,
+        PostgreSQL) or a ranked temporary table (SQLite) rather than one
+        UPDATE per record.
 
-        # Update records with non-NULL sequence values first, then NULL ones
+        Returns the number of records in the sequence plus one, ie the next
+        sequence value.
+        """
 
-        count = 1
-        queries = [self.field != None, self.field == None]
-        for query in queries:
-            rows = self.db_(query).select(self.table.ALL,
-                    orderby=self.field)
-            for row in rows:
-                if row[self.field.name] != count:
-                    row.update_record(**dict([[self.field.name,
-                            count]]))
-                count += 1
+        # pylint: disable=W0212
+
+        params = dict(f=self.field.name, t=self.table._tablename)
+        dbname = self.db_._dbname
+        if dbname == 'mysql':
+            self.db_.executesql('SET @seq := 0;')
+            self.db_.executesql("""
+                UPDATE {t} SET {f} = (@seq := @seq + 1)
+                ORDER BY {f} IS NULL, {f}, id;
+                """.format(**params))
+        elif dbname == 'sqlite':
+            self.db_.executesql('DROP TABLE IF EXISTS temp.seq_rank;')
+            self.db_.executesql("""
+                CREATE TEMP TABLE seq_rank (
+                    pos INTEGER PRIMARY KEY,
+                    rid INTEGER UNIQUE
+                );
+                """)
+            self.db_.executesql("""
+                INSERT INTO seq_rank (rid)
+                SELECT id FROM {t} ORDER BY {f} IS NULL, {f}, id;
+                """.format(**params))
+            self.db_.executesql("""
+                UPDATE {t}
+                SET {f} = (SELECT pos FROM seq_rank WHERE rid = {t}.id)
+                WHERE {f} IS NULL
+                    OR {f} != (SELECT pos FROM seq_rank WHERE rid = {t}.id);
+                """.format(**params))
+            self.db_.executesql('DROP TABLE temp.seq_rank;')
+        elif dbname == 'postgres':
+            self.db_.executesql("""
+                UPDATE {t} SET {f} = r.pos
+                FROM (
+                    SELECT id, ROW_NUMBER() OVER (
+                        ORDER BY {f} IS NULL, {f}, id) AS pos
+                    FROM {t}
+                ) AS r
+                WHERE {t}.id = r.id AND {t}.{f} IS DISTINCT FROM r.pos;
+                """.format(**params))
+        else:
+            count = self._tidy_by_row()
+            self.db_.commit()
+            return count
         self.db_.commit()
-        return count
+        return self.db_(self.table.id > 0).count() + 1
 
     def __repr__(self):
         return str(self.__dict__)
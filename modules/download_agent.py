@@ -6,16 +6,25 @@ Classes for handling url downloads.
 
 """
 
-import StringIO
+import Queue
 import cookielib
-import gzip
+import email.utils
+import glob
+import hashlib
 import httplib
+import json
 import os
 import pwd
+import random
+import re
 import socket
+import sys
+import threading
 import time
 import urllib
 import urllib2
+import urlparse
+import zlib
 
 # Verbose levels
 
@@ -25,12 +34,354 @@ INFO = 1
 DEBUG = 2
 
 
+class BatchDownloader(object):
+
+    """Class representing a downloader of a batch of urls, fetched
+    concurrently by a bounded set of threads.
+
+    Downloads to a host are limited to max_host_workers at a time and, if
+    rate is set, to rate starts per second.
+    """
+
+    lookahead = 100             # Maximum items read ahead of the downloads
+    max_host_workers = 2        # Maximum concurrent downloads per host
+    max_workers = 8             # Number of download threads
+    rate = None                 # Maximum downloads started per second per host
+
+    def __init__(
+        self,
+        max_workers=None,
+        max_host_workers=None,
+        rate=None,
+        agent_kwargs=None,
+        ):
+        """Constructor
+
+        Args:
+            max_workers: integer, number of download threads. Defaults to the
+                class attribute.
+            max_host_workers: integer, maximum concurrent downloads per host.
+                Defaults to the class attribute.
+            rate: float, maximum downloads started per second per host.
+                Defaults to the class attribute, None is no limit.
+            agent_kwargs: dict, DownloadAgent constructor kwargs of the
+                agents created for urls, eg {'retries': 3}
+        """
+
+        if max_workers is not None:
+            self.max_workers = max_workers
+        if max_host_workers is not None:
+            self.max_host_workers = max_host_workers
+        if rate is not None:
+            self.rate = rate
+        self.agent_kwargs = agent_kwargs or {}
+        self.condition = threading.Condition()
+        self.items = None           # iterator of (index, item) tuples
+        self.pending = []           # [(index, agent, host), ...]
+        self.active = {}            # {host: number of downloads}
+        self.next_start = {}        # {host: earliest time of next download}
+        self.stopped = False
+
+    def agent(self, item):
+        """Return the DownloadAgent of a batch item.
+
+        Args:
+            item: string, url, or tuple (url, post_data), or DownloadAgent
+                instance.
+
+        Returns:
+            DownloadAgent instance
+        """
+
+        if isinstance(item, DownloadAgent):
+            return item
+        kwargs = dict(self.agent_kwargs)
+        if isinstance(item, basestring):
+            kwargs['url'] = item
+        else:
+            (kwargs['url'], kwargs['post_data']) = item
+        return DownloadAgent(**kwargs)
+
+    def download(self, items):
+        """Download a batch of items.
+
+        Notes:
+            Each item is downloaded with DownloadAgent.download() so errors
+            are retried as classified by ErrorMessage. An exception raised
+            by a download is recorded in the agent errors.
+
+            Items are read from the iterable as downloads progress, so large
+            batches may be provided by a generator.
+
+        Args:
+            items: iterable of items, see agent().
+
+        Yields:
+            tuple, (integer, index of the item in items, DownloadAgent
+                instance), as downloads complete. The agent content, errors
+                and seconds attributes hold the results.
+
+        Raises:
+            The exception raised reading an item from items, or creating
+            its agent. The batch is stopped.
+        """
+
+        self.items = enumerate(items)
+        self.pending = []
+        self.active = {}
+        self.next_start = {}
+        self.stopped = False
+        results = Queue.Queue()
+        running = 0
+        for unused_i in range(self.max_workers):
+            thread = threading.Thread(target=self._work, args=(results,))
+            thread.daemon = True
+            thread.start()
+            running += 1
+
+        try:
+            while running:
+                result = results.get()
+                if result is None:
+                    running -= 1
+                    continue
+                (index, value) = result
+                if index is None:
+                    # A worker failed to get an item, value is its exc_info.
+                    raise value[0], value[1], value[2]
+                yield result
+        finally:
+            # Stop the workers if the caller stops iterating early.
+            with self.condition:
+                self.stopped = True
+                self.condition.notify_all()
+
+    def _next(self):
+        """Return the next download whose host is available, waiting as
+        necessary.
+
+        Returns:
+            tuple, (index, DownloadAgent instance, host), or None if there
+                are no more items.
+        """
+
+        with self.condition:
+            while not self.stopped:
+                while self.items is not None \
+                        and len(self.pending) < self.lookahead:
+                    try:
+                        (index, item) = self.items.next()
+                    except StopIteration:
+                        self.items = None
+                        break
+                    agent = self.agent(item)
+                    host = urlparse.urlsplit(agent.url or '').netloc.lower()
+                    self.pending.append((index, agent, host))
+                if not self.pending and self.items is None:
+                    return None
+
+                now = time.time()
+                wait = None
+                for (i, (index, agent, host)) in enumerate(self.pending):
+                    if self.active.get(host, 0) >= self.max_host_workers:
+                        continue
+                    start = self.next_start.get(host, 0)
+                    if start > now:
+                        if wait is None or start - now < wait:
+                            wait = start - now
+                        continue
+                    del self.pending[i]
+                    self.active[host] = self.active.get(host, 0) + 1
+                    if self.rate:
+                        self.next_start[host] = now + 1.0 / self.rate
+                    return (index, agent, host)
+                self.condition.wait(wait)
+        return None
+
+    def _work(self, results):
+        """Download items until there are none left.
+
+        Args:
+            results: Queue.Queue instance, (index, agent) tuples are put on
+                it as downloads complete, and None when the thread is done.
+                If reading an item or creating its agent raises an
+                exception, (None, sys.exc_info()) is put on it and the
+                thread is done.
+        """
+
+        try:
+            while True:
+                try:
+                    download = self._next()
+                except Exception:   # pylint: disable=W0703
+                    results.put((None, sys.exc_info()))
+                    return
+                if download is None:
+                    return
+                (index, agent, host) = download
+                try:
+                    agent.download()
+                except Exception, err:   # pylint: disable=W0703
+                    agent.errors.append('ERROR: {err}'.format(err=err))
+                finally:
+                    with self.condition:
+                        self.active[host] -= 1
+                        self.condition.notify_all()
+                results.put((index, agent))
+        finally:
+            results.put(None)
+
+
+class ConnectionPool(object):
+
+    """Class representing a pool of persistent HTTP/1.1 connections, keyed by
+    scheme and host, and by the tunnel host of connections through a proxy.
+
+    Connections are reused by every DownloadAgent using the pool.
+    """
+
+    idle_seconds = 60           # Idle connections older than this are closed
+    max_connections = 10        # Maximum connections per host, idle or in use
+    max_idle = 4                # Maximum idle connections per host
+    wait_seconds = 60           # Seconds to wait for a connection at the max
+
+    def __init__(self, max_connections=None, max_idle=None):
+        """Constructor
+
+        Args:
+            max_connections: integer, maximum connections per host, idle or
+                in use. Defaults to the class attribute.
+            max_idle: integer, maximum idle connections kept per host.
+                Defaults to the class attribute.
+        """
+
+        if max_connections is not None:
+            self.max_connections = max_connections
+        if max_idle is not None:
+            self.max_idle = max_idle
+        self.idle = {}          # {key: [(connection, released time), ...]}
+        self.counts = {}        # {key: number of connections}
+        self.condition = threading.Condition()
+        self.created = 0
+        self.reused = 0
+
+    def clear(self):
+        """Close all idle connections."""
+
+        with self.condition:
+            for (key, idle) in self.idle.items():
+                for (connection, unused_released) in idle:
+                    connection.close()
+                    self.counts[key] -= 1
+            self.idle = {}
+            self.condition.notify_all()
+
+    def discard(self, key, connection):
+        """Close a connection and remove it from the pool.
+
+        Args:
+            key: tuple, (scheme, host[, tunnel host]), see get().
+            connection: httplib.HTTPConnection instance, from get().
+        """
+
+        connection.close()
+        with self.condition:
+            self.counts[key] = self.counts.get(key, 1) - 1
+            self.condition.notify()
+
+    def get(self, key, timeout=None):
+        """Return a connection to a host.
+
+        Args:
+            key: tuple, (scheme, host), eg ('https', 'www.example.com:8443'),
+                or (scheme, proxy host, tunnel host) for connections
+                tunneled through a proxy with CONNECT. The caller sets the
+                tunnel of new connections, see PooledHTTPHandler.
+            timeout: float, socket timeout of new connections.
+
+        Returns:
+            tuple, (httplib.HTTPConnection instance, boolean True if the
+                connection was reused)
+
+        Raises:
+            urllib2.URLError, if no connection is available within
+                wait_seconds.
+        """
+
+        deadline = time.time() + self.wait_seconds
+        with self.condition:
+            while True:
+                idle = self.idle.get(key, [])
+                while idle:
+                    (connection, released) = idle.pop()
+                    if released + self.idle_seconds > time.time():
+                        self.reused += 1
+                        return (connection, True)
+                    connection.close()
+                    self.counts[key] -= 1
+                if self.counts.get(key, 0) < self.max_connections:
+                    self.counts[key] = self.counts.get(key, 0) + 1
+                    self.created += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise urllib2.URLError(
+                        'No connection available to {h}'.format(h=key[1]))
+                self.condition.wait(remaining)
+
+        (scheme, host) = key[:2]
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(host, timeout=timeout)
+        else:
+            connection = httplib.HTTPConnection(host, timeout=timeout)
+        return (connection, False)
+
+    def release(self, key, connection):
+        """Return a connection to the pool for reuse.
+
+        Args:
+            key: tuple, (scheme, host[, tunnel host]), see get().
+            connection: httplib.HTTPConnection instance, from get(). The
+                response of its last request must be completely read.
+        """
+
+        with self.condition:
+            idle = self.idle.setdefault(key, [])
+            if connection.sock is not None and len(idle) < self.max_idle:
+                idle.append((connection, time.time()))
+                self.condition.notify()
+                return
+        self.discard(key, connection)
+
+    def stats(self):
+        """Return pool statistics.
+
+        Returns:
+            dict, {'created': integer, 'reused': integer,
+                'connections': integer, 'idle': integer}
+        """
+
+        with self.condition:
+            return {
+                'created': self.created,
+                'reused': self.reused,
+                'connections': sum(self.counts.values()),
+                'idle': sum([len(x) for x in self.idle.values()]),
+                }
+
+
+CONNECTION_POOL = ConnectionPool()      # Default pool of DownloadAgent
+
+
 class DownloadAgent(object):
 
     """
     Class similar to urllib/urllib2 used to handle downloading.
     """
 
+    chunk_size = 65536          # Bytes read from the response at a time
+    max_bytes = None            # Maximum content size, None is no limit
+
     def __init__(
         self,
         accept_encoding=None,
@@ -41,6 +392,9 @@ class DownloadAgent(object):
         request_headers=None,
         retries=0,
         url=None,
+        pool=None,
+        cache=None,
+        retry_policy=None,
         ):
         """Constructor.
 
@@ -52,6 +406,13 @@ class DownloadAgent(object):
             referrer: string, Referrer url.
             retries: integer, Number of times to retry incase of failure.
             url: string, Url to download
+            pool: ConnectionPool instance, pool of connections downloads
+                reuse. Defaults to CONNECTION_POOL, shared by all agents.
+            cache: HttpCache instance. If set, GET responses are cached and
+                revalidated with conditional requests.
+            retry_policy: RetryPolicy instance, the timeouts and the retry
+                backoff of the download. Defaults to RETRY_POLICY, shared
+                by all agents so a failing host is tracked across them.
         """
 
         self.accept_encoding = accept_encoding
@@ -67,18 +428,89 @@ class DownloadAgent(object):
             self.request_headers = request_headers
         self.retries = retries
         self.url = url
+        self.pool = pool if pool is not None else CONNECTION_POOL
+        self.cache = cache
+        self.retry_policy = retry_policy if retry_policy is not None \
+            else RETRY_POLICY
         self.urllib_quote_safe = """:/?&="+-"""
         self.response = None
         self.content = None
         self.errors = []
+        self.seconds = None         # Duration of the download
+        self.cached = False         # True if content is from the cache
         return
 
-    def download(self):
-        """Download url and store content."""
+    def download(self, target=None, max_bytes=None, resume=False):
+        """Download url and store content.
+
+        Notes:
+            The response is read, and gzip or deflate content decoded, a
+            chunk at a time. Unless a target is provided, the chunks are
+            joined and stored in the content attribute.
+
+            Downloads to a target are not cached.
+
+        Args:
+            target: file object, or callable, the content is written to it,
+                or passed to it, a chunk at a time instead of being stored.
+            max_bytes: integer, maximum size of the content, including the
+                size of a resumed file. Larger downloads are stopped with an
+                error. Defaults to the max_bytes class attribute.
+            resume: boolean, if True, target is a file and the download
+                continues from the end of the file using an HTTP Range
+                request. Until the download completes, the url, ETag and
+                Last-Modified of the response are stored in the file
+                <target name>.resume, and resuming sends them with If-Range
+                so the file is only continued if it has not changed. If
+                there is no validator to send, eg the .resume file is
+                missing, or the range sent does not continue the file, it
+                is downloaded from the start.
+
+        Raises:
+            ValueError, if resume is True and target is not a file object.
+        """
 
         if not self.url:
             return
 
+        start = time.time()
+
+        write = None
+        offset = 0
+        resume_filename = None
+        validators = {}
+        if_range = None
+        if target is not None:
+            write = target if callable(target) else target.write
+            if resume:
+                if not hasattr(target, 'seek'):
+                    raise ValueError('Resume requires a file target.')
+                target.seek(0, os.SEEK_END)
+                offset = target.tell()
+                resume_filename = self._resume_filename(target)
+        if offset and resume_filename:
+            try:
+                with open(resume_filename, 'rb') as f:
+                    validators = json.loads(f.read())
+            except (IOError, ValueError):
+                pass
+            if validators.get('url') != self.url:
+                validators = {}
+        if offset:
+            # If-Range requires a strong validator.
+            if_range = validators.get('etag')
+            if not if_range or if_range.startswith('W/'):
+                if_range = validators.get('last_modified')
+            if not if_range:
+                # The file can't be known to be unchanged, start over.
+                target.seek(0)
+                target.truncate()
+                offset = 0
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        use_cache = self.cache is not None and not self.post_data \
+            and target is None
+
         if self.cookie:
             self.cookie_jar.set_cookie(self.cookie)
         cookie_filename = None
@@ -91,20 +523,63 @@ class DownloadAgent(object):
             if os.access(cookie_filename, os.F_OK):
                 self.cookie_jar.load(ignore_discard=True, ignore_expires=True)
 
-        cookie_handler = urllib2.HTTPCookieProcessor(self.cookie_jar)
-        opener = urllib2.build_opener(cookie_handler)
-        urllib2.install_opener(opener)
+        opener = self.opener()
 
         scrubbed_url = urllib.quote(self.url,
                                     safe=self.urllib_quote_safe)
         req = self.request(scrubbed_url)
+        if offset:
+            req.add_header('Range', 'bytes={o}-'.format(o=offset))
+            # The range of an encoded body can't be decoded by itself.
+            req.add_header('Accept-encoding', 'identity')
+            req.add_header('If-Range', if_range)
+
+        cache_entry = None
+        if use_cache:
+            cache_entry = self.cache.entry(self.url)
+            if cache_entry and self.cache.fresh(cache_entry):
+                self.content = self.cache.content(self.url)
+                if self.content is not None:
+                    self.cached = True
+                    self.cache.hit(self.url, cache_entry)
+                    self.seconds = time.time() - start
+                    return
+            if cache_entry:
+                for (name, value) in \
+                        self.cache.request_headers(cache_entry).items():
+                    req.add_header(name, value)
 
+        policy = self.retry_policy
+        host = urlparse.urlsplit(scrubbed_url).netloc.lower()
+        not_modified = None
+        range_complete = False
+        attempt = 0
         tries = 1 + self.retries
         while tries:
+            if not policy.allow(host):
+                self.errors.append('ERROR: Downloads from {h} suspended,'
+                    ' host failing.'.format(h=host))
+                break
             try:
-                self.response = urllib2.urlopen(req, timeout=10)
+                self.response = opener.open(req,
+                        timeout=policy.connect_timeout)
+                policy.success(host)
                 tries = 0
             except IOError, err:
+                if hasattr(err, 'close'):
+                    # HTTPError, free its connection.
+                    err.close()
+                if policy.host_failure(err):
+                    policy.failure(host)
+                else:
+                    policy.success(host)
+                if cache_entry and getattr(err, 'code', None) == 304:
+                    not_modified = err
+                    break
+                if offset and getattr(err, 'code', None) == 416:
+                    # Range Not Satisfiable, the file is complete.
+                    range_complete = True
+                    break
                 error_msg = ErrorMessage(err)
                 error_msg.identify()
                 if error_msg.retry:
@@ -121,10 +596,37 @@ class DownloadAgent(object):
 
                 tries = 0
             if tries > 0:
-                time.sleep(1)
+                attempt += 1
+                delay = policy.delay(attempt, err)
+                if delay is None:
+                    tries = 0
+                else:
+                    policy.sleep(delay)
+
+        if not_modified is not None:
+            if cookie_filename:
+                self.cookie_jar.save(ignore_discard=True,
+                        ignore_expires=True)
+            self.content = self.cache.content(self.url)
+            if self.content is None:
+                self.errors.append(
+                    'ERROR: Cached content of %s not found.' % self.url)
+            else:
+                self.cached = True
+                self.cache.hit(self.url, cache_entry,
+                        info=not_modified.info())
+            self.seconds = time.time() - start
+            return
+
+        if range_complete:
+            if resume_filename and os.path.exists(resume_filename):
+                os.remove(resume_filename)
+            self.seconds = time.time() - start
+            return
 
         if not self.response:
             self.errors.append('ERROR: No response from %s.' % self.url)
+            self.seconds = time.time() - start
             return
 
         #import sys      # FIXME
@@ -138,22 +640,78 @@ class DownloadAgent(object):
             self.cookie_jar.save(ignore_discard=True, ignore_expires=True)
 
         info = self.response.info()
-        encoding = ''
-        if 'Content-Encoding' in info:
-            encoding = info['Content-Encoding']
-        content_fh = self.response
-
-        # with open('/root/tmp/jimk.txt', 'w') as f_dump:
-        #    f_dump.write(content_fh.read() + "\n")
+        if offset and self.response.code == 206:
+            match = re.match(r'bytes\s+(\d+)-',
+                    info.get('Content-Range', ''))
+            if not match or int(match.group(1)) != offset:
+                # The range does not continue the file, start over.
+                self.response.close()
+                target.seek(0)
+                target.truncate()
+                return self.download(target=target, max_bytes=max_bytes,
+                        resume=resume)
+        if offset and self.response.code != 206:
+            # The range was ignored, eg the If-Range validator no longer
+            # matches, the content is sent from the start.
+            target.seek(0)
+            target.truncate()
+            offset = 0
+        if resume_filename:
+            with open(resume_filename, 'wb') as f:
+                f.write(json.dumps({
+                    'url': self.url,
+                    'etag': info.get('ETag'),
+                    'last_modified': info.get('Last-Modified'),
+                    }))
 
-        if encoding == 'gzip':
-            compressedstream = StringIO.StringIO(self.response.read())
-            content_fh = gzip.GzipFile(fileobj=compressedstream)
+        length = None
+        if not info.get('Content-Encoding'):
+            try:
+                length = offset + int(info.get('Content-Length'))
+            except (TypeError, ValueError):
+                pass
+        if max_bytes is not None and length is not None \
+                and length > max_bytes:
+            self.response.close()
+            self.errors.append(
+                'ERROR: Content of {u} exceeds {m} bytes.'.format(
+                    u=self.url, m=max_bytes))
+            self.seconds = time.time() - start
+            return
 
-        self.content = content_fh.read()
-        self.response.close()
+        chunks = []
+        if write is None:
+            write = chunks.append
+        if self._read_response(write, max_bytes, offset):
+            if resume_filename:
+                os.remove(resume_filename)
+            if target is None:
+                self.content = ''.join(chunks)
+            if use_cache and self.response.code == 200:
+                self.cache.put(self.url, info, self.content)
+        self.seconds = time.time() - start
         return
 
+    def opener(self):
+        """Return a urllib2 opener for the download.
+
+        Notes:
+            The opener handles cookies with the cookie_jar and opens http
+            and https urls with connections from the pool. The opener is not
+            installed globally.
+
+        Returns:
+            urllib2.OpenerDirector instance
+        """
+
+        return urllib2.build_opener(
+            urllib2.HTTPCookieProcessor(self.cookie_jar),
+            PooledHTTPHandler(self.pool,
+                read_timeout=self.retry_policy.read_timeout),
+            PooledHTTPSHandler(self.pool,
+                read_timeout=self.retry_policy.read_timeout),
+            )
+
     def request(self, url):
         """Create urllib2.Request for the download.
 
@@ -180,6 +738,57 @@ class DownloadAgent(object):
                            safe=self.urllib_quote_safe))
         return req
 
+    def _read_response(self, write, max_bytes, size=0):
+        """Read the response, decoding its content, a chunk at a time.
+
+        Args:
+            write: callable, called with each chunk of content.
+            max_bytes: integer, maximum size of the content, None is no
+                limit.
+            size: integer, size of the content already downloaded.
+
+        Returns:
+            boolean, True if the content was read completely, False if it
+                exceeds max_bytes.
+        """
+
+        decoder = StreamDecoder(self.response.info().get(
+            'Content-Encoding', ''), chunk_size=self.chunk_size)
+        while True:
+            data = self.response.read(self.chunk_size)
+            for chunk in decoder.decode(data):
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    self.response.close()
+                    self.errors.append(
+                        'ERROR: Content of {u} exceeds {m} bytes.'.format(
+                            u=self.url, m=max_bytes))
+                    return False
+                write(chunk)
+            if not data:
+                break
+        self.response.close()
+        return True
+
+    def _resume_filename(self, target):
+        """Return the name of the file storing the validators of a resumable
+        download.
+
+        Args:
+            target: file object
+
+        Returns:
+            string, <target name>.resume, or None if the target is not a
+                named file, eg a StringIO.
+        """
+        # R0201: *Method could be a function*
+        # pylint: disable=R0201
+
+        name = getattr(target, 'name', None)
+        if not isinstance(name, basestring) or not os.path.isfile(name):
+            return None
+        return '{n}.resume'.format(n=name)
+
 
 class DynamicMozillaCookieJar(cookielib.MozillaCookieJar):
     """This is a subclass of MozillaCookieJar adding methods for creating the
@@ -252,7 +861,7 @@ class ErrorMessage(object):
         if hasattr(self.err, 'code'):
             msg = 'HTTP error code: {code}'.format(code=self.err.code)
             self.messages.append(msg)
-            if self.err.code == 503:
+            if self.err.code in [429, 503]:
                 self.retry = True
             self.identified = True
             return
@@ -277,3 +886,795 @@ class ErrorMessage(object):
         return
 
 
+class HttpCache(object):
+
+    """Class representing an on-disk cache of HTTP responses, revalidated
+    with conditional requests.
+
+    Each entry is stored in a directory as files named by the sha1 of the
+    url: <key>.json, the response metadata, <key>.body, the content, and
+    <key>.<name> for each attachment, eg the scrubbed content of a WebPage.
+    The least recently used entries are removed when the size of the files
+    exceeds max_bytes.
+
+    Entries are keyed by url only, so responses that vary with the request,
+    other than by Accept-Encoding, or that are private to a user are not
+    stored.
+    """
+
+    max_bytes = 100 * 1024 * 1024     # Maximum size of the cache files
+    rescan_seconds = 60     # Seconds before the index is reloaded from disk
+
+    def __init__(self, path, max_bytes=None):
+        """Constructor
+
+        Args:
+            path: string, name of the cache directory. It is created if it
+                does not exist.
+            max_bytes: integer, maximum size of the cache files. Defaults to
+                the class attribute.
+        """
+
+        self.path = path
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.lock = threading.RLock()
+        self.index = None           # {key: [size, last used time]}
+        self.index_loaded = 0       # Time the index was loaded from disk
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def attach(self, url, name, data):
+        """Store data with the entry of a url. The data is removed with the
+        entry.
+
+        Args:
+            url: string, the url of the entry.
+            name: string, name of the attachment, eg 'scrubbed'
+            data: string, data to store.
+        """
+
+        key = self.key(url)
+        with self.lock:
+            index = self._index()
+            if key not in index:
+                return
+            filename = self._filename(key, name)
+            if os.path.exists(filename):
+                index[key][0] -= os.path.getsize(filename)
+            self._write(filename, data)
+            index[key][0] += len(data)
+            self._evict()
+
+    def attachment(self, url, name):
+        """Return data attached to the entry of a url.
+
+        Args:
+            url: string, the url of the entry.
+            name: string, name of the attachment
+
+        Returns:
+            string, the data, or None if there is none.
+        """
+
+        return self._read(self._filename(self.key(url), name))
+
+    def clear(self):
+        """Remove all entries."""
+
+        with self.lock:
+            for key in self._index().keys():
+                self._remove(key)
+
+    def content(self, url):
+        """Return the content of the entry of a url.
+
+        Args:
+            url: string, the url of the entry.
+
+        Returns:
+            string, the content, or None if there is no entry.
+        """
+
+        return self._read(self._filename(self.key(url), 'body'))
+
+    def entry(self, url):
+        """Return the metadata of the entry of a url.
+
+        Args:
+            url: string, the url of the entry.
+
+        Returns:
+            dict, {'url': string, 'etag': string, 'last_modified': string,
+                'expires': float, time the entry is fresh until, 'stored':
+                float, time stored, 'size': integer, size of the content}
+                or None if there is no entry.
+        """
+
+        data = self._read(self._filename(self.key(url), 'json'))
+        if data is None:
+            return None
+        try:
+            entry = json.loads(data)
+        except ValueError:
+            return None
+        if entry.get('url') != url:
+            return None
+        return entry
+
+    def fresh(self, entry):
+        """Return whether an entry can be used without revalidation.
+
+        Args:
+            entry: dict, entry metadata, see entry().
+
+        Returns:
+            boolean, True if fresh.
+        """
+
+        return bool(entry and entry['expires']
+                and entry['expires'] > time.time())
+
+    def hit(self, url, entry, info=None):
+        """Record the use of the entry of a url.
+
+        Args:
+            url: string, the url of the entry.
+            entry: dict, entry metadata, see entry().
+            info: mimetools.Message instance, headers of a 304 Not Modified
+                response revalidating the entry. Its freshness and
+                validators update the entry.
+        """
+
+        key = self.key(url)
+        with self.lock:
+            self.hits += 1
+            self.bytes_saved += entry['size']
+            index = self._index()
+            if key in index:
+                index[key][1] = time.time()
+            if info is not None:
+                (expires, unused_store) = self._freshness(info)
+                entry['expires'] = expires
+                for (name, header) in [('etag', 'ETag'),
+                                       ('last_modified', 'Last-Modified')]:
+                    if header in info:
+                        entry[name] = info[header]
+                self._write(self._filename(key, 'json'), json.dumps(entry))
+            else:
+                try:
+                    os.utime(self._filename(key, 'json'), None)
+                except OSError:
+                    pass
+
+    def key(self, url):
+        """Return the cache key of a url.
+
+        Args:
+            url: string
+
+        Returns:
+            string, hex digest.
+        """
+
+        return hashlib.sha1(url).hexdigest()
+
+    def put(self, url, info, content):
+        """Store a response.
+
+        Notes:
+            Responses with Cache-Control: no-store or private, Set-Cookie,
+            or Vary on a header other than Accept-Encoding, and responses
+            without validators or freshness, are not stored.
+
+        Args:
+            url: string, the url of the response.
+            info: mimetools.Message instance, the response headers.
+            content: string, the response content, decoded.
+
+        Returns:
+            boolean, True if the response was stored.
+        """
+
+        key = self.key(url)
+        (expires, store) = self._freshness(info)
+        entry = {
+            'url': url,
+            'etag': info.get('ETag'),
+            'last_modified': info.get('Last-Modified'),
+            'expires': expires,
+            'stored': time.time(),
+            'size': len(content),
+            }
+        with self.lock:
+            self.misses += 1
+            index = self._index()
+            if key in index:
+                self._remove(key)
+            if not store or not (entry['etag'] or entry['last_modified']
+                                 or expires):
+                return False
+            self._write(self._filename(key, 'body'), content)
+            self._write(self._filename(key, 'json'), json.dumps(entry))
+            index[key] = [len(content), time.time()]
+            self._evict()
+            return key in self._index()
+
+    def request_headers(self, entry):
+        """Return the headers of a conditional request revalidating an
+        entry.
+
+        Args:
+            entry: dict, entry metadata, see entry().
+
+        Returns:
+            dict, {header: value}
+        """
+
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def stats(self):
+        """Return cache statistics.
+
+        Returns:
+            dict, {'hits': integer, 'misses': integer, 'bytes_saved':
+                integer, content bytes served from the cache, 'entries':
+                integer, 'bytes': integer, size of the cache files}
+        """
+
+        with self.lock:
+            index = self._index()
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'bytes_saved': self.bytes_saved,
+                'entries': len(index),
+                'bytes': sum([x[0] for x in index.values()]),
+                }
+
+    def _evict(self):
+        """Remove least recently used entries until the cache files fit
+        max_bytes.
+
+        Notes:
+            Other processes may share the cache directory. Before evicting,
+            and every rescan_seconds, the index is reloaded from disk so the
+            size of their files is counted and their last use, the mtime of
+            the .json file, is compared.
+        """
+
+        index = self._index()
+        total = sum([x[0] for x in index.values()])
+        if total <= self.max_bytes \
+                and time.time() - self.index_loaded < self.rescan_seconds:
+            return
+        self.index = None
+        index = self._index()
+        total = sum([x[0] for x in index.values()])
+        if total <= self.max_bytes:
+            return
+        for key in sorted(index.keys(), key=lambda k: index[k][1]):
+            total -= index[key][0]
+            self._remove(key)
+            if total <= self.max_bytes:
+                break
+
+    def _filename(self, key, extension):
+        """Return the name of a cache file."""
+
+        return os.path.join(self.path, '{k}.{e}'.format(k=key, e=extension))
+
+    def _freshness(self, info):
+        """Return the freshness of a response.
+
+        Args:
+            info: mimetools.Message instance, the response headers.
+
+        Returns:
+            tuple, (float, time the response is fresh until or 0,
+                boolean, False if the response must not be stored)
+        """
+
+        directives = {}
+        for directive in info.get('Cache-Control', '').split(','):
+            (name, unused_sep, value) = directive.strip().partition('=')
+            directives[name.lower()] = value.strip('"')
+        # The content is decoded, so it does not vary by Accept-Encoding.
+        vary = [x.strip().lower() for x in info.get('Vary', '').split(',')
+                if x.strip() and x.strip().lower() != 'accept-encoding']
+        store = 'no-store' not in directives and 'private' not in directives \
+            and 'Set-Cookie' not in info and not vary
+        if 'no-cache' in directives:
+            return (0, store)
+        if 'max-age' in directives:
+            try:
+                return (time.time() + int(directives['max-age']), store)
+            except ValueError:
+                return (0, store)
+        if 'Expires' in info:
+            expires = email.utils.parsedate_tz(info['Expires'])
+            date = email.utils.parsedate_tz(info.get('Date', ''))
+            if expires:
+                now = email.utils.mktime_tz(date) if date else time.time()
+                lifetime = email.utils.mktime_tz(expires) - now
+                if lifetime > 0:
+                    return (time.time() + lifetime, store)
+        return (0, store)
+
+    def _index(self):
+        """Return the index of entries, loading it from the cache directory
+        on first use.
+
+        Returns:
+            dict, {key: [size of files, last used time]}
+        """
+
+        if self.index is None:
+            self.index = {}
+            self.index_loaded = time.time()
+            for meta in glob.glob(os.path.join(self.path, '*.json')):
+                key = os.path.basename(meta)[:-len('.json')]
+                size = sum([os.path.getsize(x) for x in
+                        glob.glob(self._filename(key, '*'))
+                        if not x.endswith('.json')])
+                self.index[key] = [size, os.path.getmtime(meta)]
+        return self.index
+
+    def _read(self, filename):
+        """Return the contents of a cache file or None if it doesn't exist.
+        """
+
+        try:
+            with open(filename, 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def _remove(self, key):
+        """Remove the files of an entry."""
+
+        for filename in glob.glob(self._filename(key, '*')):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        self._index().pop(key, None)
+
+    def _write(self, filename, data):
+        """Write a cache file. The file is replaced atomically."""
+
+        tmp_filename = '{f}.{p}.{t}.tmp'.format(f=filename, p=os.getpid(),
+                t=threading.current_thread().ident)
+        with open(tmp_filename, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_filename, filename)
+
+
+class PooledHTTPHandler(urllib2.HTTPHandler):
+
+    """Class representing a urllib2 handler opening http urls with
+    persistent connections from a ConnectionPool.
+    """
+
+    # Methods a request can be resent with if a reused connection fails
+    # after the request was sent.
+    idempotent_methods = ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT', 'TRACE']
+
+    def __init__(self, pool, read_timeout=None):
+        """Constructor
+
+        Args:
+            pool: ConnectionPool instance
+            read_timeout: float, socket timeout once connected. The timeout
+                of the request applies to connecting. Defaults to the
+                timeout of the request.
+        """
+
+        urllib2.HTTPHandler.__init__(self)
+        self.pool = pool
+        self.read_timeout = read_timeout
+
+    def http_open(self, req):
+        """Open an http url. See urllib2.HTTPHandler."""
+
+        return self.pooled_open(req)
+
+    def pooled_open(self, req):
+        """Open a request with a pooled connection.
+
+        Notes:
+            Unlike urllib2.AbstractHTTPHandler.do_open, the request is sent
+            with Connection: keep-alive. If a reused connection was closed
+            by the host while idle, the request is sent once more on a new
+            connection. If the request was sent but no response was read,
+            it is sent again only if its method is idempotent; the host may
+            have acted on it.
+
+            Requests through a proxy with a tunnel, eg https, use
+            connections to the proxy tunneled to the host with CONNECT, as
+            urllib2 does. The tunnel host is part of the pool key.
+
+        Args:
+            req: urllib2.Request instance
+
+        Returns:
+            urllib.addinfourl instance, whose fp is a PooledResponse.
+        """
+
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        tunnel_host = getattr(req, '_tunnel_host', None)
+        key = (req.get_type(), host)
+        if tunnel_host:
+            key = key + (tunnel_host, )
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for (k, v) in req.headers.items()
+                            if k not in headers))
+        headers = dict((name.title(), val) for (name, val) in
+                       headers.items())
+        headers['Connection'] = 'keep-alive'
+        tunnel_headers = {}
+        if tunnel_host and 'Proxy-Authorization' in headers:
+            # The proxy credentials are sent with CONNECT, not to the host.
+            tunnel_headers['Proxy-Authorization'] = \
+                headers.pop('Proxy-Authorization')
+
+        method = req.get_method()
+        while True:
+            (connection, reused) = self.pool.get(key, timeout=req.timeout)
+            sent = False
+            try:
+                if connection.sock is None:
+                    if tunnel_host:
+                        connection.set_tunnel(tunnel_host,
+                                headers=tunnel_headers)
+                    connection.connect()
+                if self.read_timeout is not None:
+                    connection.sock.settimeout(self.read_timeout)
+                connection.request(method, req.get_selector(), req.data,
+                                   headers)
+                sent = True
+                response = connection.getresponse()
+                break
+            except (socket.error, httplib.HTTPException), err:
+                self.pool.discard(key, connection)
+                if not reused or isinstance(err, socket.timeout) \
+                        or (sent and method not in self.idempotent_methods):
+                    raise urllib2.URLError(err)
+
+        resp = urllib.addinfourl(
+            PooledResponse(response, connection, self.pool, key),
+            response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+
+class PooledHTTPSHandler(PooledHTTPHandler, urllib2.HTTPSHandler):
+
+    """Class representing a urllib2 handler opening https urls with
+    persistent connections from a ConnectionPool.
+    """
+
+    def https_open(self, req):
+        """Open an https url. See urllib2.HTTPSHandler."""
+
+        return self.pooled_open(req)
+
+
+class PooledResponse(object):
+
+    """Class representing the body of a response on a pooled connection.
+
+    The connection is returned to the pool when the body has been read
+    completely, and closed if the response is closed before then.
+    """
+
+    def __init__(self, response, connection, pool, key):
+        """Constructor
+
+        Args:
+            response: httplib.HTTPResponse instance
+            connection: httplib.HTTPConnection instance, the connection of
+                the response.
+            pool: ConnectionPool instance, the pool of the connection.
+            key: tuple, the pool key of the connection, see
+                ConnectionPool.get().
+        """
+
+        self.response = response
+        self.connection = connection
+        self.pool = pool
+        self.key = key
+        self.buffer = ''
+
+    def __del__(self):
+        self.close()
+
+    def _done(self):
+        """Release the connection if the body has been read."""
+
+        if self.connection is not None and self.response.isclosed():
+            connection = self.connection
+            self.connection = None
+            if self.response.will_close:
+                self.pool.discard(self.key, connection)
+            else:
+                self.pool.release(self.key, connection)
+
+    def close(self):
+        """Close the response."""
+
+        self._done()
+        if self.connection is not None:
+            # The body was not read, the connection can't be reused.
+            connection = self.connection
+            self.connection = None
+            self.response.close()
+            self.pool.discard(self.key, connection)
+
+    def read(self, amt=None):
+        """Read the body. See httplib.HTTPResponse.read()."""
+
+        if self.buffer:
+            if amt is None:
+                data = self.buffer + self.response.read()
+                self.buffer = ''
+            else:
+                data = self.buffer[:amt]
+                self.buffer = self.buffer[amt:]
+        else:
+            data = self.response.read(amt)
+        self._done()
+        return data
+
+    def readline(self, limit=-1):
+        """Read a line of the body."""
+
+        while '\n' not in self.buffer:
+            if limit >= 0 and len(self.buffer) >= limit:
+                break
+            data = self.response.read(8192)
+            self._done()
+            if not data:
+                break
+            self.buffer += data
+        end = self.buffer.find('\n') + 1 or len(self.buffer)
+        if limit >= 0:
+            end = min(end, limit)
+        (line, self.buffer) = (self.buffer[:end], self.buffer[end:])
+        return line
+
+    def readlines(self, sizehint=0):
+        """Read the lines of the body."""
+        # W0613: *Unused argument %r*
+        # pylint: disable=W0613
+
+        lines = []
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+        return lines
+
+
+class RetryPolicy(object):
+
+    """Class representing the retry policy of downloads: timeouts, backoff
+    between retries and a circuit breaker per host.
+
+    A host failing breaker_failures times in a row is not contacted for
+    breaker_seconds. After that a download is tried again and, if it fails,
+    the circuit opens again at once.
+    """
+
+    backoff_base = 1.0          # Seconds before the first retry
+    backoff_factor = 2.0        # Backoff multiplier per retry
+    backoff_max = 60.0          # Maximum backoff seconds
+    breaker_failures = 5        # Consecutive failures opening the circuit
+    breaker_seconds = 60.0      # Seconds the circuit stays open
+    connect_timeout = 10.0      # Seconds to wait for a connection
+    jitter = 0.5                # Backoff is reduced randomly by up to this
+    read_timeout = 10.0         # Seconds to wait for data from the host
+    retry_after_max = 300.0     # Longer Retry-After values are not retried
+
+    def __init__(self, **kwargs):
+        """Constructor
+
+        Args:
+            kwargs: dict, values overriding the class attributes,
+                eg connect_timeout=5
+        """
+
+        for (name, value) in kwargs.items():
+            if not hasattr(self.__class__, name):
+                raise TypeError('Invalid RetryPolicy setting: {n}'.format(
+                    n=name))
+            setattr(self, name, value)
+        self.hosts = {}             # {host: [failures, circuit open until]}
+        self.lock = threading.Lock()
+
+    def allow(self, host):
+        """Return whether downloads from a host are allowed.
+
+        Args:
+            host: string, eg 'www.example.com:8080'
+
+        Returns:
+            boolean, False if the circuit of the host is open.
+        """
+
+        with self.lock:
+            state = self.hosts.get(host)
+            return not state or state[1] <= time.time()
+
+    def delay(self, attempt, err=None):
+        """Return the seconds to wait before retrying.
+
+        Args:
+            attempt: integer, number of the retry, 1 for the first.
+            err: IOError instance, the error of the download. If it is an
+                HTTP error with a Retry-After header, the header is honored.
+
+        Returns:
+            float, seconds, or None if the download should not be retried.
+        """
+
+        backoff = min(self.backoff_max,
+                      self.backoff_base * self.backoff_factor ** (attempt - 1))
+        backoff -= backoff * self.jitter * random.random()
+        retry_after = self.retry_after(err)
+        if retry_after is None:
+            return backoff
+        if retry_after > self.retry_after_max:
+            return None
+        return max(retry_after, backoff)
+
+    def failure(self, host):
+        """Record a failed download from a host.
+
+        Args:
+            host: string
+        """
+
+        with self.lock:
+            state = self.hosts.setdefault(host, [0, 0])
+            state[0] += 1
+            if state[0] >= self.breaker_failures:
+                state[1] = time.time() + self.breaker_seconds
+
+    def host_failure(self, err):
+        """Return whether an error indicates the host is failing.
+
+        Args:
+            err: IOError instance
+
+        Returns:
+            boolean, True for connection errors, timeouts and HTTP server
+                errors.
+        """
+
+        code = getattr(err, 'code', None)
+        return code is None or code >= 500
+
+    def retry_after(self, err):
+        """Return the seconds of the Retry-After header of an HTTP error.
+
+        Args:
+            err: IOError instance
+
+        Returns:
+            float, seconds, or None if there is no Retry-After header.
+        """
+
+        headers = getattr(err, 'hdrs', None)
+        if headers is None or 'Retry-After' not in headers:
+            return None
+        value = headers['Retry-After'].strip()
+        if value.isdigit():
+            return float(value)
+        date = email.utils.parsedate_tz(value)
+        if not date:
+            return None
+        return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+    def sleep(self, seconds):
+        """Wait before retrying.
+
+        Args:
+            seconds: float
+        """
+
+        time.sleep(seconds)
+
+    def success(self, host):
+        """Record a successful download from a host, closing its circuit.
+
+        Args:
+            host: string
+        """
+
+        with self.lock:
+            self.hosts.pop(host, None)
+
+
+RETRY_POLICY = RetryPolicy()            # Default policy of DownloadAgent
+
+
+class StreamDecoder(object):
+
+    """Class representing an incremental decoder of gzip or deflate encoded
+    content.
+
+    Content with any other encoding is passed through unchanged.
+    """
+
+    def __init__(self, encoding, chunk_size=65536):
+        """Constructor
+
+        Args:
+            encoding: string, value of the Content-Encoding header.
+            chunk_size: integer, maximum size of decoded chunks.
+        """
+
+        self.encoding = encoding.strip().lower()
+        self.chunk_size = chunk_size
+        self.decompressor = None
+        self.started = False    # True once content has been decoded
+        if self.encoding in ['gzip', 'x-gzip']:
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'deflate':
+            self.decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+
+    def decode(self, data):
+        """Decode data.
+
+        Notes:
+            Deflate content is meant to be zlib wrapped but some servers send
+            raw deflate data. Both are decoded.
+
+        Args:
+            data: string, the next piece of encoded content. An empty string
+                signals the end of the content.
+
+        Yields:
+            string, chunks of decoded content, each at most chunk_size bytes
+                unless flushed at the end.
+        """
+
+        if self.decompressor is None:
+            if data:
+                yield data
+            return
+
+        if not data:
+            chunk = self.decompressor.flush()
+            if chunk:
+                yield chunk
+            return
+
+        while data:
+            try:
+                chunk = self.decompressor.decompress(data, self.chunk_size)
+            except zlib.error:
+                if self.encoding != 'deflate' or self.started:
+                    raise
+                # Raw deflate data, no zlib header.
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                self.started = True
+                continue
+            self.started = True
+            data = self.decompressor.unconsumed_tail
+            if chunk:
+                yield chunk
@@ -68,7 +68,25 @@ class TableCRUD(Report):
         return A('edit', _href=URL(r=self.request, f=self.update_function,
             args=[row['id']], vars=self.request.vars))
 
-    def rows(self, page, items_per_page, order_by, order_dir):
+    def export_columns(self):
+        """Return the columns of an export, all the fields of the table.
+
+        See Report.export_columns().
+        """
+        return [(x.title(), x) for x in self.sqldb_table.fields]
+
+    def order_field(self, order_by):
+        """Return the field for an order_by value.
+
+        Args:
+            order_by: string, name of field to sort by
+
+        Returns:
+            gluon.dal.Field instance
+        """
+        return self.sqldb_table[order_by]
+
+    def rows(self, page, items_per_page, order_by, order_dir, query=None):
         """Retrieve rows for a page.
 
         Args:
@@ -76,20 +94,28 @@ class TableCRUD(Report):
             items_per_page: integer
             order_by: string, name of field to sort by
             order_dir: string, order direction
+            query: gluon.dal.Query, defaults to sql_query(). See
+                Report.rows().
 
         Returns:
             Storage: row data.
 
         """
 
+        # The id is a tiebreaker so pages, and export chunks, of records with
+        # equal order_by values do not overlap.
         order_l = [self.sqldb_table[order_by]]
+        if order_by != 'id':
+            order_l.append(self.sqldb_table.id)
         if bool(int(order_dir)):
             order_l = [~x for x in order_l]
 
         offset = page * items_per_page
         limit = (page + 1) * items_per_page
         limitby = (offset, limit)
-        rows = self.sqldb(self.sql_query()).select(self.sqldb_table.ALL,
+        if query is None:
+            query = self.sql_query()
+        rows = self.sqldb(query).select(self.sqldb_table.ALL,
                                    orderby=order_l, limitby=limitby)
         return rows
 
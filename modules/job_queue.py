@@ -8,12 +8,22 @@ Classes related to job queues.
 
 """
 from functools import wraps
+import datetime
+import math
 import os
+import runpy
+import select
 import shlex
+import signal
+import socket
 import subprocess
+import sys
+import tempfile
 import time
+import traceback
 
 from applications.shared.modules.database import DbObject
+from gluon.dal import ConnectionPool, DAL
 
 
 class QueueEmptyError(Exception):
@@ -33,12 +43,363 @@ class QueueLockedExtendedError(Exception):
     pass
 
 
+class Executor(object):
+    """Class representing a pool of processes running queued jobs.
+
+    Jobs are claimed from the queue and run concurrently, at most
+    max_workers at a time. The exit status, stdout and stderr of each job
+    are stored in the job record when it finishes. If the claim of a job is
+    lost, eg its lease expired and another worker claimed it, the job is not
+    started, or is killed if running.
+    """
+    max_workers = 4             # Maximum number of jobs run at a time
+    output_limit = 65536        # Maximum bytes of stdout/stderr stored
+    poll_seconds = 0.1          # Seconds between checks on running jobs
+    start_failed_status = 127   # Exit status of jobs that fail to start
+    timeout = None              # Seconds a job runs before it is killed
+
+    def __init__(self, queue, max_workers=None, priority_limits=None,
+            timeout=None, worker=None, fork=False, fork_env=None):
+        """Constructor.
+
+        Args:
+            queue: Queue object instance, the queue jobs are claimed from.
+            max_workers: integer, maximum number of jobs run at a time.
+                Defaults to Executor.max_workers.
+            priority_limits: dict, {priority: integer}, maximum number of
+                jobs of a priority run at a time. Priorities not in the dict
+                are limited by max_workers only.
+            timeout: integer, seconds a job may run before it is killed.
+                Defaults to Executor.timeout, no limit.
+            worker: string, id used to claim jobs. Defaults to worker_id().
+            fork: If True, jobs are run in forked children of this process,
+                see ForkedProcess. Otherwise, jobs are run as
+                $ python <command>
+            fork_env: dict, the globals the job script is run with when fork
+                is True, eg the web2py environment with the models imported.
+                It is built once, in this process, and used by every job,
+                see ForkedProcess.
+        """
+        self.queue = queue
+        if max_workers:
+            self.max_workers = max_workers
+        self.priority_limits = priority_limits or {}
+        if timeout:
+            self.timeout = timeout
+        self.worker = worker or worker_id()
+        self.fork = fork
+        self.fork_env = fork_env
+        self.running = {}           # {job id: running job dict}
+
+    def _discard(self, running):
+        """Remove a job whose claim was lost from the running jobs. The job
+        record is not updated.
+
+        Args:
+            running: dict, running job dict, see _start().
+        """
+        running['stdout'].close()
+        running['stderr'].close()
+        self.running.pop(running['job'].id, None)
+
+    def _finish(self, running, exit_status):
+        """Store the results of a finished job and remove it from the
+        running jobs.
+
+        Args:
+            running: dict, running job dict, see _start().
+            exit_status: integer, exit status of the job process.
+        """
+        output = {}
+        for name in ['stdout', 'stderr']:
+            running[name].seek(0)
+            output[name] = running[name].read(self.output_limit)
+            running[name].close()
+        self.queue.finish(running['job'], exit_status=exit_status,
+                stdout=output['stdout'], stderr=output['stderr'])
+        self.running.pop(running['job'].id, None)
+
+    def _reap(self):
+        """Finish running jobs that have exited and kill those that have
+        timed out. The leases of jobs still running are renewed, jobs whose
+        lease can't be renewed are killed and discarded.
+
+        Returns:
+            integer, number of jobs finished.
+        """
+        finished = 0
+        now = time.time()
+        for running in self.running.values():
+            process = running['process']
+            if process.poll() is None:
+                if self.timeout and now - running['started'] > self.timeout:
+                    process.kill()
+                    process.wait()
+                    running['stderr'].seek(0, os.SEEK_END)
+                    running['stderr'].write(
+                        '\nKilled, timeout {t} seconds exceeded.\n'.format(
+                            t=self.timeout))
+                else:
+                    if now - running['renewed'] > \
+                            self.queue.lease_seconds / 2:
+                        if not self.queue.renew(running['job']):
+                            # The claim was lost, another worker may run the
+                            # job.
+                            process.kill()
+                            process.wait()
+                            self._discard(running)
+                            continue
+                        running['renewed'] = now
+                    continue
+            self._finish(running, process.returncode)
+            finished += 1
+        return finished
+
+    def _saturated_priorities(self):
+        """Return the priorities that have reached their limit of running
+        jobs.
+
+        Returns:
+            list, list of priorities.
+        """
+        counts = {}
+        for running in self.running.values():
+            priority = running['job'].priority
+            counts[priority] = counts.get(priority, 0) + 1
+        return [k for k, v in self.priority_limits.items()
+                if counts.get(k, 0) >= v]
+
+    def _start(self, job):
+        """Start running a claimed job.
+
+        Args:
+            job: Job object instance, a job returned by claim().
+        """
+        if not self.queue.mark_started(job):
+            # The claim was lost, another worker may run the job.
+            return
+        stdout = tempfile.TemporaryFile()
+        stderr = tempfile.TemporaryFile()
+        now = time.time()
+        running = dict(job=job, stdout=stdout, stderr=stderr, started=now,
+                renewed=now)
+        if not job.command:
+            stderr.write('Job has no command.\n')
+            self._finish(running, self.start_failed_status)
+            return
+        try:
+            if self.fork:
+                process = ForkedProcess(job, stdout, stderr,
+                        env=self.fork_env)
+            else:
+                with open(os.devnull) as devnull:
+                    process = subprocess.Popen(job.command_args(),
+                            stdin=devnull, stdout=stdout, stderr=stderr,
+                            close_fds=True)
+        except (OSError, ValueError), err:
+            stderr.write('Job failed to start: {e}\n'.format(e=err))
+            self._finish(running, self.start_failed_status)
+            return
+        running['process'] = process
+        self.running[job.id] = running
+
+    def claim(self):
+        """Claim the highest priority job whose priority is not at its limit
+        of running jobs.
+
+        Returns:
+            Job object instance, the claimed job.
+
+        Raises:
+            QueueEmptyError, if there are no jobs to claim.
+        """
+        query = None
+        saturated = self._saturated_priorities()
+        if saturated:
+            tbl_ = self.queue.tbl_
+            priorities = [x for x in saturated if x is not None]
+            if priorities:
+                query = ~tbl_.priority.belongs(priorities)
+            if None in saturated:
+                query = query & (tbl_.priority != None) if query else \
+                    tbl_.priority != None
+            else:
+                query = query | (tbl_.priority == None)
+        return self.queue.claim(worker=self.worker, query=query)
+
+    def run(self):
+        """Run jobs until the queue is empty and all jobs have finished.
+
+        Notes:
+            While jobs are running, the queue is checked for more jobs only
+            after a job finishes.
+
+        Returns:
+            integer, number of jobs run.
+        """
+        count = 0
+        check_queue = True
+        while True:
+            finished = self._reap()
+            count += finished
+            if finished:
+                check_queue = True
+            while check_queue and len(self.running) < self.max_workers:
+                try:
+                    self._start(self.claim())
+                except QueueEmptyError:
+                    check_queue = False
+            if not self.running:
+                return count
+            time.sleep(self.poll_seconds)
+
+
+class ForkedProcess(object):
+    """Class representing a job run in a forked child of the current process.
+
+    The child inherits the modules already imported by this process, and the
+    environment, eg the web2py models, already built, so the job does not
+    pay the cost of interpreter startup, imports and models. The job script
+    is run with runpy as if by
+        $ python <command>
+
+    The interface mimics the subprocess.Popen methods used by Executor.
+    """
+
+    def __init__(self, job, stdout, stderr, env=None):
+        """Constructor.
+
+        Args:
+            job: Job object instance, the job to run.
+            stdout: file object, the job's stdout is written to this file.
+            stderr: file object, the job's stderr is written to this file.
+            env: dict, the globals the job script is run with, eg the web2py
+                environment. The databases, DAL instances, of the dict are
+                given new connections in the child so the child does not
+                share the database connections of this process.
+        """
+        self.returncode = None
+        args = job.command_args()[1:]
+        self.pid = os.fork()
+        if self.pid == 0:
+            self._child(args, stdout, stderr, env)
+
+    def _child(self, args, stdout, stderr, env):
+        """Run the job script in the child. Never returns."""
+        # W0702: *No exception type(s) specified*
+        # pylint: disable=W0702
+        code = 1
+        try:
+            os.dup2(stdout.fileno(), 1)
+            os.dup2(stderr.fileno(), 2)
+            sys.argv = args
+            init_globals = None
+            if env is not None:
+                self._reconnect(env)
+                init_globals = dict(env)
+            runpy.run_path(args[0], init_globals=init_globals,
+                    run_name='__main__')
+            code = 0
+        except SystemExit, err:
+            if err.code is None or isinstance(err.code, int):
+                code = err.code or 0
+            else:
+                print >> sys.stderr, err.code
+        except:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def _reconnect(self, env):
+        """Give the databases of the environment new connections in the child.
+
+        Notes:
+            The connections inherited from this process are kept, open and
+            unused. Closing them, or releasing the last reference to them,
+            would close the connections of this process.
+
+        Args:
+            env: dict, the globals the job script is run with.
+        """
+        inherited = []
+        for pool in ConnectionPool.POOLS.values():
+            inherited.extend(pool)
+            del pool[:]
+        for value in env.values():
+            if isinstance(value, DAL):
+                adapter = value._adapter
+                inherited.append((adapter.connection, adapter.cursor))
+                adapter.connection = None
+                adapter.reconnect()
+        self.inherited_connections = inherited
+
+    def _set_returncode(self, status):
+        """Set the returncode from a os.waitpid status."""
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+
+    def kill(self):
+        """Kill the child."""
+        os.kill(self.pid, signal.SIGKILL)
+
+    def poll(self):
+        """Check if the child has exited.
+
+        Returns:
+            integer, the exit status, None if the child is running.
+        """
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid:
+                self._set_returncode(status)
+        return self.returncode
+
+    def wait(self):
+        """Wait for the child to exit.
+
+        Returns:
+            integer, the exit status.
+        """
+        if self.returncode is None:
+            unused_pid, status = os.waitpid(self.pid, 0)
+            self._set_returncode(status)
+        return self.returncode
+
+
 class Job(DbObject):
     """Class representing a job record."""
     def __init__(self, tbl_, **kwargs):
         """Constructor."""
         DbObject.__init__(self, tbl_, **kwargs)
 
+    def _add_args(self):
+        """Return the field/value pairs used to insert the job.
+
+        Notes:
+            The queued_on timestamp, if defined and not set, is set to now.
+
+        See DbObject._add_args().
+        """
+        if 'queued_on' in self.tbl_.fields and not self.queued_on:
+            self.queued_on = datetime.datetime.now()
+        return DbObject._add_args(self)
+
+    def command_args(self):
+        """Return the job command as a list of arguments.
+
+        Returns:
+            list, ['python', <command args>]
+        """
+        # E1101: *%s %r has no %r member*
+        # pylint: disable=E1101
+        args = ['python']
+        args.extend(shlex.split(self.command))
+        return args
+
     def run(self):
         """Run the job command.
 
@@ -51,14 +412,18 @@ class Job(DbObject):
 
         if not self.command:
             return
-        args = ['python']
-        args.extend(shlex.split(self.command))
-        return subprocess.call(args)
+        return subprocess.call(self.command_args())
 
 
 class Queue(object):
-    """Class representing a job queue."""
+    """Class representing a job queue.
+
+    Jobs are dequeued by claiming them, see claim(). Any number of handlers,
+    on one or many hosts, can claim jobs from the same queue in parallel.
+    """
     lock_filename = '/var/run/job_queue.pid'
+    lease_seconds = 3600        # Seconds a claim is valid, see claim()
+    claim_batch = 10            # Number of candidate jobs read per claim
 
     def __init__(self, tbl_):
         """Constructor.
@@ -67,8 +432,109 @@ class Queue(object):
             tbl_: gluon.dal.Table of table jobs are stored in.
         """
         self.tbl_ = tbl_
+        self.db_ = tbl_['_db']
+
+    def _update_claimed(self, job, **fields):
+        """Update a job only if it is still claimed by the job's worker.
 
-    def jobs(self, maximum_start=None, orderby=None, limitby=None):
+        Notes:
+            MySQL reports the number of rows changed, not matched, so an
+            update setting the values a row already has, eg a renew() within
+            the second of the previous one, reports 0. In that case the claim
+            is confirmed by selecting the row.
+
+        Args:
+            job: Job object instance, a job returned by claim().
+            fields: field/value pairs to update.
+
+        Returns:
+            True if the job was updated.
+        """
+        query = (self.tbl_.id == job.id) & (self.tbl_.status == 'r') & \
+            (self.tbl_.worker == job.worker)
+        updated = self.db_(query).update(**fields)
+        if not updated:
+            updated = self.db_(query).count()
+        self.db_.commit()
+        if not updated:
+            return False
+        for field, value in fields.items():
+            setattr(job, field, value)
+        return True
+
+    def claim(self, worker=None, lease_seconds=None, query=None):
+        """Claim the highest priority job in the queue.
+
+        Notes:
+            A job is claimed with a conditional UPDATE that changes the status
+            from 'a' (queued) to 'r' (in progress) only if it is still 'a'.
+            If another worker claims the job first, the next candidate is
+            tried. Claims with an expired lease are requeued first, see
+            reclaim().
+
+        Args:
+            worker: string, id of the worker claiming the job. Defaults to
+                worker_id().
+            lease_seconds: integer, seconds the claim is valid. Defaults to
+                Queue.lease_seconds. Use renew() to extend a claim.
+            query: gluon.dal.Query, if provided, only jobs matching the query
+                are claimed.
+
+        Returns:
+            Job object instance, the claimed job.
+
+        Raises:
+            QueueEmptyError, if there are no jobs to claim.
+        """
+        if not worker:
+            worker = worker_id()
+        if not lease_seconds:
+            lease_seconds = self.lease_seconds
+        self.reclaim()
+        start = time.strftime('%F %T', time.localtime())    # now
+        orderby = ~self.tbl_.priority | self.tbl_.id
+        while True:
+            candidates = self.jobs(maximum_start=start, orderby=orderby,
+                    limitby=self.claim_batch, query=query)
+            if len(candidates) == 0:
+                msg = 'There are no jobs in the queue.'
+                raise QueueEmptyError(msg)
+            for job in candidates:
+                lease_expires = datetime.datetime.now() + \
+                    datetime.timedelta(seconds=lease_seconds)
+                claim_query = (self.tbl_.id == job.id) & \
+                    (self.tbl_.status == 'a')
+                claimed_on = datetime.datetime.now()
+                claimed = self.db_(claim_query).update(status='r',
+                        worker=worker, lease_expires=lease_expires,
+                        claimed_on=claimed_on)
+                self.db_.commit()
+                if claimed:
+                    job.status = 'r'
+                    job.worker = worker
+                    job.lease_expires = lease_expires
+                    job.claimed_on = claimed_on
+                    return job
+            # Every candidate was claimed by another worker, try again.
+
+    def finish(self, job, status='d', **fields):
+        """Record a claimed job as finished.
+
+        Args:
+            job: Job object instance, a job returned by claim().
+            status: string, the new job status.
+            fields: other field/value pairs to update, eg exit_status.
+
+        Returns:
+            True if the job was updated, False if the claim was lost, eg the
+            lease expired and the job was claimed by another worker.
+        """
+        return self._update_claimed(job, status=status, worker=None,
+                lease_expires=None, finished_on=datetime.datetime.now(),
+                **fields)
+
+    def jobs(self, maximum_start=None, orderby=None, limitby=None,
+            query=None):
         """Return the jobs in the queue.
 
         Args:
@@ -82,13 +548,17 @@ class Queue(object):
             limitby: integer or tuple. Tuple is format (start, stop). If
                     integer converted to tuple (0, integer)
                     See database.py Collection.get() for more details.
+            query: gluon.dal.Query, if provided, the jobs returned are
+                    restricted to those matching the query.
         Returns:
             list, list of Job object instances.
         """
-        query = self.tbl_.status == 'a'
+        jobs_query = self.tbl_.status == 'a'
         if maximum_start:
-            query = query & (self.tbl_.start <= maximum_start)
-        return Job(self.tbl_).set_.get(query=query, orderby=orderby,
+            jobs_query = jobs_query & (self.tbl_.start <= maximum_start)
+        if query:
+            jobs_query = jobs_query & query
+        return Job(self.tbl_).set_.get(query=jobs_query, orderby=orderby,
                 limitby=limitby)
 
     def lock(self, filename=None, extended_seconds=0):
@@ -133,6 +603,129 @@ class Queue(object):
             f.write(str(os.getpid()))
         return filename
 
+    def mark_started(self, job):
+        """Record that a claimed job has started running.
+
+        Args:
+            job: Job object instance, a job returned by claim().
+
+        Returns:
+            True if the job was updated, False if the claim was lost.
+        """
+        return self._update_claimed(job, started_on=datetime.datetime.now())
+
+    def reclaim(self):
+        """Requeue in progress jobs whose claim has expired.
+
+        Returns:
+            integer, number of jobs requeued.
+        """
+        now = datetime.datetime.now()
+        query = (self.tbl_.status == 'r') & (self.tbl_.lease_expires != None) \
+            & (self.tbl_.lease_expires < now)
+        count = self.db_(query).update(status='a', worker=None,
+                lease_expires=None)
+        self.db_.commit()
+        return count or 0
+
+    def release(self, job):
+        """Requeue a claimed job without running it.
+
+        Args:
+            job: Job object instance, a job returned by claim().
+
+        Returns:
+            True if the job was requeued, False if the claim was lost.
+        """
+        return self._update_claimed(job, status='a', worker=None,
+                lease_expires=None)
+
+    def renew(self, job, lease_seconds=None):
+        """Extend the claim of a job.
+
+        Args:
+            job: Job object instance, a job returned by claim().
+            lease_seconds: integer, seconds from now the claim is valid.
+                Defaults to Queue.lease_seconds.
+
+        Returns:
+            True if the claim was extended, False if the claim was lost.
+        """
+        if not lease_seconds:
+            lease_seconds = self.lease_seconds
+        lease_expires = datetime.datetime.now() + \
+            datetime.timedelta(seconds=lease_seconds)
+        return self._update_claimed(job, lease_expires=lease_expires)
+
+    def stats(self, seconds=3600):
+        """Return queue throughput and latency statistics.
+
+        Notes:
+            Wait time is the time from when a job could first run, the later
+            of start and queued_on, to when it was claimed. Run time is the
+            time from started_on to finished_on. Times are in seconds and are
+            as precise as the database datetime columns.
+
+        Args:
+            seconds: integer, the wait, run and throughput statistics cover
+                jobs finished in this many seconds before now.
+
+        Returns:
+            dict, {
+                'depth': {priority: number of jobs ready to run, ...},
+                'scheduled': number of jobs scheduled to start in the future,
+                'running': number of jobs in progress,
+                'finished': number of jobs finished,
+                'failed': number of finished jobs with non-zero exit status,
+                'failure_rate': failed / finished,
+                'throughput_per_minute': finished / minutes,
+                'wait_p50', 'wait_p95': wait time percentiles,
+                'run_p50', 'run_p95': run time percentiles,
+            }
+            The dict can be converted with json.dumps().
+        """
+        now = datetime.datetime.now()
+        tbl_ = self.tbl_
+        stats = {'depth': {}}
+
+        count = tbl_.id.count()
+        query = (tbl_.status == 'a') & (tbl_.start <= now)
+        for row in self.db_(query).select(tbl_.priority, count,
+                groupby=tbl_.priority):
+            stats['depth'][row[tbl_.priority]] = row[count]
+        stats['scheduled'] = self.db_((tbl_.status == 'a') & \
+                (tbl_.start > now)).count()
+        stats['running'] = self.db_(tbl_.status == 'r').count()
+
+        since = now - datetime.timedelta(seconds=seconds)
+        query = (tbl_.finished_on != None) & (tbl_.finished_on >= since)
+        rows = self.db_(query).select(tbl_.start, tbl_.queued_on,
+                tbl_.claimed_on, tbl_.started_on, tbl_.finished_on,
+                tbl_.exit_status)
+        waits = []
+        runs = []
+        failed = 0
+        for row in rows:
+            ready = [x for x in [row.start, row.queued_on] if x]
+            if ready and row.claimed_on:
+                wait = (row.claimed_on - max(ready)).total_seconds()
+                waits.append(max(wait, 0))
+            if row.started_on:
+                runs.append(
+                    (row.finished_on - row.started_on).total_seconds())
+            if row.exit_status:
+                failed += 1
+        finished = len(rows)
+        stats['finished'] = finished
+        stats['failed'] = failed
+        stats['failure_rate'] = float(failed) / finished if finished else 0.0
+        stats['throughput_per_minute'] = finished * 60.0 / seconds
+        for name, values in [('wait', waits), ('run', runs)]:
+            values.sort()
+            stats[name + '_p50'] = percentile(values, 50)
+            stats[name + '_p95'] = percentile(values, 95)
+        return stats
+
     def top_job(self):
         """Return the highest priority job in the queue.
 
@@ -165,15 +758,194 @@ class Queue(object):
         return
 
 
-def trigger_queue_handler(request):
-    """Decorator for triggering activation of queue handler"""
+class QueueDaemon(object):
+    """Class representing a long running queue handler woken by triggers.
+
+    Triggers are datagrams sent to a unix domain socket, see wake().
+    Triggers received within coalesce_seconds of each other result in a
+    single call of the handler. The handler is also called every
+    poll_seconds so jobs scheduled to start in the future are run.
+    """
+    coalesce_seconds = 1        # Seconds triggers are collected for
+    poll_seconds = 60           # Maximum seconds between handler calls
+    socket_mode = 0666          # Permissions of the socket file
+
+    def __init__(self, handler, socket_path):
+        """Constructor.
+
+        Args:
+            handler: callable, called to handle the queue, eg
+                Executor(queue).run
+            socket_path: string, name of the socket file to listen on.
+        """
+        self.handler = handler
+        self.socket_path = socket_path
+        self.sock = None
+
+    def _drain(self):
+        """Read all pending triggers from the socket.
+
+        Returns:
+            integer, number of triggers read.
+        """
+        count = 0
+        while True:
+            try:
+                self.sock.recv(64)
+            except socket.error:
+                return count
+            count += 1
+
+    def close(self):
+        """Stop listening and remove the socket file."""
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def listen(self):
+        """Listen for triggers on the socket.
+
+        Notes:
+            An existing socket file is replaced.
+        """
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(0)
+        self.sock.bind(self.socket_path)
+        os.chmod(self.socket_path, self.socket_mode)
+
+    def run(self, max_runs=None):
+        """Call the handler each time the daemon is triggered.
+
+        Exceptions raised by the handler are printed to stderr and the
+        daemon continues.
+
+        Args:
+            max_runs: integer, return after calling the handler this many
+                times. If None, run forever.
+        """
+        # W0702: *No exception type(s) specified*
+        # pylint: disable=W0702
+        if not self.sock:
+            self.listen()
+        runs = 0
+        while max_runs is None or runs < max_runs:
+            self.wait(self.poll_seconds)
+            try:
+                self.handler()
+            except:
+                traceback.print_exc()
+            runs += 1
+
+    def wait(self, timeout):
+        """Wait for triggers.
+
+        Notes:
+            After the first trigger is received, triggers are collected for
+            coalesce_seconds.
+
+        Args:
+            timeout: float, maximum seconds to wait for the first trigger.
+
+        Returns:
+            integer, number of triggers received, 0 if timed out.
+        """
+        readable = select.select([self.sock], [], [], timeout)[0]
+        if not readable:
+            return 0
+        count = self._drain()
+        deadline = time.time() + self.coalesce_seconds
+        remaining = self.coalesce_seconds
+        while remaining > 0:
+            if select.select([self.sock], [], [], remaining)[0]:
+                count += self._drain()
+            remaining = deadline - time.time()
+        return count
+
+
+def percentile(values, percent):
+    """Return the percentile of a sorted list of values.
+
+    Notes:
+        The nearest-rank method is used.
+
+    Args:
+        values: list, sorted list of numbers.
+        percent: number, percentile 0 to 100.
+
+    Returns:
+        number, the percentile value. None if values is empty.
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def queue_socket_path(request):
+    """Return the default name of the socket a QueueDaemon listens on.
+
+    Args:
+        request: gluon.globals.Request object instance.
+
+    Returns:
+        string, name of socket file including path.
+    """
+    return os.path.join('.', request.folder, 'private', 'job_queue.sock')
+
+
+def trigger_queue_handler(request, socket_path=None):
+    """Decorator for triggering activation of queue handler
+
+    The queue daemon is woken with a datagram, see wake(). No process is
+    spawned and the decorated function does not wait on the daemon.
+
+    Args:
+        request: gluon.globals.Request object instance.
+        socket_path: string, name of the socket the QueueDaemon listens on.
+            Defaults to queue_socket_path(request).
+    """
+    if not socket_path:
+        socket_path = queue_socket_path(request)
+
     def wrapper(f):
         @wraps(f)
         def wrapped_f(*args, **kwargs):
             result = f(*args, **kwargs)
-            trigger_script = os.path.join('.', request.folder, 'private/bin',
-                    'queue_trigger.sh')
-            subprocess.Popen([trigger_script])
+            wake(socket_path)
             return result
         return wrapped_f
     return wrapper
+
+
+def wake(socket_path):
+    """Wake the QueueDaemon listening on a socket.
+
+    Args:
+        socket_path: string, name of the socket the QueueDaemon listens on.
+
+    Returns:
+        True if the wakeup was sent. False if no daemon is listening or its
+        socket buffer is full, in which case a wakeup is already pending.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.setblocking(0)
+        sock.sendto('w', socket_path)
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def worker_id():
+    """Return an id for the current process suitable for claiming jobs.
+
+    Returns:
+        string, 'hostname:pid'
+    """
+    return '{host}:{pid}'.format(host=socket.gethostname(), pid=os.getpid())
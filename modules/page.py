@@ -8,8 +8,8 @@ Classes related to web pages.
 
 """
 
-from applications.shared.modules.download_agent import DownloadAgent, \
-    DynamicMozillaCookieJar
+from applications.shared.modules.download_agent import BatchDownloader, \
+    DownloadAgent, DynamicMozillaCookieJar
 from BeautifulSoup import BeautifulSoup
 import HTMLParser
 import re
@@ -43,6 +43,8 @@ class WebPage(object):
     """Class representing a web page."""
 
     retries = 5  # Number of times to retry downloading
+    cache = None  # HttpCache instance, if set pages are cached
+    retry_policy = None  # RetryPolicy instance, None for the default
     control_chars = None  # Cache of control chars string
     control_chars_re = None  # Cache of control chars re
 
@@ -204,6 +206,43 @@ class WebPage(object):
         self.bs_massage.append((bs_re, lambda match: ''))
         return
 
+    def agent(
+        self,
+        cookie_jar=None,
+        cookie=None,
+        cookie_filename=None,
+        referrer=None,
+        request_headers=None,
+        ):
+        """Return the DownloadAgent that downloads the webpage.
+
+        Args:
+            See get().
+
+        Returns:
+            DownloadAgent instance
+        """
+
+        if not referrer:
+            referrer = self.url
+
+        if not cookie_jar and cookie_filename:
+            cookie_jar = DynamicMozillaCookieJar(filename=cookie_filename)
+            cookie_jar.create_file()
+
+        return DownloadAgent(
+            accept_encoding='gzip,deflate',
+            cookie_jar=cookie_jar,
+            cookie=cookie,
+            post_data=self.post_data,
+            referrer=referrer,
+            request_headers=request_headers,
+            retries=self.retries,
+            url=self.url,
+            cache=self.cache,
+            retry_policy=self.retry_policy,
+            )
+
     def as_soup(self):
         """
         Return the site page contents as a BeautifulSoup object
@@ -247,24 +286,30 @@ class WebPage(object):
             DownloadError if web page download is unsuccessful
         """
 
-        if not referrer:
-            referrer = self.url
-
-        if not cookie_jar and cookie_filename:
-            cookie_jar = DynamicMozillaCookieJar(filename=cookie_filename)
-            cookie_jar.create_file()
-
-        agent = DownloadAgent(
-            accept_encoding='gzip,deflate',
+        agent = self.agent(
             cookie_jar=cookie_jar,
             cookie=cookie,
-            post_data=self.post_data,
+            cookie_filename=cookie_filename,
             referrer=referrer,
             request_headers=request_headers,
-            retries=self.retries,
-            url=self.url,
             )
         agent.download()
+        self.load(agent)
+        return
+
+    def load(self, agent):
+        """Store the content downloaded by an agent.
+
+        Notes:
+            If the agent has a cache, the scrubbed content is cached with the
+            page so pages served from the cache are not scrubbed again.
+
+        Args:
+            agent: DownloadAgent instance, from agent(), downloaded.
+
+        Raises:
+            DownloadError if web page download is unsuccessful
+        """
 
         if not agent.content:
             if agent.errors:
@@ -274,7 +319,16 @@ class WebPage(object):
         # with open('/root/tmp/raw.htm', 'w') as f_dump:
         #    f_dump.write(self.raw_content + '\n')
 
+        # Pages served from the cache are not scrubbed again.
+        scrubbed_name = 'scrubbed_{c}'.format(c=self.__class__.__name__)
+        if agent.cached:
+            self.content = agent.cache.attachment(self.url, scrubbed_name)
+            if self.content is not None:
+                return
+
         self.content = self.scrub_content()
+        if agent.cache is not None and not self.post_data:
+            agent.cache.attach(self.url, scrubbed_name, self.content)
         return
 
     def scrub_content(self, html=None):
@@ -306,3 +360,40 @@ class WebPage(object):
         return html
 
 
+def get_pages(pages, downloader=None, **kwargs):
+    """Get the content of web pages concurrently.
+
+    Args:
+        pages: iterable of WebPage instances
+        downloader: BatchDownloader instance. Defaults to a BatchDownloader
+            with default settings.
+        kwargs: dict, WebPage.get() kwargs, applied to every page.
+
+    Yields:
+        tuple, (WebPage instance, DownloadError instance or None), as
+            downloads complete.
+
+    Raises:
+        The exception raised iterating pages or by a page's agent(), see
+            BatchDownloader.download().
+    """
+
+    if downloader is None:
+        downloader = BatchDownloader()
+    agents = {}
+
+    def page_agents():
+        """Generator of the agents of the pages."""
+        for page in pages:
+            agent = page.agent(**kwargs)
+            agents[id(agent)] = page
+            yield agent
+
+    for (unused_index, agent) in downloader.download(page_agents()):
+        page = agents.pop(id(agent))
+        try:
+            page.load(agent)
+        except DownloadError, err:
+            yield (page, err)
+            continue
+        yield (page, None)
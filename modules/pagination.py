@@ -5,12 +5,268 @@
 Classes for handling pagination
 
 """
-from gluon.html import A, DIV, HR, SPAN, TABLE, TD, TH, TR, URL, XML
+from gluon.dal import Expression, Query
+from gluon.html import A, DIV, HR, SPAN, TABLE, TD, TH, TR, URL, XML, \
+    xmlescape
+import cStringIO
 import copy
+import csv
+import json
+import threading
+import time
 
 # R0921: Abstract clas not referenced.
 # pylint: disable=R0921
 
+COUNTS = {}                 # Cache of report counts, see Report.count()
+COUNTS_LOCK = threading.Lock()
+COUNTS_SIZE = 1000          # Maximum number of cached counts
+
+
+class JqGridData(object):
+    """Class representing a jqGrid JSON data source for a report.
+
+    The grid's requests, request.vars page, rows, sidx, sord, _search,
+    filters, searchField, searchOper and searchString, are answered with a
+    page of rows of the report's sql_query(), sorted, filtered and paged by
+    the database.
+
+    Usage:
+        # Controller
+        def client_grid_data():
+            report = ClientReport(request, 'client_list', db)
+            response.headers['Content-Type'] = 'application/json'
+            return JqGridData(report).json()
+
+        # View, jsonReader defaults, the colModel index of a column is its
+        # report order_by.
+        $('#grid').jqGrid({url: '{{=URL('client_grid_data')}}',
+            datatype: 'json', colModel: [{name: 'name', index: 'name'}...]});
+    """
+
+    max_rows = 1000             # Maximum rows per page
+    operators = {
+        'eq': lambda f, d: f == d,
+        'ne': lambda f, d: f != d,
+        'lt': lambda f, d: f < d,
+        'le': lambda f, d: f <= d,
+        'gt': lambda f, d: f > d,
+        'ge': lambda f, d: f >= d,
+        'bw': lambda f, d: like(f, escape_like(d) + '%'),
+        'bn': lambda f, d: ~like(f, escape_like(d) + '%'),
+        'ew': lambda f, d: like(f, '%' + escape_like(d)),
+        'en': lambda f, d: ~like(f, '%' + escape_like(d)),
+        'cn': lambda f, d: like(f, '%' + escape_like(d) + '%'),
+        'nc': lambda f, d: ~like(f, '%' + escape_like(d) + '%'),
+        'in': lambda f, d: f.belongs([x.strip() for x in d.split(',')]),
+        'ni': lambda f, d: ~f.belongs([x.strip() for x in d.split(',')]),
+        'nu': lambda f, d: f == None,
+        'nn': lambda f, d: f != None,
+        }
+
+    def __init__(self, report, id_field='id'):
+        """Constructor.
+
+        Args:
+            report: Report object instance. Its sqldb, sql_query(),
+                columns and order_field() are used.
+            id_field: string, row value used as the jqGrid row id, eg 'id'
+                or, for a report of a join, 'client.id'.
+        """
+        self.report = report
+        self.id_field = id_field
+
+    def _order_bys(self):
+        """Return the fields the grid can be sorted and filtered by, the
+        report column order_by values.
+
+        Returns:
+            list of strings
+        """
+        return [x['order_by'] for x in self.report.column_set.report_columns
+                if x['order_by']]
+
+    def cells(self, row):
+        """Return the cells of a row.
+
+        Args:
+            row: Storage or dict, Data set.
+
+        Returns:
+            list, the value of each report column. Values are escaped as in
+                Report.report(); numbers are not converted.
+        """
+        cells = []
+        for column in self.report.column_set.sorted():
+            if callable(column['callback']):
+                value = column['callback'](row)
+            else:
+                try:
+                    value = self.report._row_value(row, column['callback'])
+                except KeyError:
+                    value = None
+            if value is None:
+                value = ''
+            elif not isinstance(value, (int, long, float)) \
+                    or isinstance(value, bool):
+                value = xmlescape(value)
+            cells.append(value)
+        return cells
+
+    def data(self):
+        """Return the data of the grid's request.
+
+        Returns:
+            dict, in the format of jqGrid's default jsonReader:
+                {'page': page, 'total': pages, 'records': count,
+                 'rows': [{'id': id, 'cell': [value, ...]}, ...]}
+
+        Raises:
+            ValueError, if a filter is invalid.
+        """
+        params = self.params()
+        query = self.report.sql_query()
+        filter_query = self.filter_query(params['filters'])
+        if filter_query is not None:
+            query = query & filter_query
+
+        records = self.report.sqldb(query).count()
+        rows_per_page = params['rows']
+        pages = int(records / rows_per_page) + (records
+                % rows_per_page != 0) * 1
+        page = min(params['page'], pages) if pages else 1
+        limitby = ((page - 1) * rows_per_page, page * rows_per_page)
+
+        rows = self.report.sqldb(query).select(
+                orderby=self.orderby(params['sidx'], params['sord']),
+                limitby=limitby)
+        return {
+            'page': page,
+            'total': pages,
+            'records': records,
+            'rows': [{'id': self.report._row_value(x, self.id_field),
+                      'cell': self.cells(x)} for x in rows],
+            }
+
+    def filter_query(self, filters):
+        """Return the query of jqGrid filters.
+
+        Args:
+            filters: dict, jqGrid filters,
+                {'groupOp': 'AND' or 'OR',
+                 'rules': [{'field': f, 'op': op, 'data': data}, ...],
+                 'groups': [filters, ...]}
+
+        Returns:
+            gluon.dal.Query instance, None if there are no rules.
+
+        Raises:
+            ValueError, if a field is not a report column order_by or an op
+                is not in operators.
+        """
+        if not filters:
+            return None
+        queries = []
+        for rule in filters.get('rules') or []:
+            field = rule.get('field')
+            if field not in self._order_bys():
+                raise ValueError('Invalid filter field: {f}'.format(
+                        f=field))
+            operator = self.operators.get(rule.get('op'))
+            if not operator:
+                raise ValueError('Invalid filter op: {o}'.format(
+                        o=rule.get('op')))
+            queries.append(operator(self.report.order_field(field),
+                    rule.get('data') or ''))
+        for group in filters.get('groups') or []:
+            query = self.filter_query(group)
+            if query is not None:
+                queries.append(query)
+        if not queries:
+            return None
+        combined = queries[0]
+        for query in queries[1:]:
+            if str(filters.get('groupOp', 'AND')).upper() == 'OR':
+                combined = combined | query
+            else:
+                combined = combined & query
+        return combined
+
+    def json(self):
+        """Return the data of the grid's request as compact JSON.
+
+        Returns:
+            string, JSON, see data()
+        """
+        return json.dumps(self.data(), separators=(',', ':'), default=str)
+
+    def orderby(self, sidx, sord):
+        """Return the orderby of a grid sort.
+
+        Args:
+            sidx: string, name of field to sort by, a report column
+                order_by. If it is not, the grid is sorted by the id of the
+                id_field table or, if id_field has no table, of the first
+                table of the report's sql_query().
+            sord: string, 'asc' or 'desc'
+
+        Returns:
+            list of gluon.dal.Field instances, the sort field and id as a
+                tiebreaker.
+        """
+        if sidx in self._order_bys():
+            field = self.report.order_field(sidx)
+        elif '.' in self.id_field:
+            field = self.report.sqldb[self.id_field.split('.')[-2]].id
+        else:
+            tablenames = self.report.sqldb._adapter.tables(
+                    self.report.sql_query())
+            field = self.report.sqldb[tablenames[0]].id
+        orderby = [field]
+        if field.name != 'id':
+            orderby.append(field.table.id)
+        if sord == 'desc':
+            orderby = [~x for x in orderby]
+        return orderby
+
+    def params(self):
+        """Return the grid's request parameters.
+
+        Returns:
+            dict, {'page': integer, 1 based, 'rows': integer, 'sidx':
+                string, 'sord': 'asc' or 'desc', 'filters': dict or None}
+
+        Raises:
+            ValueError, if the filters are not valid JSON.
+        """
+        request_vars = self.report.request.vars
+        page = str(request_vars.page or '')
+        page = int(page) if page.isdigit() and int(page) > 0 else 1
+        rows = str(request_vars.rows or '')
+        rows = int(rows) if rows.isdigit() and int(rows) > 0 else 20
+        rows = min(rows, self.max_rows)
+        sord = 'desc' if request_vars.sord == 'desc' else 'asc'
+
+        filters = None
+        if request_vars._search == 'true':
+            if request_vars.filters:
+                filters = json.loads(request_vars.filters)
+                if not isinstance(filters, dict):
+                    raise ValueError('Invalid filters')
+            elif request_vars.searchField:
+                filters = {'groupOp': 'AND', 'rules': [{
+                    'field': request_vars.searchField,
+                    'op': request_vars.searchOper or 'eq',
+                    'data': request_vars.searchString,
+                    }]}
+        return {
+            'page': page,
+            'rows': rows,
+            'sidx': request_vars.sidx or '',
+            'sord': sord,
+            'filters': filters,
+            }
+
 
 class Navigator(object):
     """Represents a page navigator."""
@@ -193,7 +449,41 @@ class PageList(object):
 
 
 class Report(object):
-    """Class representing a paginated report."""
+    """Class representing a paginated report.
+
+    Pagination modes:
+        'offset': Pages are selected with limitby=(offset, offset + n). Any
+            page number can be jumped to but the database reads and
+            discards every row before the page, so deep pages are slow.
+        'keyset': The prev and next page links carry the order_by value and
+            id of the first or last row of the page, and the page is
+            selected with, eg, WHERE (order_by, id) > (value, id) LIMIT n.
+            The cost of a page is the same whatever its depth. Page number
+            links still use offsets. Requires an order_field() for the
+            order_by and a rows() ordering by (order_by, id); otherwise
+            pages fall back to offsets.
+
+    Count strategies, see count():
+        'exact': COUNT(*) of the sql_query() on every report.
+        'cached': The exact count is cached per query for count_ttl
+            seconds.
+        'approximate': On MySQL, the optimizer's estimate of the number of
+            rows, from EXPLAIN. Estimates below approximate_min are replaced
+            by exact counts.
+        'has_next': No count. Only whether there is a page after the
+            current page is determined.
+    """
+
+    approximate_min = 10000     # See count strategy 'approximate'
+    count_strategy = 'exact'    # See class docstring
+    count_ttl = 300             # Seconds counts are cached, see 'cached'
+    export_chunk_size = 1000    # Number of rows selected at a time, export()
+    export_content_types = {
+        'csv': 'text/csv',
+        'ndjson': 'application/x-ndjson',
+        }
+    keyset_vars = ['seek', 'seek_id', 'seek_null', 'seek_value']
+    pagination = 'offset'       # 'offset' or 'keyset', see class docstring
 
     def __init__(
         self,
@@ -248,6 +538,338 @@ class Report(object):
                 count = 0
         return count
 
+    def _approximate_count(self):
+        """Return an estimate of the number of rows.
+
+        Returns:
+            integer
+
+        Notes:
+            The estimate is the product of the rows estimates of the tables
+            of the EXPLAIN of the query, scaled by the filtered percentage
+            if available. Without MySQL, the exact count is returned.
+        """
+        if self.sqldb._dbname != 'mysql':
+            return self.__len__()
+        try:
+            sql = self.sqldb(self.sql_query())._select()
+        except NotImplementedError:
+            return 0
+        adapter = self.sqldb._adapter
+        adapter.execute('EXPLAIN {sql}'.format(sql=sql.rstrip(';')))
+        names = [x[0].lower() for x in adapter.cursor.description]
+        estimate = 1.0
+        for explain_row in adapter.cursor.fetchall():
+            explain = dict(zip(names, explain_row))
+            rows = float(explain.get('rows') or 0)
+            if explain.get('filtered') is not None:
+                rows = rows * float(explain['filtered']) / 100
+            estimate = estimate * rows
+        if estimate < self.approximate_min:
+            return self.__len__()
+        return int(estimate)
+
+    def _cached_count(self):
+        """Return the number of rows, cached per query for count_ttl
+        seconds.
+
+        Returns:
+            integer
+        """
+        try:
+            sql = self.sqldb(self.sql_query())._count()
+        except NotImplementedError:
+            return 0
+        key = (self.sqldb._uri, sql)
+        now = time.time()
+        cached = COUNTS.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+        count = self.__len__()
+        with COUNTS_LOCK:
+            if len(COUNTS) >= COUNTS_SIZE:
+                for (old_key, old_value) in COUNTS.items():
+                    if old_value[0] <= now:
+                        del COUNTS[old_key]
+                if len(COUNTS) >= COUNTS_SIZE:
+                    COUNTS.clear()
+            COUNTS[key] = (now + self.count_ttl, count)
+        return count
+
+    def _export_order(self, order_by, order_dir):
+        """Return the sort order of an export.
+
+        Args:
+            order_by: string, default name of field to sort by
+            order_dir: integer, default order direction
+
+        Returns:
+            tuple, (order_by, order_dir). As in report(), request.vars
+                override the defaults.
+        """
+        order_by = self.request.vars.order_by or order_by
+        if not order_by in [x['order_by'] for x in
+                            self.column_set.report_columns]:
+            order_by = 'id'
+        order_dir = self.request.vars.order_dir or order_dir
+        if not str(order_dir).isdigit():
+            order_dir = 0
+        order_dir = 1 if int(order_dir) != 0 else 0
+        return (order_by, order_dir)
+
+    def _page_vars(self, updates, seek_vars=None):
+        """Return the request vars for a page link.
+
+        Args:
+            updates: dict, vars to set, eg {'page': 3}
+            seek_vars: dict, keyset vars of the linked page, see
+                _seek_vars(). If None, the link is an offset link.
+
+        Returns:
+            dict
+        """
+        request_vars = dict(self.request.vars)
+        for key in self.keyset_vars:
+            request_vars.pop(key, None)
+        request_vars.update(updates)
+        if seek_vars:
+            request_vars.update(seek_vars)
+        return request_vars
+
+    def _row_value(self, row, path):
+        """Return the value of a row for a dotted path.
+
+        Args:
+            row: Storage or dict, Data set.
+            path: string, eg 'name' or 'client.name'
+
+        Returns:
+            value, row['client']['name'], or row['name'] if the row is not
+                nested, ie a single table select.
+        """
+        # R0201: *Method could be a function*
+        # pylint: disable=R0201
+
+        value = row
+        try:
+            for name in path.split('.'):
+                value = value[name]
+        except (KeyError, TypeError):
+            value = row[path.split('.')[-1]]
+        return value
+
+    def _seek_vars(self, row, order_by, seek):
+        """Return the keyset vars of a page link.
+
+        Args:
+            row: Storage or dict, the first row of the page for a prev link,
+                the last row for a next link.
+            order_by: string, name of field the report is sorted by
+            seek: string, 'prev' or 'next'
+
+        Returns:
+            dict, {'seek': seek, 'seek_value': value, 'seek_id': id}. If the
+                order_by value is NULL, 'seek_null': 1 replaces
+                'seek_value'. None if the row has no order_by value or id,
+                in which case the link is an offset link.
+        """
+        id_path = '.'.join(order_by.split('.')[:-1] + ['id'])
+        try:
+            value = self._row_value(row, order_by)
+            record_id = self._row_value(row, id_path)
+        except KeyError:
+            return None
+        if record_id is None:
+            return None
+        if value is None:
+            return {'seek': seek, 'seek_null': 1, 'seek_id': record_id}
+        return {'seek': seek, 'seek_value': value, 'seek_id': record_id}
+
+    def count(self):
+        """Return the number of rows as per the count_strategy.
+
+        Returns:
+            integer, or None if the count_strategy is 'has_next'. If the
+                count_strategy is 'approximate', the number is an estimate.
+        """
+        if self.count_strategy == 'has_next':
+            return None
+        if self.sqldb and self.count_strategy == 'cached':
+            return self._cached_count()
+        if self.sqldb and self.count_strategy == 'approximate':
+            return self._approximate_count()
+        return self.__len__()
+
+    def export(self, export_format='csv', order_by='id', order_dir=0):
+        """Export the report rows.
+
+        Args:
+            export_format: string, 'csv' or 'ndjson', newline delimited
+                JSON, one object per row.
+            order_by: string, name of field to sort by. request.vars
+                order_by overrides, as in report().
+            order_dir: integer, order direction. request.vars order_dir
+                overrides.
+
+        Returns:
+            generator, yields strings, one per chunk of rows. See
+                export_chunks().
+
+        Notes:
+            web2py closes the database connections of a request before it
+            iterates the response body. If the connection of sqldb is
+            closed when the export starts, the rows are selected on a new
+            connection, closed when the export ends.
+
+        Usage:
+            # Controller, the export is streamed with chunked transfer
+            # encoding as no Content-Length header is set.
+            def table_export():
+                crud = TableCRUD(db, request, response, session, 'client')
+                raise HTTP(200, crud.export('csv'),
+                        **crud.export_headers('csv', 'client.csv'))
+        """
+        if export_format not in self.export_content_types:
+            raise ValueError('Invalid export format: {f}'.format(
+                    f=export_format))
+        columns = self.export_columns()
+        (order_by, order_dir) = self._export_order(order_by, order_dir)
+
+        def value(row, callback):
+            """Return the value of a column for a row."""
+            if callable(callback):
+                return callback(row)
+            try:
+                return self._row_value(row, callback)
+            except KeyError:
+                return None
+
+        def utf8(data):
+            """Return a value encoded for the csv module."""
+            if isinstance(data, unicode):
+                return data.encode('utf-8')
+            return data
+
+        def chunks():
+            """Generate the chunks of the export."""
+            if export_format == 'csv':
+                out = cStringIO.StringIO()
+                csv_writer = csv.writer(out, quoting=csv.QUOTE_NONNUMERIC)
+                csv_writer.writerow([utf8(x[0]) for x in columns])
+                for rows in self.export_chunks(order_by, order_dir):
+                    for row in rows:
+                        csv_writer.writerow(
+                            [utf8(value(row, x[1])) for x in columns])
+                    yield out.getvalue()
+                    out.seek(0)
+                    out.truncate()
+                if out.tell():
+                    yield out.getvalue()
+            else:
+                keys = [x[0] if callable(x[1]) else x[1] for x in columns]
+                for rows in self.export_chunks(order_by, order_dir):
+                    lines = []
+                    for row in rows:
+                        lines.append(json.dumps(dict(zip(keys,
+                            [value(row, x[1]) for x in columns])),
+                            default=str))
+                        lines.append('\n')
+                    yield ''.join(lines)
+
+        def generate():
+            """Generate the chunks of the export, connecting if required."""
+            adapter = self.sqldb._adapter if self.sqldb else None
+            connect = adapter is not None and adapter.connection is None
+            if connect:
+                adapter.reconnect()
+            try:
+                for chunk in chunks():
+                    yield chunk
+            finally:
+                if connect:
+                    adapter.close('rollback')
+
+        return generate()
+
+    def export_chunks(self, order_by, order_dir, chunk_size=None):
+        """Return the report rows in chunks.
+
+        Args:
+            order_by: string, name of field to sort by
+            order_dir: integer, order direction
+            chunk_size: integer, number of rows per chunk. Defaults to
+                export_chunk_size.
+
+        Returns:
+            generator, yields lists of rows.
+
+        Notes:
+            Every chunk is selected with keyset_rows(), the first from the
+            start of the report, the following ones continuing after the
+            last row of the previous chunk, so each chunk costs the same
+            and only one chunk is held in memory. Rows with a NULL order_by
+            value are included, see keyset_rows(). If keyset_rows() is not
+            implemented, or the rows have no id, chunks are selected by
+            offset with rows().
+        """
+        if chunk_size is None:
+            chunk_size = self.export_chunk_size
+        page = 0
+        seek_vars = {}
+        while True:
+            rows = None
+            if seek_vars is not None:
+                try:
+                    rows = self.keyset_rows(chunk_size, order_by, order_dir,
+                            seek_vars.get('seek_value'),
+                            seek_vars.get('seek_id'))
+                except NotImplementedError:
+                    seek_vars = None
+            if rows is None:
+                rows = self.rows(page, chunk_size, order_by, order_dir)
+            if not rows:
+                return
+            yield rows
+            if len(rows) < chunk_size:
+                return
+            page += 1
+            if seek_vars is not None:
+                seek_vars = self._seek_vars(rows[-1], order_by, 'next')
+
+    def export_columns(self):
+        """Return the columns of an export.
+
+        Returns:
+            list of tuples, [(heading, callback), ...] where callback is a
+                field name, eg 'client.name', or a function returning the
+                value of the column for a row. The default is the report
+                columns whose callback is a field name; formatting
+                functions return HTML. Reports override to export other
+                columns.
+        """
+        return [(x['heading'], x['callback']) for x in
+                self.column_set.sorted() if not callable(x['callback'])]
+
+    def export_headers(self, export_format, filename=None):
+        """Return the HTTP headers of an export response.
+
+        Args:
+            export_format: string, 'csv' or 'ndjson', see export()
+            filename: string, name of file the export is downloaded as.
+                Defaults to <report_function>.<export_format>
+
+        Returns:
+            dict, {header: value, ...}
+        """
+        if not filename:
+            filename = '{f}.{e}'.format(f=self.report_function,
+                    e=export_format)
+        return {
+            'Content-Type': self.export_content_types[export_format],
+            'Content-Disposition': 'attachment; filename="{f}"'.format(
+                f=filename.replace('"', '')),
+            }
+
     def format_delimited_list(self, row, fields, sep=''):
         """Format a list of field values.
 
@@ -307,20 +929,119 @@ class Report(object):
         else:
             new_order_dir = report_column['order_dir']
 
-        request_vars = dict(self.request.vars)
-        request_vars.update({'order_dir': new_order_dir,
+        request_vars = self._page_vars({'order_dir': new_order_dir,
             'order_by': new_order_by, 'page': 0})
         return A(report_column['heading'],
                  _class='results_column_header_link',
                  _href=URL(r=self.request, f=self.report_function,
                  args=self.request.args, vars=request_vars))
 
-    def next_page_link(self, page, pages):
+    def has_next_page(self, page, items_per_page, order_by, order_dir,
+            rows):
+        """Return whether there is a page after the current page.
+
+        Args:
+            page: integer, the number of the current page
+            items_per_page: integer
+            order_by: string, name of field to sort by
+            order_dir: string, order direction
+            rows: list, the rows of the current page
+
+        Returns:
+            boolean, True if there is a next page.
+
+        Notes:
+            If the page is full, the first row of the next page is selected,
+            with keyset_rows() if the report uses keyset pagination,
+            otherwise with rows((page + 1) * items_per_page, 1, ...).
+        """
+        if len(rows) < items_per_page:
+            return False
+        if self.pagination == 'keyset':
+            seek_vars = self._seek_vars(rows[-1], order_by, 'next')
+            if seek_vars:
+                try:
+                    return len(self.keyset_rows(1, order_by, order_dir,
+                        seek_vars.get('seek_value'),
+                        seek_vars['seek_id'])) > 0
+                except NotImplementedError:
+                    pass
+        return len(self.rows((page + 1) * items_per_page, 1, order_by,
+            order_dir)) > 0
+
+    def keyset_rows(self, items_per_page, order_by, order_dir, seek_value,
+            seek_id, backward=False):
+        """SQL rows for a keyset page.
+
+        Args:
+            items_per_page: integer
+            order_by: string, name of field to sort by
+            order_dir: string, order direction
+            seek_value: order_by value of the boundary row, the last row of
+                the previous page or, if backward, the first row of the next
+                page. None if the value is NULL.
+            seek_id: integer, id of the boundary row. If None, there is no
+                boundary row, the first rows of the report are returned.
+            backward: If True, the rows before the boundary row are returned.
+
+        Returns:
+            list of gluon.dal.Row instances, in report order.
+
+        Raises:
+            NotImplementedError, if the report has no sqldb, order field or
+                rows().
+
+        Notes:
+            The rows are selected with rows(), page 0, with the report query
+            narrowed to the rows after the boundary row. rows() must order
+            by order_by, then id.
+
+            The row comparison (order_by, id) > (value, id) is expanded to
+            order_by > value OR (order_by = value AND id > id) which MySQL
+            can resolve with an index on (order_by, id). Rows with a NULL
+            order_by value are a partition ordered by id, sorting first
+            ascending on MySQL and SQLite, last on PostgreSQL, as they do
+            in rows().
+        """
+        if not self.sqldb:
+            raise NotImplementedError
+        field = self.order_field(order_by)
+        id_field = field.table.id
+        descending = bool(int(order_dir)) != bool(backward)
+        nulls_first = (self.sqldb._dbname == 'postgres') == descending
+        query = self.sql_query()
+        if seek_id is not None:
+            if descending:
+                after_id = id_field < seek_id
+            else:
+                after_id = id_field > seek_id
+            if seek_value is None:
+                seek = (field == None) & after_id
+                if nulls_first:
+                    seek = seek | (field != None)
+            else:
+                if descending:
+                    seek = field < seek_value
+                else:
+                    seek = field > seek_value
+                seek = seek | ((field == seek_value) & after_id)
+                if not nulls_first:
+                    seek = seek | (field == None)
+            query = query & seek
+        rows = [row for row in self.rows(0, items_per_page, order_by,
+                int(descending), query=query)]
+        if backward:
+            rows.reverse()
+        return rows
+
+    def next_page_link(self, page, pages, seek_vars=None):
         """Return an HTML anchor representing a next page link.
 
         Args:
             page: integer, current page number
             pages: integer, total number of pages in report
+            seek_vars: dict, keyset vars of the next page, see
+                _seek_vars(). If None, the link is an offset link.
 
         Returns:
             string, HTML anchor
@@ -329,18 +1050,21 @@ class Report(object):
         if page >= pages - 1:
             return SPAN('next')
         else:
-            request_vars = dict(self.request.vars)
-            request_vars.update({'page': page + 1})
+            request_vars = self._page_vars({'page': page + 1},
+                    seek_vars=seek_vars)
             return A('next', _class='page_link',
                      _href=URL(r=self.request, f=self.report_function,
                      args=self.request.args, vars=request_vars))
 
-    def numeric_page_links(self, page, pages):
+    def numeric_page_links(self, page, pages, more=False):
         """Return a list of HTML TD tags representing page links.
 
         Args:
             page: integer, current page number
-            pages: integer, total number of pages in report
+            pages: integer, total number of pages in report, or, if the
+                total is unknown, the number of pages known to exist.
+            more: If True, the total is unknown and there may be pages
+                after the known pages. An ellipsis is appended.
 
         Returns:
             list, List of HTML TD tags
@@ -353,8 +1077,29 @@ class Report(object):
                 links.append(TD(SPAN('...')))
             links = links + [TD(self.page_link(p, page)) for p in
                              page_list]
+        if more:
+            links.append(TD(SPAN('...')))
         return links
 
+    def order_field(self, order_by):
+        """Return the field for an order_by value.
+
+        Args:
+            order_by: string, name of field to sort by, eg 'client.name'
+
+        Returns:
+            gluon.dal.Field instance
+
+        Raises:
+            NotImplementedError, if the report has no sqldb or the order_by
+                is not of the form 'table.field'. Reports sorting by field
+                names override this.
+        """
+        if not self.sqldb or '.' not in order_by:
+            raise NotImplementedError
+        (tablename, fieldname) = order_by.split('.', 1)
+        return self.sqldb[tablename][fieldname]
+
     def page_link(self, page_number, current_page):
         """Return an HTML anchor representing a page number link.
 
@@ -369,17 +1114,18 @@ class Report(object):
         if page_number == current_page:
             return SPAN(page_number + 1)
         else:
-            request_vars = dict(self.request.vars)
-            request_vars.update({'page': page_number})
+            request_vars = self._page_vars({'page': page_number})
             return A(page_number + 1, _class='page_link',
                      _href=URL(r=self.request, f=self.report_function,
                      args=self.request.args, vars=request_vars))
 
-    def prev_page_link(self, page):
+    def prev_page_link(self, page, seek_vars=None):
         """Return an HTML anchor representing a prev page link.
 
         Args:
             page: integer, current page number
+            seek_vars: dict, keyset vars of the prev page, see
+                _seek_vars(). If None, the link is an offset link.
 
         Returns:
             string, HTML anchor
@@ -388,8 +1134,8 @@ class Report(object):
         if page == 0:
             return SPAN('prev')
         else:
-            request_vars = dict(self.request.vars)
-            request_vars.update({'page': page - 1})
+            request_vars = self._page_vars({'page': page - 1},
+                    seek_vars=seek_vars)
             return A('prev', _class='page_link',
                      _href=URL(r=self.request, f=self.report_function,
                      args=self.request.args, vars=request_vars))
@@ -457,74 +1203,152 @@ class Report(object):
         if v['order_dir'] != 0:
             v['order_dir'] = 1
 
-        records = self.__len__()
+        records = self.count()
 
         items_per_page = int(v['items_per_page'])
 
-        # if records/items_per_page produces a fraction, add another page
-        pages = int(records / items_per_page) + (records
-                % items_per_page != 0) * 1
-
-        v['page'] = 0 if v['page'] > pages else v['page']
-
-        rows = self.rows(v['page'], items_per_page, v['order_by'],
-                v['order_dir'])
+        if records is not None:
+            # if records/items_per_page produces a fraction, add another page
+            pages = int(records / items_per_page) + (records
+                    % items_per_page != 0) * 1
+
+            # An estimate may be short of the page requested.
+            if self.count_strategy != 'approximate':
+                v['page'] = 0 if v['page'] > pages else v['page']
+
+        rows = None
+        if self.pagination == 'keyset' \
+                and self.request.vars.seek in ['next', 'prev'] \
+                and ('seek_value' in self.request.vars
+                     or self.request.vars.seek_null) \
+                and 'seek_id' in self.request.vars:
+            seek_value = None if self.request.vars.seek_null \
+                else self.request.vars.seek_value
+            try:
+                rows = self.keyset_rows(items_per_page, v['order_by'],
+                        v['order_dir'], seek_value, self.request.vars.seek_id,
+                        backward=self.request.vars.seek == 'prev')
+            except NotImplementedError:
+                pass
+        if rows is None:
+            rows = self.rows(v['page'], items_per_page, v['order_by'],
+                    v['order_dir'])
+
+        more = False
+        if records is None:
+            # The total is unknown, the pages known are the pages up to and
+            # including the next page, if any.
+            more = self.has_next_page(v['page'], items_per_page,
+                    v['order_by'], v['order_dir'], rows)
+            pages = v['page'] + 1 + int(more)
+            records = len(rows)
+
+        seek_prev = None
+        seek_next = None
+        if self.pagination == 'keyset' and rows:
+            seek_prev = self._seek_vars(rows[0], v['order_by'], 'prev')
+            seek_next = self._seek_vars(rows[-1], v['order_by'], 'next')
 
-        tr_rows = []
         ths = [TH(self.header_link(report_column, v['order_by'],
                v['order_dir']), _class='results_column_header')
                for report_column in self.column_set.sorted()]
 
-        tr_rows.append(TR(ths))  # Header row
+        # The table is serialized as the gluon.html helpers TABLE(TR(TD()))
+        # would serialize it. See row_renderer().
+        html = ['<table border="1" class="results_table"'
+                ' id="results_table">']
+        html.append(TR(ths).xml())  # Header row
 
         if records > 0:
+            render = self.row_renderer()
+            write = html.append
             for i, row in enumerate(rows):
-                tds = []
-                for column in self.column_set.sorted():
-                    formatted = ''
-                    if callable(column['callback']):
-                        formatted = column['callback'](row)
-                    else:
-                        # The next few lines get the value of the cell,
-                        # ie. row/column. Examples:
-                        # column.name           r
-                        # 'client_id'           row['client_id']
-                        # 'client.province'     row['client']['provnce']
-                        # 'x.y.z'               row['x']['y']['z']
-                        r = row
-                        try:
-                            for f in column['callback'].split('.'):
-                                r = r[f]
-                        except KeyError:
-                            r = 'n/a'
-                        formatted = r
-                    if not str(formatted) or formatted == None:
-                        formatted = column['empty'] or XML('&nbsp;')
-                    column_class = 'results_table_cell col_{name}'.format(
-                            name=column['order_by'].replace('.', '_'))
-                    tds.append(TD(formatted,
-                               _class=column_class,
-                               ))
-                tr_params = {}
-                if self.row_classes:
-                    tr_params['_class'] = self.row_classes[i % len(
-                        self.row_classes)]
-                tr_rows.append(TR(tds, **tr_params))
+                render(write, row, i)
         else:
-            tr_rows.append(TR([TD(SPAN('No records found.'),
-                _colspan=len(self.column_set))]))
+            html.append(TR([TD(SPAN('No records found.'),
+                _colspan=len(self.column_set))]).xml())
+        html.append('</table>')
 
-        results = DIV(TABLE(tr_rows, _class='results_table',
-                      _id='results_table', _border='1'))
+        results = DIV(XML(''.join(html)))
 
-        page_links = DIV(HR(), TABLE(TR(TD(self.prev_page_link(v['page'
-                         ])), self.numeric_page_links(v['page'],
-                         pages), TD(self.next_page_link(v['page'],
-                         pages))), _class='page_links_table'), HR())
+        page_links = DIV(HR(), TABLE(TR(TD(self.prev_page_link(v['page'],
+                         seek_vars=seek_prev)),
+                         self.numeric_page_links(v['page'], pages,
+                         more=more),
+                         TD(self.next_page_link(v['page'], pages,
+                         seek_vars=seek_next))), _class='page_links_table'),
+                         HR())
 
         return dict(results=results, page_links=page_links, pages=pages)
 
-    def rows(self, page, items_per_page, order_by, order_dir):
+    def row_renderer(self):
+        """Return a function rendering the HTML of report rows.
+
+        The column set is resolved once: the callback paths are split, and
+        the cell classes, empty values and row classes are escaped, so
+        rendering a row only formats its cell values.
+
+        Returns:
+            function, render(write, row, index), calls write with the HTML
+                strings of the row, <tr>...</tr>. index is the number of the
+                row on the page, used to pick the row class.
+
+        Notes:
+            The HTML is the same as the serialization of
+            TR([TD(formatted, _class=column_class), ...], _class=row_class).
+        """
+        # C0103: Invalid name
+        # pylint: disable=C0103
+
+        cells = []
+        for column in self.column_set.sorted():
+            callback = column['callback']
+            path = None if callable(callback) else callback.split('.')
+            empty = xmlescape(column['empty']) if column['empty'] \
+                else '&nbsp;'
+            td = '<td class="{c}">'.format(c=xmlescape(
+                'results_table_cell col_{name}'.format(
+                    name=column['order_by'].replace('.', '_')), True))
+            cells.append((callback, path, empty, td))
+
+        if self.row_classes:
+            trs = ['<tr class="{c}">'.format(c=xmlescape(x, True))
+                   for x in self.row_classes]
+        else:
+            trs = ['<tr>']
+        tr_count = len(trs)
+
+        def render(write, row, index):
+            """Write the HTML of a row."""
+            write(trs[index % tr_count])
+            for (callback, path, empty, td) in cells:
+                if path is None:
+                    formatted = callback(row)
+                else:
+                    # The value of the cell, ie. row/column. Examples:
+                    # column.name           formatted
+                    # 'client_id'           row['client_id']
+                    # 'client.province'     row['client']['provnce']
+                    # 'x.y.z'               row['x']['y']['z']
+                    formatted = row
+                    try:
+                        for f in path:
+                            formatted = formatted[f]
+                    except KeyError:
+                        formatted = 'n/a'
+                write(td)
+                if not str(formatted) or formatted == None:
+                    write(empty)
+                elif isinstance(formatted, (list, tuple)):
+                    for component in formatted:
+                        write(xmlescape(component))
+                else:
+                    write(xmlescape(formatted))
+                write('</td>')
+            write('</tr>')
+        return render
+
+    def rows(self, page, items_per_page, order_by, order_dir, query=None):
         """SQL rows for report.
 
         Args:
@@ -532,6 +1356,8 @@ class Report(object):
             items_per_page: integer
             order_by: string, name of field to sort by
             order_dir: string, order direction
+            query: gluon.dal.Query, if provided, the rows are selected with
+                this query instead of sql_query(), eg by keyset_rows().
 
         Returns:
             gluon.sql.Rows instance
@@ -632,3 +1458,41 @@ class ReportColumnSet(object):
         """
         return sorted(self.report_columns, key=lambda column: \
                       column['number'])
+
+
+def escape_like(value):
+    """Escape the LIKE wildcards of a value.
+
+    Args:
+        value: string
+
+    Returns:
+        string, value with %, _ and the escape character, !, escaped, for
+            a pattern of like().
+    """
+    return value.replace('!', '!!').replace('%', '!%').replace('_', '!_')
+
+
+def like(field, pattern):
+    """Return a case insensitive LIKE query with ! as the escape character.
+
+    Notes:
+        gluon.dal Field.like() has no ESCAPE clause. Without one, SQLite
+        has no escape character, and MySQL and PostgreSQL use backslash.
+        The query uses the ILIKE operator of the adapter, the ESCAPE clause
+        is appended to the pattern operand.
+
+    Args:
+        field: gluon.dal.Field instance
+        pattern: string, LIKE pattern, literal %, _ and ! escaped with
+            escape_like().
+
+    Returns:
+        gluon.dal.Query instance
+    """
+    adapter = field.db._adapter
+    escaped = Expression(field.db,
+            lambda first: "{p} ESCAPE '!'".format(
+                p=adapter.represent(first, 'string')),
+            pattern, type='string')
+    return Query(field.db, adapter.ILIKE, field, escaped)
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+This script times the per object cost of DbObject methods.
+
+For usage and help:
+
+    database_benchmark.py -h    # Brief help displaying options.
+
+Example:
+
+    python web2py.py -S shared -R \
+        applications/shared/private/bin/database_benchmark.py -A -n 20000
+"""
+from applications.shared.modules.database import Collection, DbObject, \
+    table_meta
+from gluon.dal import DAL, Field
+from gluon.storage import Storage
+from optparse import OptionParser
+import copy
+import sys
+import timeit
+
+VERSION = '0.1'
+
+
+def legacy_as_dict(obj):
+    """DbObject.as_dict() without the table metadata cache."""
+    obj_dict = {}
+    for field in obj.tbl_.fields:
+        if hasattr(obj, field):
+            obj_dict[field] = getattr(obj, field)
+    return obj_dict
+
+
+def legacy_as_list(obj):
+    """DbObject.as_list() without the table metadata cache."""
+    obj_list = []
+    for field in obj.tbl_.fields:
+        if hasattr(obj, field):
+            obj_list.append(getattr(obj, field))
+    return obj_list
+
+
+def legacy_copy(obj):
+    """DbObject.__copy__() without the table metadata cache."""
+    table = legacy_init(obj.tbl_)
+    for field in obj.tbl_.fields:
+        table.__dict__[field] = obj.__dict__[field]
+    return table
+
+
+def legacy_eq(obj, other):
+    """DbObject.__eq__() without the table metadata cache."""
+    for field in obj.tbl_.fields:
+        if obj.__dict__[field] != other.__dict__[field]:
+            return False
+    return True
+
+
+def legacy_from_row(tbl_, row):
+    """Collection.get() object creation without the table metadata cache."""
+    db_obj = legacy_init(tbl_)
+    for field in db_obj.tbl_.fields:
+        if hasattr(row, field):
+            setattr(db_obj, field, row[field])
+    return db_obj
+
+
+def legacy_init(tbl_, **kwargs):
+    """DbObject.__init__() without the table metadata cache."""
+    obj = DbObject.__new__(DbObject)
+    obj.tbl_ = tbl_
+    for field in obj.tbl_.fields:
+        obj.__dict__[field] = obj.tbl_[field].default
+    for key in kwargs.keys():
+        if key in obj.tbl_.fields:
+            obj.__dict__[key] = kwargs[key]
+        elif key == 'db_':
+            obj.db_ = kwargs[key]
+    if not hasattr(obj, 'db_'):
+        obj.db_ = obj.tbl_['_db']
+    obj.set_ = Collection(tbl_=obj.tbl_, db_=obj.db_, class_=DbObject)
+    return obj
+
+
+def benchmark_table():
+    """Return a table, in an in memory database, to benchmark with."""
+    db = DAL('sqlite:memory:')
+    db.define_table('bench',
+        Field('company_id', 'integer'),
+        Field('number', 'integer'),
+        Field('name'),
+        Field('amount', 'decimal(10,2)'),
+        Field('start_date', 'date'),
+        Field('status', default='a'),
+        Field('description'),
+        Field('sequence', 'integer'),
+        Field('created_on', 'datetime'),
+        Field('updated_on', 'datetime'),
+        )
+    return db.bench
+
+
+def run(number):
+    """Time the methods and print the results.
+
+    Args:
+        number: integer, number of times each method is called.
+    """
+    tbl_ = benchmark_table()
+    table_meta(tbl_)
+    obj = DbObject(tbl_, name='abc', number=1234)
+    other = DbObject(tbl_, name='abc', number=1234)
+    row = Storage(obj.as_dict(), id=1)
+
+    tests = [
+        ('__init__', lambda: legacy_init(tbl_, name='abc'),
+            lambda: DbObject(tbl_, name='abc')),
+        ('__copy__', lambda: legacy_copy(obj), lambda: copy.copy(obj)),
+        ('__eq__', lambda: legacy_eq(obj, other), lambda: obj == other),
+        ('as_dict', lambda: legacy_as_dict(obj), obj.as_dict),
+        ('as_list', lambda: legacy_as_list(obj), obj.as_list),
+        ('get (per row)', lambda: legacy_from_row(tbl_, row),
+            lambda: Collection(tbl_)._as_object(row)),
+        ]
+
+    print '{m:<16} {b:>12} {a:>12} {s:>8}'.format(m='method',
+            b='before (us)', a='after (us)', s='speedup')
+    for name, before, after in tests:
+        before_us = min(timeit.repeat(before, number=number, repeat=3)) \
+                * 1000000 / number
+        after_us = min(timeit.repeat(after, number=number, repeat=3)) \
+                * 1000000 / number
+        print '{m:<16} {b:>12.2f} {a:>12.2f} {s:>7.1f}x'.format(m=name,
+                b=before_us, a=after_us, s=before_us / after_us)
+
+
+def main():
+    """ Main routine. """
+
+    usage = '%prog [options]' + '\nVersion: %s' % VERSION
+    parser = OptionParser(usage=usage)
+
+    parser.add_option('-n', '--number', type='int', dest='number',
+                      default=10000,
+                      help='Number of calls per method. Default 10000.',
+                      )
+
+    (options, unused_args) = parser.parse_args(sys.argv[1:])
+    run(options.number)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+This script times DbSequenceField tidy() and move() on large sequences.
+
+For usage and help:
+
+    db_sequence_field_benchmark.py -h    # Brief help displaying options.
+
+Example:
+
+    python web2py.py -S shared -R \
+        applications/shared/private/bin/db_sequence_field_benchmark.py \
+        -A -s 10000 -s 100000
+"""
+from applications.shared.modules.db_sequence_field import DbSequenceField
+from gluon.dal import DAL, Field
+from optparse import OptionParser
+import os
+import random
+import sys
+import time
+
+VERSION = '0.1'
+
+DB_FOLDER = '/tmp'
+DB_FILE = 'db_sequence_field_benchmark.db'
+
+
+def legacy_move(seq, record_id):
+    """DbSequenceField.move(record_id, 'end') as a row by row tidy, shift and
+    tidy.
+    """
+    rows = seq.db_(seq.table.id == record_id).select()
+    current_pos = rows[0][seq.field.name]
+    position = seq._tidy_by_row() + 1
+    query = (seq.field != None) & (seq.field <= position) \
+        & (seq.field >= current_pos)
+    seq.db_(query).update(**dict([[seq.field.name, seq.field - 1]]))
+    seq.db_(seq.table.id == record_id).update(
+        **dict([[seq.field.name, position]]))
+    seq._tidy_by_row()
+    seq.db_.commit()
+
+
+def load(db, records):
+    """Replace the sequence records with shuffled sequence values.
+
+    Args:
+        db: gluon.dal.DAL object instance
+        records: integer, number of records.
+    """
+    db.executesql('DELETE FROM seq_bench;')
+    sequences = range(1, records + 1)
+    random.shuffle(sequences)
+    db._adapter.cursor.executemany(
+        'INSERT INTO seq_bench (sequence) VALUES (?);',
+        [(x, ) for x in sequences])
+    db.commit()
+
+
+def timed(func, *args):
+    """Return the seconds it takes to call a function."""
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def run(sizes):
+    """Time the methods and print the results.
+
+    Args:
+        sizes: list of integers, number of records in the sequence.
+    """
+    if os.path.exists(os.path.join(DB_FOLDER, DB_FILE)):
+        os.unlink(os.path.join(DB_FOLDER, DB_FILE))
+    db = DAL('sqlite://{f}'.format(f=DB_FILE), folder=DB_FOLDER)
+    db.define_table('seq_bench', Field('sequence', 'integer'),
+            migrate=False)
+    db.executesql("""
+        CREATE TABLE seq_bench (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sequence INTEGER
+        );
+        """)
+    db.executesql('CREATE INDEX seq_bench_sequence ON seq_bench (sequence);')
+    seq = DbSequenceField(field=db.seq_bench.sequence)
+
+    print '{n:>8} {m:<12} {b:>12} {a:>12}'.format(n='records', m='method',
+            b='before (s)', a='after (s)')
+    for records in sizes:
+        load(db, records)
+        before = timed(seq._tidy_by_row)
+        db.commit()
+        load(db, records)
+        after = timed(seq.tidy)
+        print '{n:>8} {m:<12} {b:>12.3f} {a:>12.3f}'.format(n=records,
+                m='tidy', b=before, a=after)
+
+        seq.tidy()
+        record_id = db(db.seq_bench.sequence == 1).select()[0].id
+        before = timed(legacy_move, seq, record_id)
+        seq.tidy()
+        record_id = db(db.seq_bench.sequence == 1).select()[0].id
+        after = timed(seq.move, record_id, 'end')
+        print '{n:>8} {m:<12} {b:>12.3f} {a:>12.3f}'.format(n=records,
+                m="move 'end'", b=before, a=after)
+
+        record_id = db(db.seq_bench.sequence == records).select()[0].id
+        after = timed(seq.move, record_id, 'up')
+        print '{n:>8} {m:<12} {b:>12} {a:>12.3f}'.format(n=records,
+                m="move 'up'", b='', a=after)
+    os.unlink(os.path.join(DB_FOLDER, DB_FILE))
+
+
+def main():
+    """ Main routine. """
+
+    usage = '%prog [options]' + '\nVersion: %s' % VERSION
+    parser = OptionParser(usage=usage)
+
+    parser.add_option('-s', '--size', type='int', action='append',
+                      dest='sizes',
+                      help=' '.join(['Number of records in the sequence.',
+                          'Repeat for several sizes. Default 10000 and',
+                          '100000.']),
+                      )
+
+    (options, unused_args) = parser.parse_args(sys.argv[1:])
+    run(options.sizes or [10000, 100000])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+This script enqueues synthetic jobs in a SQLite job queue, runs them with
+job_queue.Executor and prints the queue statistics.
+
+For usage and help:
+
+    job_queue_load_test.py -h    # Brief help displaying options.
+
+Example:
+
+    python web2py.py -S shared -R \
+        applications/shared/private/bin/job_queue_load_test.py \
+        -A -n 5000 -w 8 -f
+"""
+from applications.shared.modules.job_queue import Executor, Job, Queue
+from gluon.dal import DAL, Field
+from optparse import OptionParser
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+VERSION = '0.1'
+
+JOB_SCRIPT = """
+import sys
+import time
+time.sleep(float(sys.argv[1]))
+sys.exit(int(sys.argv[2]))
+"""
+
+
+def job_table(folder):
+    """Return a job table, in a SQLite database, to load test with.
+
+    Args:
+        folder: string, directory the database is created in.
+    """
+    db = DAL('sqlite://job_queue_load_test.db', folder=folder)
+    db.define_table('job',
+        Field('start', 'datetime'),
+        Field('priority', 'integer'),
+        Field('command'),
+        Field('status'),
+        Field('worker'),
+        Field('lease_expires', 'datetime'),
+        Field('exit_status', 'integer'),
+        Field('stdout', 'text'),
+        Field('stderr', 'text'),
+        Field('queued_on', 'datetime'),
+        Field('claimed_on', 'datetime'),
+        Field('started_on', 'datetime'),
+        Field('finished_on', 'datetime'),
+        )
+    return db.job
+
+
+def run(options):
+    """Enqueue and run the jobs and print the results.
+
+    Args:
+        options: optparse options, see main().
+    """
+    folder = tempfile.mkdtemp()
+    try:
+        tbl_ = job_table(folder)
+        script = os.path.join(folder, 'job.py')
+        with open(script, 'w') as f:
+            f.write(JOB_SCRIPT)
+
+        jobs = []
+        for i in range(options.number):
+            # Every 20th job fails.
+            exit_status = 1 if i % 20 == 19 else 0
+            command = '{s} {d} {e}'.format(s=script, d=options.duration,
+                    e=exit_status)
+            jobs.append(Job(tbl_, start='2010-01-01 00:00:00',
+                priority=i % 3, command=command, status='a'))
+        start = time.time()
+        Job(tbl_).set_.bulk_add(jobs)
+        enqueue_seconds = time.time() - start
+
+        queue = Queue(tbl_)
+        print 'Before run:'
+        print json.dumps(queue.stats(), indent=4, sort_keys=True)
+
+        executor = Executor(queue, max_workers=options.workers,
+                fork=options.fork)
+        start = time.time()
+        count = executor.run()
+        run_seconds = time.time() - start
+
+        print 'After run:'
+        print json.dumps(queue.stats(), indent=4, sort_keys=True)
+        print '{n} jobs enqueued in {s:.3f} s ({r:.0f} jobs/s)'.format(
+                n=options.number, s=enqueue_seconds,
+                r=options.number / enqueue_seconds)
+        print '{n} jobs run in {s:.3f} s ({r:.1f} jobs/s), {w} workers'.format(
+                n=count, s=run_seconds, r=count / run_seconds,
+                w=options.workers)
+    finally:
+        shutil.rmtree(folder)
+
+
+def main():
+    """ Main routine. """
+
+    usage = '%prog [options]' + '\nVersion: %s' % VERSION
+    parser = OptionParser(usage=usage)
+
+    parser.add_option('-d', '--duration', type='float', dest='duration',
+                      default=0.0,
+                      help='Seconds each job sleeps. Default 0.',
+                      )
+    parser.add_option('-f', '--fork', action='store_true', dest='fork',
+                      default=False,
+                      help='Run jobs in forked children of this process.',
+                      )
+    parser.add_option('-n', '--number', type='int', dest='number',
+                      default=2000,
+                      help='Number of jobs enqueued. Default 2000.',
+                      )
+    parser.add_option('-w', '--workers', type='int', dest='workers',
+                      default=Executor.max_workers,
+                      help=' '.join(['Maximum number of jobs run at a time.',
+                          'Default', str(Executor.max_workers)]),
+                      )
+
+    (options, unused_args) = parser.parse_args(sys.argv[1:])
+    run(options)
+
+if __name__ == '__main__':
+    main()
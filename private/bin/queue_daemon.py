@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+This script runs a long running job queue handler. The handler runs queued
+jobs when woken by controllers decorated with trigger_queue_handler and at
+least every poll interval.
+
+For usage and help:
+
+    queue_daemon.py -h    # Brief help displaying options.
+
+Example:
+
+    python web2py.py -S shared -M -R \
+        applications/shared/private/bin/queue_daemon.py -A -w 4 -t 3600
+"""
+from applications.shared.modules.job_queue import Executor, Queue, \
+    QueueDaemon, queue_socket_path
+from gluon.shell import env
+from optparse import OptionParser
+import sys
+
+VERSION = '0.1'
+
+
+def main():
+    """ Main routine. """
+    # E0602: *Undefined variable %r*
+    # pylint: disable=E0602
+
+    usage = '%prog [options]' + '\nVersion: %s' % VERSION
+    parser = OptionParser(usage=usage)
+
+    parser.add_option('-c', '--coalesce', type='float', dest='coalesce',
+                      default=QueueDaemon.coalesce_seconds,
+                      help=' '.join(['Seconds triggers are collected for',
+                          'before the queue is handled. Default',
+                          str(QueueDaemon.coalesce_seconds)]),
+                      )
+    parser.add_option('-f', '--fork', action='store_true', dest='fork',
+                      default=False,
+                      help='Run jobs in forked children of the daemon.',
+                      )
+    parser.add_option('-p', '--poll', type='float', dest='poll',
+                      default=QueueDaemon.poll_seconds,
+                      help=' '.join(['Maximum seconds between handling the',
+                          'queue. Default', str(QueueDaemon.poll_seconds)]),
+                      )
+    parser.add_option('-s', '--socket', dest='socket_path',
+                      default=queue_socket_path(request),
+                      help='Socket file to listen on. Default %default',
+                      )
+    parser.add_option('-t', '--timeout', type='int', dest='timeout',
+                      help='Seconds a job may run before it is killed.',
+                      )
+    parser.add_option('-w', '--workers', type='int', dest='workers',
+                      default=Executor.max_workers,
+                      help=' '.join(['Maximum number of jobs run at a time.',
+                          'Default', str(Executor.max_workers)]),
+                      )
+
+    (options, unused_args) = parser.parse_args(sys.argv[1:])
+
+    fork_env = None
+    if options.fork:
+        # The models are imported once, each forked job inherits them.
+        fork_env = env(request.application, import_models=True)
+    executor = Executor(Queue(db.job), max_workers=options.workers,
+            timeout=options.timeout, fork=options.fork, fork_env=fork_env)
+    daemon = QueueDaemon(executor.run, options.socket_path)
+    daemon.coalesce_seconds = options.coalesce
+    daemon.poll_seconds = options.poll
+    try:
+        daemon.run()
+    finally:
+        daemon.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+This script times the rendering of pagination.Report rows, comparing
+Report.row_renderer() with rows built from gluon.html helpers, and checks
+the HTML of both is the same.
+
+For usage and help:
+
+    report_render_benchmark.py -h    # Brief help displaying options.
+
+Example:
+
+    python web2py.py -S shared -R \
+        applications/shared/private/bin/report_render_benchmark.py \
+        -A -r 100 -c 10
+"""
+from applications.shared.modules.pagination import Report
+from gluon.globals import Request
+from gluon.html import A, TD, TR, XML
+from optparse import OptionParser
+import sys
+import time
+
+VERSION = '0.1'
+
+
+class BenchmarkReport(Report):
+    """Class representing a report of synthetic rows."""
+
+    def __init__(self, request, columns, data):
+        """Constructor.
+
+        Args:
+            request: gluon.globals.Request object instance
+            columns: list of tuples for defining columns, see Report.
+            data: list of dicts, the report rows.
+        """
+        self.data = data
+        Report.__init__(self, request, 'benchmark', None, columns,
+                ['row_odd', 'row_even'])
+
+    def rows(self, page, items_per_page, order_by, order_dir, query=None):
+        start = page * items_per_page
+        return self.data[start:start + items_per_page]
+
+    def sql_query(self):
+        pass
+
+
+def helper_render(report, rows):
+    """Return the HTML of rows built with gluon.html helpers.
+
+    Args:
+        report: Report object instance
+        rows: list of dicts, the report rows.
+
+    Returns:
+        string, HTML
+    """
+    html = []
+    for i, row in enumerate(rows):
+        tds = []
+        for column in report.column_set.sorted():
+            if callable(column['callback']):
+                formatted = column['callback'](row)
+            else:
+                formatted = row
+                try:
+                    for f in column['callback'].split('.'):
+                        formatted = formatted[f]
+                except KeyError:
+                    formatted = 'n/a'
+            if not str(formatted) or formatted == None:
+                formatted = column['empty'] or XML('&nbsp;')
+            column_class = 'results_table_cell col_{name}'.format(
+                    name=column['order_by'].replace('.', '_'))
+            tds.append(TD(formatted, _class=column_class))
+        tr_class = report.row_classes[i % len(report.row_classes)]
+        html.append(TR(tds, _class=tr_class).xml())
+    return ''.join(html)
+
+
+def compiled_render(report, rows):
+    """Return the HTML of rows rendered with Report.row_renderer().
+
+    Args:
+        report: Report object instance
+        rows: list of dicts, the report rows.
+
+    Returns:
+        string, HTML
+    """
+    html = []
+    render = report.row_renderer()
+    write = html.append
+    for i, row in enumerate(rows):
+        render(write, row, i)
+    return ''.join(html)
+
+
+def run(options):
+    """Time the renderers and print the results.
+
+    Args:
+        options: optparse options, see main().
+    """
+    columns = []
+    for c in range(options.columns):
+        if c % 3 == 2:
+            callback = lambda row, c=c: A(row['client']['f{c}'.format(c=c)],
+                    _href='/client?id={i}'.format(i=row['client']['id']))
+            columns.append(('Link {c}'.format(c=c), callback, '', None))
+        else:
+            columns.append(('Field {c}'.format(c=c),
+                'client.f{c}'.format(c=c), 'client.f{c}'.format(c=c), 0))
+    data = []
+    for r in range(options.rows):
+        client = {'id': r}
+        for c in range(options.columns):
+            client['f{c}'.format(c=c)] = 'Value <{r}> & {c}'.format(r=r, c=c)
+        data.append({'client': client})
+
+    request = Request()
+    request.application = 'shared'
+    report = BenchmarkReport(request, columns, data)
+
+    if helper_render(report, data) != compiled_render(report, data):
+        print 'ERROR: HTML of the renderers differs.'
+        sys.exit(1)
+
+    for (name, renderer) in [('helpers', helper_render),
+                             ('row_renderer', compiled_render)]:
+        start = time.time()
+        for _ in range(options.repeat):
+            renderer(report, data)
+        seconds = time.time() - start
+        per_row = seconds / (options.repeat * options.rows) * 1000000
+        print '{n:<14} {s:.3f} s  {p:.1f} us/row'.format(n=name, s=seconds,
+                p=per_row)
+
+    start = time.time()
+    for _ in range(options.repeat):
+        report.report({'items_per_page': min(options.rows, 100)})
+    seconds = time.time() - start
+    print '{n:<14} {s:.3f} s  {p:.1f} ms/report'.format(n='report()',
+            s=seconds, p=seconds / options.repeat * 1000)
+
+
+def main():
+    """ Main routine. """
+
+    usage = '%prog [options]' + '\nVersion: %s' % VERSION
+    parser = OptionParser(usage=usage)
+
+    parser.add_option('-c', '--columns', type='int', dest='columns',
+                      default=10,
+                      help='Number of columns. Default 10.',
+                      )
+    parser.add_option('-n', '--repeat', type='int', dest='repeat',
+                      default=100,
+                      help='Number of times the rows are rendered. '
+                           'Default 100.',
+                      )
+    parser.add_option('-r', '--rows', type='int', dest='rows',
+                      default=100,
+                      help='Number of rows. Default 100.',
+                      )
+
+    (options, unused_args) = parser.parse_args(sys.argv[1:])
+    run(options)
+
+if __name__ == '__main__':
+    main()
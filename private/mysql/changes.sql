@@ -47,3 +47,14 @@ ALTER IGNORE TABLE setting ADD column created_on datetime DEFAULT NULL;
 ALTER IGNORE TABLE setting ADD column updated_on datetime DEFAULT NULL;
 ALTER IGNORE TABLE test ADD column created_on datetime DEFAULT NULL;
 ALTER IGNORE TABLE test ADD column updated_on datetime DEFAULT NULL;
+ALTER IGNORE TABLE job ADD column worker varchar(255) DEFAULT NULL;
+ALTER IGNORE TABLE job ADD column lease_expires datetime DEFAULT NULL;
+ALTER IGNORE TABLE job ADD INDEX status_priority (status, priority);
+ALTER IGNORE TABLE job ADD column exit_status int(11) DEFAULT NULL;
+ALTER IGNORE TABLE job ADD column stdout text;
+ALTER IGNORE TABLE job ADD column stderr text;
+ALTER IGNORE TABLE job ADD column queued_on datetime DEFAULT NULL;
+ALTER IGNORE TABLE job ADD column claimed_on datetime DEFAULT NULL;
+ALTER IGNORE TABLE job ADD column started_on datetime DEFAULT NULL;
+ALTER IGNORE TABLE job ADD column finished_on datetime DEFAULT NULL;
+ALTER IGNORE TABLE job ADD INDEX finished_on (finished_on);
@@ -10,22 +10,31 @@ Test suite for shared/modules/db/table.py
 # The accounting database is use for testing
 from applications.shared.modules.test_runner import LocalTestSuite, \
     ModuleTestSuite
-from applications.shared.modules.database import Collection, DbIOError, \
-    DbObject, rows_to_objects
+from applications.shared.modules.database import Collection, CompactRow, \
+    DbIOError, DbObject, MemoryCacheBackend, ObjectCache, ObjectList, \
+    QueryCache, SqliteCacheBackend, TableMeta, can_roll_back_unit, chunks, \
+    commit, compact_class, in_unit_of_work, object_caches, query_caches, \
+    rows_to_objects, set_object_cache, set_query_cache, table_changed, \
+    table_meta, unit_of_work
 import cStringIO
 import copy
 import datetime
 import decimal
 import gluon.main               # Sets up logging (if logging in module)
+import os
 import re
+import shutil
 import sys
+import tempfile
 import time
 import unittest
+import weakref
 
 # C0111: *Missing docstring*
 # R0904: *Too many public methods (%s/%s)*
 # pylint: disable=C0111,R0904
 
+from gluon.dal import DAL, Field
 from gluon.shell import env
 
 # The test script requires an existing database to work with. The shared
@@ -253,6 +262,193 @@ class TestCollection(unittest.TestCase):
         self.assertTrue(t2.remove())  # Remove test object 2
         return
 
+    def test__bulk_add(self):
+        DBH.test.truncate()
+        DBH.commit()
+
+        objects = []
+        for i in range(0, 7):
+            objects.append(DbObject(DBH.test, company_id=COMPANY_ID,
+                number=NUMBER + i, name='{n}_{i}'.format(n=NAME, i=i)))
+        # Leave status unset on one so it gets the column default.
+        objects[3].status = None
+        c = Collection(DBH.test)
+        self.assertTrue(c.bulk_add(objects, chunk_size=3))
+        self.assertEqual(len(c.objects), 7)  # All objects added
+        self.assertEqual(c.errors, [])  # No errors
+        ids = [x.id for x in c.objects]
+        self.assertTrue(all(ids))  # Ids are set
+        self.assertEqual(len(set(ids)), 7)  # Ids are unique
+        for obj in c.objects:
+            # Each object matches its record
+            self.assertEqual(obj, Collection(DBH.test).get(id=obj.id)[0])
+            # Timestamps are set
+            self.assertTrue(isinstance(obj.created_on, datetime.datetime))
+            self.assertTrue(isinstance(obj.updated_on, datetime.datetime))
+        # Column DEFAULT is read back
+        self.assertEqual(c.objects[3].status, 'a')
+        self.assertEqual(len(Collection(DBH.test).get()), 7)
+
+        # A bad record is reported, the rest of the batch is added.
+        DBH.test.truncate()
+        DBH.commit()
+        bad = DbObject(DBH.test, company_id=COMPANY_ID,
+                number='_bad_number_')
+        objects = [
+            DbObject(DBH.test, company_id=COMPANY_ID, number=NUMBER),
+            bad,
+            DbObject(DBH.test, company_id=COMPANY_ID, number=NUMBER_2),
+            ]
+        c = Collection(DBH.test).bulk_add(objects)
+        self.assertEqual(len(c.objects), 2)
+        self.assertEqual(len(c.errors), 1)
+        self.assertEqual(c.errors[0][0], bad)
+        self.assertTrue(isinstance(c.errors[0][1], DbIOError))
+        self.assertEqual(len(Collection(DBH.test).get()), 2)
+
+        # Empty list
+        c = Collection(DBH.test).bulk_add([])
+        self.assertEqual(len(c.objects), 0)
+
+        # Multi-row inserts are used only if their ids are consecutive.
+        mode = DBH.executesql('SELECT @@innodb_autoinc_lock_mode;')[0][0]
+        self.assertEqual(Collection(DBH.test)._consecutive_ids(),
+                mode in [0, 1])
+        db = DAL('sqlite:memory:')
+        db.define_table('consecutive', Field('name'))
+        self.assertTrue(Collection(db.consecutive)._consecutive_ids())
+        # Otherwise, records are inserted one at a time.
+        DBH.test.truncate()
+        DBH.commit()
+        c = Collection(DBH.test)
+        c._consecutive_ids = lambda: False
+        objects = [DbObject(DBH.test, company_id=COMPANY_ID, number=x)
+                for x in [NUMBER, NUMBER_2]]
+        self.assertEqual(len(c.bulk_add(objects).objects), 2)
+        for obj in c.objects:
+            self.assertEqual(obj, Collection(DBH.test).get(id=obj.id)[0])
+
+        DBH.test.truncate()
+        DBH.commit()
+        return
+
+    def test__bulk_modify(self):
+        DBH.test.truncate()
+        DBH.commit()
+
+        t = self._obj(number=1)
+        t2 = self._obj(number=2)
+        original_updated_on = t.updated_on
+        time.sleep(1)  # Pause one sec so the modified date will change
+
+        t.name = NAME_2
+        t2.name = NAME
+        t2.start_date = None
+        missing = DbObject(DBH.test, id=999999, name=NAME)
+        no_id = DbObject(DBH.test, name=NAME)
+        c = Collection(DBH.test).bulk_modify([t, missing, t2, no_id],
+                chunk_size=2)
+        self.assertEqual(c.objects, [t, t2])  # Existing records modified
+        self.assertEqual(len(c.errors), 2)  # Missing records reported
+        self.assertEqual([x[0] for x in c.errors], [missing, no_id])
+
+        got = Collection(DBH.test).get(id=t.id).first()
+        self.assertEqual(got.name, NAME_2)
+        self.assertEqual(got.number, NUMBER)  # Other fields unchanged
+        self.assertNotEqual(got.updated_on, original_updated_on)
+        got = Collection(DBH.test).get(id=t2.id).first()
+        self.assertEqual(got.name, NAME)
+        self.assertEqual(got.start_date, None)
+
+        # Objects with no dirty fields are not written.
+        updated_on = got.updated_on
+        c = Collection(DBH.test).bulk_modify([got])
+        self.assertEqual(c.objects, [got])
+        self.assertEqual(got.updated_on, updated_on)
+
+        DBH.test.truncate()
+        DBH.commit()
+        return
+
+    def test__bulk_upsert(self):
+        DBH.test.truncate()
+        DBH.commit()
+
+        t = self._obj(number=1)
+        original_created_on = t.created_on
+        time.sleep(1)  # Pause one sec so the timestamps will change
+
+        def upsert_objects():
+            return [
+                DbObject(DBH.test, company_id=COMPANY_ID, number=NUMBER,
+                    name=NAME_2, created_on=datetime.datetime(2001, 1, 1)),
+                DbObject(DBH.test, company_id=COMPANY_ID, number=NUMBER_2,
+                    name=NAME),
+                ]
+
+        # Keyed on number, no unique index, existing keys read first
+        c = Collection(DBH.test)
+        self.assertFalse(c._native_upsert(['number']))
+        objects = upsert_objects()
+        self.assertEqual(c.bulk_upsert(objects, ['number']), c)
+        self.assertEqual(c.objects, objects)
+        self.assertEqual(c.errors, [])
+        self.assertEqual(objects[0].id, t.id)  # Existing record updated
+        self.assertTrue(objects[1].id)  # New record added
+        self.assertEqual(len(Collection(DBH.test).get()), 2)
+        got = Collection(DBH.test).get(id=t.id).first()
+        self.assertEqual(got.name, NAME_2)
+        self.assertEqual(got.amount, AMOUNT)  # None values are not written
+        self.assertEqual(got.created_on, original_created_on)  # Not updated
+        self.assertNotEqual(got.updated_on, t.updated_on)
+        got = Collection(DBH.test).get(id=objects[1].id).first()
+        self.assertEqual(got.name, NAME)
+        self.assertTrue(got.created_on)
+        for obj in objects:
+            self.assertEqual(obj.dirty_fields(), [])
+
+        # Last object wins if keys repeat.
+        objects = upsert_objects()
+        objects[1].number = NUMBER
+        c.bulk_upsert(objects, ['number'])
+        self.assertEqual(len(Collection(DBH.test).get()), 2)
+        self.assertEqual(Collection(DBH.test).get(id=t.id).first().name,
+                NAME)
+
+        # Keyed on several fields, records match on all of them.
+        objects = upsert_objects()
+        objects[0].name = '__company__'
+        objects[1].company_id = COMPANY_ID_2
+        objects[1].number = NUMBER
+        c.bulk_upsert(objects, ['company_id', 'number'])
+        self.assertEqual(objects[0].id, t.id)
+        self.assertNotEqual(objects[1].id, t.id)
+        self.assertEqual(Collection(DBH.test).get(id=t.id).first().name,
+                '__company__')
+        self.assertEqual(len(Collection(DBH.test).get()), 3)
+        objects[1].remove()
+
+        # Keyed on id, single statement upsert
+        self.assertTrue(c._native_upsert(['id']))
+        t.name = '__upsert__'
+        new = DbObject(DBH.test, id=t.id + 1000, company_id=COMPANY_ID,
+                number=NUMBER_2, name='__upsert_new__')
+        no_key = DbObject(DBH.test, company_id=COMPANY_ID, name=NAME)
+        c = Collection(DBH.test).bulk_upsert([t, new, no_key], ['id'])
+        self.assertEqual(c.objects, [t, new])
+        self.assertEqual([x[0] for x in c.errors], [no_key])
+        self.assertEqual(Collection(DBH.test).get(id=t.id).first().name,
+                '__upsert__')
+        self.assertEqual(Collection(DBH.test).get(id=new.id).first().name,
+                '__upsert_new__')
+        self.assertEqual(
+            Collection(DBH.test).get(id=t.id).first().created_on,
+            original_created_on)
+
+        DBH.test.truncate()
+        DBH.commit()
+        return
+
     def test__export_as_csv(self):
         output = cStringIO.StringIO()
         Collection(DBH.test).export_as_csv(out=output)
@@ -329,6 +525,19 @@ class TestCollection(unittest.TestCase):
             ), output.getvalue())
         output.close()
 
+        # With objects iterator. Output matches the objects property.
+        expect = cStringIO.StringIO()
+        Collection(DBH.test, objects=[t, t2]).export_as_csv(out=expect)
+        output = cStringIO.StringIO()
+        c = Collection(DBH.test)
+        query = DBH.test.company_id == COMPANY_ID
+        c.export_as_csv(out=output, objects=c.iter(query=query,
+                        chunk_size=1))
+        self.assertEqual(output.getvalue(), expect.getvalue())
+        self.assertEqual(len(c.objects), 0)  # Objects property not used
+        output.close()
+        expect.close()
+
         self.assertTrue(t.remove())  # Remove test object
         self.assertTrue(t2.remove())  # Remove test object 2
         return
@@ -432,6 +641,141 @@ class TestCollection(unittest.TestCase):
 
         self.assertTrue(t.remove())  # Remove test object
         self.assertTrue(t2.remove())  # Remove test object 2
+
+        # Mutable values changed in place are saved.
+        db = DAL('sqlite:memory:')
+        db.define_table('tagged', Field('tags', 'list:string'))
+        tagged = DbObject(db.tagged, tags=['a'])
+        tagged.add()
+        got = Collection(db.tagged).get(id=tagged.id).first()
+        got.tags.append('b')
+        self.assertEqual(got.dirty_fields(), ['tags'])
+        self.assertTrue(got.modify())
+        self.assertEqual(db.tagged[tagged.id].tags, ['a', 'b'])
+        got = list(Collection(db.tagged).iter())[0]
+        got.tags.append('c')
+        self.assertEqual(got.dirty_fields(), ['tags'])
+        return
+
+    def _index_objects(self):
+        return [
+            DbObject(DBH.test, id=1, number=NUMBER, name=NAME, status='a'),
+            DbObject(DBH.test, id=2, number=NUMBER, name=NAME_2, status='a'),
+            DbObject(DBH.test, id=3, number=NUMBER_2, name=NAME, status='d'),
+            ]
+
+    def test__group_by(self):
+        objects = self._index_objects()
+        c = Collection(DBH.test, objects=objects)
+        self.assertEqual(c.group_by('number'), {
+            NUMBER: [objects[0], objects[1]],
+            NUMBER_2: [objects[2]],
+            })
+        # Changing the result does not change the cached index.
+        groups = c.group_by('number')
+        groups[NUMBER].append(objects[2])
+        del groups[NUMBER_2]
+        self.assertEqual(c.index('number'), {
+            NUMBER: [objects[0], objects[1]],
+            NUMBER_2: [objects[2]],
+            })
+        self.assertEqual(c.group_by(('number', 'status')), {
+            (NUMBER, 'a'): [objects[0], objects[1]],
+            (NUMBER_2, 'd'): [objects[2]],
+            })
+        self.assertEqual(c.group_by(lambda x: x.name[:8]), {
+            NAME[:8]: objects})
+        self.assertEqual(Collection(DBH.test).group_by('number'), {})
+
+    def test__index(self):
+        objects = self._index_objects()
+        c = Collection(DBH.test, objects=objects)
+        index = c.index('status')
+        self.assertEqual(index, {'a': objects[:2], 'd': objects[2:]})
+        self.assertTrue(c.index('status') is index)  # Cached
+        self.assertEqual(c.index(('status', )),
+                {('a', ): objects[:2], ('d', ): objects[2:]})
+        self.assertEqual(c.index('id', unique=True),
+                {1: objects[0], 2: objects[1], 3: objects[2]})
+        self.assertRaises(ValueError, c.index, 'status', unique=True)
+
+        # Changing the objects rebuilds the index.
+        new = DbObject(DBH.test, id=4, status='d')
+        c.objects.append(new)
+        self.assertEqual(c.index('status')['d'], [objects[2], new])
+        c.objects.remove(new)
+        self.assertEqual(c.index('status')['d'], [objects[2]])
+        c.objects[0] = new
+        self.assertEqual(c.index('status')['d'], [new, objects[2]])
+        c.objects = objects[:1]
+        self.assertEqual(c.index('status'), {'a': objects[:1]})
+
+        # get() rebuilds the index
+        DBH.test.truncate()
+        DBH.commit()
+        t = self._obj(number=1)
+        c.get()
+        self.assertEqual(c.index('id', unique=True), {t.id: t})
+        DBH.test.truncate()
+        DBH.commit()
+
+    def test__index_by(self):
+        objects = self._index_objects()
+        c = Collection(DBH.test, objects=objects)
+        self.assertEqual(c.index_by('id'),
+                {1: objects[0], 2: objects[1], 3: objects[2]})
+        self.assertEqual(c.index_by('id'), c.as_dict())
+        # Changing the result does not change the cached index.
+        index = c.index_by('id')
+        del index[1]
+        self.assertEqual(len(c.index('id', unique=True)), 3)
+        self.assertEqual(c.index_by(('number', 'name')), {
+            (NUMBER, NAME): objects[0],
+            (NUMBER, NAME_2): objects[1],
+            (NUMBER_2, NAME): objects[2],
+            })
+        self.assertEqual(c.index_by(lambda x: x.id * 10),
+                {10: objects[0], 20: objects[1], 30: objects[2]})
+        self.assertRaises(ValueError, c.index_by, 'number')
+        self.assertRaises(ValueError, c.index_by, lambda x: x.number)
+
+    def test__iter(self):
+        DBH.test.truncate()
+        DBH.commit()
+        c = Collection(DBH.test)
+        self.assertEqual(list(c.iter()), [])  # Empty table
+
+        objects = []
+        for i in range(0, 7):
+            objects.append(DbObject(DBH.test, company_id=COMPANY_ID,
+                number=NUMBER + i, name='{n}_{i}'.format(n=NAME, i=i)))
+        self.assertEqual(len(c.bulk_add(objects).objects), 7)
+        c = Collection(DBH.test)
+
+        # Chunk sizes smaller, equal and larger than the number of records
+        for chunk_size in [1, 2, 3, 7, 100]:
+            got = list(c.iter(chunk_size=chunk_size))
+            self.assertEqual(got, objects)
+        self.assertTrue(isinstance(got[0], DbObject))
+
+        # Generator is lazy
+        gen = c.iter(chunk_size=2)
+        self.assertEqual(gen.next(), objects[0])
+        self.assertEqual(gen.next(), objects[1])
+
+        # Test with query
+        query = DBH.test.number >= NUMBER + 4
+        self.assertEqual(list(c.iter(query=query, chunk_size=2)),
+                objects[4:])
+        query = DBH.test.name == '__fake__'
+        self.assertEqual(list(c.iter(query=query)), [])
+        # Empty string query returns no objects
+        self.assertEqual(list(c.iter(query='')), [])
+        # The objects property is not changed.
+        self.assertEqual(len(c.objects), 0)
+
+        DBH.test.truncate()
+        DBH.commit()
         return
 
     def test__last(self):
@@ -481,6 +825,86 @@ class TestCollection(unittest.TestCase):
         return
 
 
+class TestCompactRow(unittest.TestCase):
+
+    def setUp(self):
+        DBH.test.truncate()
+        DBH.commit()
+        self.t = DbObject(DBH.test, company_id=COMPANY_ID_2, number=NUMBER,
+                name=NAME, amount=AMOUNT, start_date=START_DATE,
+                status=STATUS).add()
+        self.c = Collection(DBH.test, compact=True)
+
+    def tearDown(self):
+        DBH.test.truncate()
+        DBH.commit()
+
+    def test____init__(self):
+        row = compact_class(DBH.test)(name=NAME)
+        self.assertTrue(isinstance(row, CompactRow))
+        self.assertEqual(row.name, NAME)
+        self.assertEqual(row.amount, DBH.test.amount.default)  # Default set
+        self.assertFalse(hasattr(row, '__dict__'))  # Slots only
+        self.assertRaises(AttributeError, setattr, row, 'fake_field', 1)
+
+    def test____copy__(self):
+        row = self.c.get(id=self.t.id).first()
+        row_copy = copy.copy(row)
+        self.assertFalse(row_copy is row)
+        self.assertEqual(row_copy, row)
+        self.assertEqual(copy.deepcopy(row), row)
+
+    def test____eq__(self):
+        row = self.c.get(id=self.t.id).first()
+        self.assertEqual(row, self.t)  # Matches DbObject
+        self.assertEqual(self.t, row)  # DbObject matches
+        row.name = NAME_2
+        self.assertNotEqual(row, self.t)
+        self.assertNotEqual(self.t, row)
+
+    def test__as_dict(self):
+        row = self.c.get(id=self.t.id).first()
+        self.assertEqual(row.as_dict(), self.t.as_dict())
+
+    def test__as_list(self):
+        row = self.c.get(id=self.t.id).first()
+        self.assertEqual(row.as_list(), self.t.as_list())
+
+    def test__as_object(self):
+        row = self.c.get(id=self.t.id).first()
+        obj = row.as_object()
+        self.assertTrue(isinstance(obj, DbObject))
+        self.assertEqual(obj, self.t)
+        self.assertTrue(obj.db_ is DBH)
+
+        row = Collection(DBH.company, class_=Company,
+                compact=True).get(id=COMPANY_ID).first()
+        if row:
+            self.assertTrue(isinstance(row.as_object(), Company))
+
+    def test__export_as_csv(self):
+        row = self.c.get(id=self.t.id).first()
+        self.assertEqual(str(row), str(self.t))
+        output = cStringIO.StringIO()
+        self.c.export_as_csv(out=output)
+        expect = cStringIO.StringIO()
+        Collection(DBH.test, objects=[self.t]).export_as_csv(out=expect)
+        self.assertEqual(output.getvalue(), expect.getvalue())
+
+    def test__modify(self):
+        row = self.c.get(id=self.t.id).first()
+        row.name = NAME_2
+        obj = row.modify()
+        self.assertTrue(isinstance(obj, DbObject))  # Upgraded
+        self.assertEqual(Collection(DBH.test).get(id=self.t.id).first().name,
+                NAME_2)
+
+    def test__remove(self):
+        row = self.c.get(id=self.t.id).first()
+        self.assertTrue(row.remove())
+        self.assertEqual(len(self.c.get(id=self.t.id)), 0)
+
+
 class TestDbIOError(unittest.TestCase):
 
     def test____init__(self):
@@ -849,6 +1273,44 @@ class TestDbObject(unittest.TestCase):
         t2.db_.commit()
         return
 
+    def test__dirty_fields(self):
+        t = DbObject(DBH.test)
+        t.tbl_.truncate()
+        t.db_.commit()
+
+        # Not read from the database, all fields are dirty.
+        t.name = NAME
+        t.number = NUMBER
+        t.status = STATUS
+        self.assertEqual(t.dirty_fields(),
+                [f for f in DBH.test.fields if f != 'id'])
+
+        t.add()
+        self.assertEqual(t.dirty_fields(), [])
+        t.name = NAME_2
+        t.number = NUMBER_2
+        self.assertEqual(t.dirty_fields(), ['number', 'name'])
+        t.modify()
+        self.assertEqual(t.dirty_fields(), [])
+
+        got = DbObject(DBH.test).set_.get(id=t.id).first()
+        self.assertEqual(got.dirty_fields(), [])
+        got.status = STATUS_2
+        self.assertEqual(got.dirty_fields(), ['status'])
+        self.assertEqual(copy.copy(got).dirty_fields(), ['status'])
+        got.status = STATUS
+        self.assertEqual(got.dirty_fields(), [])
+
+        # Mutable values changed in place are dirty.
+        got.name = ['a']
+        got._mark_clean()
+        got.name.append('b')
+        self.assertEqual(got.dirty_fields(), ['name'])
+
+        t.tbl_.truncate()
+        t.db_.commit()
+        return
+
     def test__export_as_csv(self):
         t = DbObject(DBH.test)
         t.tbl_.truncate()
@@ -929,6 +1391,42 @@ class TestDbObject(unittest.TestCase):
         # modified date is updated
         self.assertNotEqual(t.updated_on, original_updated_on)
 
+        # Only dirty fields are written.
+        t.db_.executesql("UPDATE test SET number = {n} WHERE id = {i};".format(
+            n=NUMBER_2, i=t.id))
+        t.db_.commit()
+        t.name = NAME
+        self.assertTrue(t.modify())
+        rows = t.db_.executesql("SELECT name, number FROM test;")
+        self.assertEqual(rows[0][0], NAME)
+        self.assertEqual(rows[0][1], NUMBER_2)  # Not overwritten
+        self.assertEqual(t.dirty_fields(), [])
+
+        # Nothing is written if no fields are dirty.
+        original_updated_on = t.updated_on
+        time.sleep(1)
+        self.assertTrue(t.modify())
+        self.assertEqual(t.updated_on, original_updated_on)
+        got = DbObject(DBH.test).set_.get(id=t.id).first()
+        self.assertEqual(got.updated_on, original_updated_on)
+
+        # Objects not read from the database write all fields.
+        t_2 = DbObject(DBH.test, id=t.id, name=NAME_2, number=NUMBER)
+        self.assertTrue(t_2.modify())
+        rows = t.db_.executesql("SELECT name, number FROM test;")
+        self.assertEqual(rows[0][0], NAME_2)
+        self.assertEqual(rows[0][1], NUMBER)
+
+        # Missing record
+        t_2.id = t.id + 1000
+        t_2.name = NAME
+        self.assertRaises(SyntaxError, t_2.modify)
+
+        # Missing record, no fields dirty
+        got.id = t.id + 1000
+        self.assertEqual(got.dirty_fields(), [])
+        self.assertRaises(SyntaxError, got.modify)
+
         t.tbl_.truncate()
         t.db_.commit()
         return
@@ -1121,7 +1619,512 @@ class TestDbObject(unittest.TestCase):
         return
 
 
+class TestMemoryCacheBackend(unittest.TestCase):
+
+    def test____init__(self):
+        backend = MemoryCacheBackend(size=10)
+        self.assertEqual(backend.size, 10)
+        self.assertEqual(len(backend.entries), 0)
+        self.assertEqual(backend.versions, {})
+
+    def test__clear(self):
+        backend = MemoryCacheBackend()
+        backend.set('a', 1)
+        backend.incr_version('t')
+        backend.clear()
+        self.assertEqual(backend.get('a'), None)
+        self.assertEqual(backend.get_version('t'), 1)
+
+    def test__get(self):
+        backend = MemoryCacheBackend(size=2)
+        self.assertEqual(backend.get('a'), None)
+        backend.set('a', 1)
+        backend.set('b', 2)
+        self.assertEqual(backend.get('a'), 1)
+        # 'b' is least recently used so it is evicted.
+        backend.set('c', 3)
+        self.assertEqual(backend.get('b'), None)
+        self.assertEqual(backend.get('a'), 1)
+        self.assertEqual(backend.get('c'), 3)
+
+    def test__get_version(self):
+        backend = MemoryCacheBackend()
+        self.assertEqual(backend.get_version('t'), 0)
+        backend.incr_version('t')
+        self.assertEqual(backend.get_version('t'), 1)
+
+    def test__incr_version(self):
+        backend = MemoryCacheBackend()
+        backend.incr_version('t')
+        backend.incr_version('t')
+        backend.incr_version('u')
+        self.assertEqual(backend.versions, {'t': 2, 'u': 1})
+
+    def test__set(self):
+        backend = MemoryCacheBackend(size=2)
+        backend.set('a', 1)
+        backend.set('a', 2)
+        self.assertEqual(backend.get('a'), 2)
+        backend.set('b', 3)
+        backend.set('c', 4)
+        self.assertEqual(list(backend.entries.keys()), ['b', 'c'])
+
+
+class TestObjectCache(unittest.TestCase):
+
+    def setUp(self):
+        DBH.test.truncate()
+        DBH.commit()
+        self.t = DbObject(DBH.test, number=NUMBER, name=NAME).add()
+
+    def tearDown(self):
+        set_object_cache(None)
+        set_object_cache(None, per_request=True)
+        DBH.test.truncate()
+        DBH.commit()
+
+    def test____init__(self):
+        cache = ObjectCache(size=10, ttl=60)
+        self.assertEqual(cache.size, 10)
+        self.assertEqual(cache.ttl, 60)
+        self.assertFalse(cache.identity_map)
+        self.assertEqual(len(cache), 0)
+
+    def test__get(self):
+        cache = ObjectCache()
+        self.assertEqual(cache.get(DBH.test, self.t.id), None)  # Miss
+        cache.set(self.t)
+        got = cache.get(DBH.test, self.t.id)
+        self.assertEqual(got, self.t)  # Hit
+        self.assertFalse(got is self.t)  # Not identity map, new instance
+        self.assertEqual(cache.get(DBH.test, str(self.t.id)), self.t)
+        self.assertEqual(cache.get(DBH.test, 'abc'), None)
+        self.assertTrue(isinstance(cache.get(DBH.test, self.t.id,
+                        class_=Company), Company))
+
+        # Identity map
+        cache = ObjectCache(identity_map=True)
+        cache.set(self.t)
+        self.assertTrue(cache.get(DBH.test, self.t.id) is self.t)
+        # Different class is a miss
+        self.assertEqual(cache.get(DBH.test, self.t.id, class_=Company),
+                None)
+
+        # Expired
+        cache = ObjectCache(ttl=1)
+        cache.set(self.t)
+        self.assertEqual(cache.get(DBH.test, self.t.id), self.t)
+        time.sleep(2)
+        self.assertEqual(cache.get(DBH.test, self.t.id), None)
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test__invalidate(self):
+        cache = ObjectCache()
+        t2 = DbObject(DBH.test, number=NUMBER_2, name=NAME_2).add()
+        cache.set(self.t)
+        cache.set(t2)
+        cache.invalidate(DBH.test, id=self.t.id)
+        self.assertEqual(cache.get(DBH.test, self.t.id), None)
+        self.assertEqual(cache.get(DBH.test, t2.id), t2)
+        cache.set(self.t)
+        cache.invalidate(DBH.test)
+        self.assertEqual(len(cache), 0)
+
+    def test__set(self):
+        cache = ObjectCache(size=2)
+        cache.set(DbObject(DBH.test))  # No id, ignored
+        self.assertEqual(len(cache), 0)
+        for i in range(1, 4):
+            cache.set(DbObject(DBH.test, id=i))
+        self.assertEqual(len(cache), 2)  # Least recently used discarded
+        self.assertEqual(cache.get(DBH.test, 1), None)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test__stats(self):
+        cache = ObjectCache()
+        cache.get(DBH.test, self.t.id)
+        cache.set(self.t)
+        cache.get(DBH.test, self.t.id)
+        cache.get(DBH.test, self.t.id)
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertAlmostEqual(stats['hit_rate'], 2.0 / 3)
+        self.assertEqual(stats['entries'], 1)
+
+    def test__collection(self):
+        # Collection and DbObject methods use and update the cache.
+        cache = ObjectCache()
+        set_object_cache(cache)
+        c = Collection(DBH.test)
+        self.assertEqual(c.get(id=self.t.id).first(), self.t)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(c.only(id=self.t.id).first(), self.t)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+        self.t.name = NAME_2
+        self.t.modify()
+        self.assertEqual(c.get(id=self.t.id).first().name, NAME_2)
+
+        t2 = DbObject(DBH.test, number=NUMBER_2).add()
+        self.assertEqual(cache.get(DBH.test, t2.id), t2)
+
+        self.t.remove()
+        self.assertEqual(len(c.get(id=self.t.id)), 0)
+
+        # Request cache is an identity map
+        request_cache = ObjectCache(identity_map=True)
+        set_object_cache(request_cache, per_request=True)
+        self.assertEqual(object_caches(), [request_cache, cache])
+        first = c.get(id=t2.id).first()
+        self.assertTrue(c.get(id=t2.id).first() is first)
+
+
+class TestObjectList(unittest.TestCase):
+
+    def test____init__(self):
+        objects = ObjectList()
+        self.assertEqual(objects, [])
+        self.assertEqual(objects.version, 0)
+        objects = ObjectList([1, 2])
+        self.assertEqual(objects, [1, 2])
+        self.assertEqual(objects.version, 0)
+
+    def test__version(self):
+        objects = ObjectList([3, 1, 2])
+        objects.append(4)
+        objects.extend([5])
+        objects.insert(0, 6)
+        objects.pop()
+        objects.remove(6)
+        objects.reverse()
+        objects.sort(reverse=True)
+        objects[0] = 7
+        del objects[0]
+        objects[0:1] = [8]
+        del objects[0:1]
+        objects += [9]
+        objects *= 1
+        self.assertTrue(isinstance(objects, ObjectList))
+        self.assertEqual(objects, [2, 1, 9])
+        self.assertEqual(objects.version, 13)
+
+
+class TestQueryCache(unittest.TestCase):
+
+    def setUp(self):
+        DBH.test.truncate()
+        DBH.commit()
+        self.t = DbObject(DBH.test, number=NUMBER, name=NAME).add()
+
+    def tearDown(self):
+        set_query_cache(None)
+        DBH.test.truncate()
+        DBH.commit()
+
+    def test____init__(self):
+        cache = QueryCache()
+        self.assertTrue(isinstance(cache.backend, MemoryCacheBackend))
+        self.assertEqual(cache.ttl, None)
+        backend = MemoryCacheBackend()
+        cache = QueryCache(backend=backend, ttl=60)
+        self.assertTrue(cache.backend is backend)
+        self.assertEqual(cache.ttl, 60)
+
+    def test__bump(self):
+        cache = QueryCache()
+        version = cache.version(DBH, 'test')
+        cache.bump(DBH, 'test')
+        self.assertEqual(cache.version(DBH, 'test'), version + 1)
+        self.assertEqual(cache.version(DBH, 'company'), 0)
+
+    def test__clear(self):
+        cache = QueryCache()
+        cache.set(DBH, 'SELECT 1;', 0, [{'id': 1}])
+        cache.clear()
+        self.assertEqual(cache.get(DBH, 'SELECT 1;', 0), None)
+
+    def test__get(self):
+        cache = QueryCache()
+        sql = 'SELECT test.id FROM test;'
+        self.assertEqual(cache.get(DBH, sql, 0), None)
+        cache.set(DBH, sql, 0, [{'id': 1}])
+        self.assertEqual(cache.get(DBH, sql, 0), [{'id': 1}])
+        # Entries of an older table version are not returned.
+        self.assertEqual(cache.get(DBH, sql, 1), None)
+
+        # Expired entries are not returned.
+        cache = QueryCache(ttl=-1)
+        cache.set(DBH, sql, 0, [{'id': 1}])
+        self.assertEqual(cache.get(DBH, sql, 0), None)
+
+    def test__key(self):
+        cache = QueryCache()
+        key = cache.key(DBH, 'SELECT 1;')
+        self.assertTrue(re.match(r'^[0-9a-f]{40}$', key))
+        self.assertEqual(cache.key(DBH, 'SELECT 1;'), key)
+        self.assertNotEqual(cache.key(DBH, 'SELECT 2;'), key)
+
+    def test__set(self):
+        cache = QueryCache(ttl=60)
+        cache.set(DBH, 'SELECT 1;', 3, [{'id': 1}])
+        version, expires, records = cache.backend.get(
+            cache.key(DBH, 'SELECT 1;'))
+        self.assertEqual(version, 3)
+        self.assertTrue(time.time() < expires <= time.time() + 60)
+        self.assertEqual(records, [{'id': 1}])
+
+    def test__stats(self):
+        cache = QueryCache()
+        self.assertEqual(cache.stats(),
+                {'hits': 0, 'misses': 0, 'hit_rate': 0.0})
+        cache.set(DBH, 'SELECT 1;', 0, [])
+        cache.get(DBH, 'SELECT 1;', 0)
+        cache.get(DBH, 'SELECT 2;', 0)
+        cache.get(DBH, 'SELECT 1;', 0)
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertAlmostEqual(stats['hit_rate'], 2.0 / 3)
+
+    def test__version(self):
+        cache = QueryCache()
+        self.assertEqual(cache.version(DBH, 'test'), 0)
+        cache.bump(DBH, 'test')
+        self.assertEqual(cache.version(DBH, 'test'), 1)
+
+    def test__version_key(self):
+        cache = QueryCache()
+        key = cache.version_key(DBH, 'test')
+        self.assertTrue(re.match(r'^[0-9a-f]{40}$', key))
+        self.assertNotEqual(cache.version_key(DBH, 'company'), key)
+
+    def test__collection(self):
+        # Collection.get(cached=True) reads through the cache and DbObject
+        # writes invalidate it.
+        cache = QueryCache()
+        set_query_cache(cache)
+        c = Collection(DBH.test)
+        query = (DBH.test.number == NUMBER)
+        self.assertEqual(c.get(query=query, cached=True).first(), self.t)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(c.get(query=query, cached=True).first(), self.t)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+        # Not cached unless requested
+        c.get(query=query)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+        self.t.name = NAME_2
+        self.t.modify()
+        self.assertEqual(c.get(query=query, cached=True).first().name,
+                NAME_2)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+        t2 = DbObject(DBH.test, number=NUMBER).add()
+        self.assertEqual(len(c.get(query=query, cached=True)), 2)
+
+        t2.remove()
+        self.assertEqual(len(c.get(query=query, cached=True)), 1)
+
+        c.bulk_add([DbObject(DBH.test, number=NUMBER)])
+        self.assertEqual(len(c.get(query=query, cached=True)), 2)
+
+        # Queries of more than one table are not cached.
+        stats = cache.stats()
+        c.get(query=(DBH.test.company_id == DBH.company.id), cached=True)
+        self.assertEqual(cache.stats(), stats)
+
+
+class TestSqliteCacheBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'query_cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test____init__(self):
+        backend = SqliteCacheBackend(self.filename, size=10)
+        self.assertEqual(backend.size, 10)
+        self.assertTrue(os.path.exists(self.filename))
+
+    def test__clear(self):
+        backend = SqliteCacheBackend(self.filename)
+        backend.set('a', 1)
+        backend.incr_version('t')
+        backend.clear()
+        self.assertEqual(backend.get('a'), None)
+        self.assertEqual(backend.get_version('t'), 1)
+
+    def test__get(self):
+        backend = SqliteCacheBackend(self.filename)
+        self.assertEqual(backend.get('a'), None)
+        value = (1, None, [{'id': 1, 'name': u'\xe9'}])
+        backend.set('a', value)
+        self.assertEqual(backend.get('a'), value)
+
+        # Entries are shared by backends of the same file.
+        other = SqliteCacheBackend(self.filename)
+        self.assertEqual(other.get('a'), value)
+
+    def test__get_version(self):
+        backend = SqliteCacheBackend(self.filename)
+        self.assertEqual(backend.get_version('t'), 0)
+        backend.incr_version('t')
+        self.assertEqual(backend.get_version('t'), 1)
+
+    def test__incr_version(self):
+        backend = SqliteCacheBackend(self.filename)
+        other = SqliteCacheBackend(self.filename)
+        backend.incr_version('t')
+        other.incr_version('t')
+        self.assertEqual(backend.get_version('t'), 2)
+        self.assertEqual(other.get_version('t'), 2)
+
+    def test__set(self):
+        backend = SqliteCacheBackend(self.filename, size=2)
+        backend.prune_every = 4
+        backend.set('a', 1)
+        backend.set('a', 2)
+        self.assertEqual(backend.get('a'), 2)
+        time.sleep(0.01)
+        backend.set('b', 3)
+        time.sleep(0.01)
+        # The fourth set prunes the oldest entries over size.
+        backend.set('c', 4)
+        self.assertEqual(backend.get('a'), None)
+        self.assertEqual(backend.get('b'), 3)
+        self.assertEqual(backend.get('c'), 4)
+
+
+class TestTableMeta(unittest.TestCase):
+
+    def test____init__(self):
+        meta = TableMeta(DBH.test)
+        self.assertEqual(meta.fields, tuple(DBH.test.fields))
+        self.assertEqual(meta.data_fields, tuple(DBH.test.fields[1:]))
+        self.assertEqual(meta.source_fields, DBH.test.fields)
+        self.assertFalse(meta.source_fields is DBH.test.fields)
+        # No table references, the meta is shared by requests.
+        self.assertFalse(hasattr(meta, 'tbl_'))
+        self.assertEqual(meta.created_fields, ('created_on', ))
+        self.assertEqual(meta.modified_fields, ('updated_on', ))
+        self.assertEqual(meta.timestamp_fields, ('created_on', 'updated_on'))
+
+    def test__values(self):
+        meta = TableMeta(DBH.test)
+        t = DbObject(DBH.test, name=NAME, number=NUMBER)
+        self.assertEqual(meta.values(t), tuple(t.as_list()))
+        row = compact_class(DBH.test)(name=NAME, number=NUMBER)
+        self.assertEqual(meta.values(row), meta.values(t))
+        del t.name
+        self.assertRaises(AttributeError, meta.values, t)
+
+
 class TestFunctions(unittest.TestCase):
+    def test__can_roll_back_unit(self):
+        self.assertTrue(can_roll_back_unit(DBH))
+        with unit_of_work(DBH):
+            self.assertEqual(can_roll_back_unit(DBH),
+                    DBH._dbname in ['mysql', 'postgres'])
+        self.assertTrue(can_roll_back_unit(DBH))
+
+    def test__chunks(self):
+        self.assertEqual(list(chunks([], 2)), [])
+        self.assertEqual(list(chunks([1, 2, 3], 5)), [[1, 2, 3]])
+        self.assertEqual(list(chunks([1, 2, 3, 4], 2)), [[1, 2], [3, 4]])
+        self.assertEqual(list(chunks(iter([1, 2, 3]), 2)), [[1, 2], [3]])
+
+    def test__commit(self):
+        self.assertTrue(commit(DBH))
+        with unit_of_work(DBH):
+            self.assertFalse(commit(DBH))
+        self.assertTrue(commit(DBH))
+
+    def test__compact_class(self):
+        row_class = compact_class(DBH.test)
+        self.assertTrue(issubclass(row_class, CompactRow))
+        self.assertEqual(row_class.__slots__, tuple(DBH.test.fields))
+        self.assertTrue(row_class.class_ is DbObject)
+        self.assertTrue(row_class._tbl_ref() is DBH.test)
+        self.assertTrue(row_class._db_ref() is DBH)
+        row = row_class(name=NAME)
+        self.assertTrue(row.tbl_ is DBH.test)
+        self.assertTrue(row.db_ is DBH)
+        # Classes are cached
+        self.assertTrue(compact_class(DBH.test) is row_class)
+        account_class = compact_class(DBH.account, class_=Account)
+        self.assertFalse(account_class is row_class)
+        self.assertTrue(account_class.class_ is Account)
+        # The table and database are not kept alive by the class.
+        self.assertTrue(isinstance(row_class._tbl_ref, weakref.ref))
+        self.assertTrue(isinstance(row_class._db_ref, weakref.ref))
+        self.assertFalse('tbl_' in row_class.__dict__)
+
+    def test__in_unit_of_work(self):
+        self.assertFalse(in_unit_of_work(DBH))
+        with unit_of_work(DBH):
+            self.assertTrue(in_unit_of_work(DBH))
+            with unit_of_work(DBH):
+                self.assertTrue(in_unit_of_work(DBH))
+            self.assertTrue(in_unit_of_work(DBH))
+        self.assertFalse(in_unit_of_work(DBH))
+
+    def test__query_caches(self):
+        self.assertEqual(query_caches(), [])
+        cache = QueryCache()
+        set_query_cache(cache)
+        self.assertEqual(query_caches(), [cache])
+        set_query_cache(None)
+        self.assertEqual(query_caches(), [])
+
+    def test__set_query_cache(self):
+        cache = QueryCache()
+        set_query_cache(cache)
+        self.assertTrue(query_caches()[0] is cache)
+        set_query_cache(None)
+        self.assertEqual(query_caches(), [])
+
+    def test__table_changed(self):
+        # No cache, no error
+        table_changed(DBH, DBH.test)
+
+        cache = QueryCache()
+        set_query_cache(cache)
+        table_changed(DBH, DBH.test)
+        self.assertEqual(cache.version(DBH, 'test'), 1)
+        self.assertEqual(cache.version(DBH, 'company'), 0)
+
+        # Inside a unit of work, the version is bumped again on exit.
+        with unit_of_work(DBH):
+            table_changed(DBH, DBH.test)
+            self.assertEqual(cache.version(DBH, 'test'), 2)
+        self.assertEqual(cache.version(DBH, 'test'), 3)
+        set_query_cache(None)
+
+    def test__table_meta(self):
+        meta = table_meta(DBH.test)
+        self.assertTrue(isinstance(meta, TableMeta))
+        self.assertTrue(table_meta(DBH.test) is meta)  # Cached
+        self.assertFalse(table_meta(DBH.account) is meta)
+        # Metadata is recomputed if the table changes.
+        meta.source_fields = DBH.test.fields[:-1]
+        self.assertFalse(table_meta(DBH.test) is meta)
+
+        # The tables of every request share the metadata.
+        meta = table_meta(DBH.test)
+        db = DAL('sqlite:memory:')
+        db.define_table('meta', Field('name'))
+        meta_2 = table_meta(db.meta)
+        db_2 = DAL('sqlite:memory:')
+        db_2.define_table('meta', Field('name'))
+        self.assertTrue(table_meta(db_2.meta) is meta_2)
+        self.assertEqual(meta_2.fields, ('id', 'name'))
+        self.assertTrue(table_meta(DBH.test) is meta)
+
     def test__rows_to_objects(self):
         db = DBH
         query = db.account.id > 0
@@ -1169,6 +2172,53 @@ class TestFunctions(unittest.TestCase):
             self.assertEqual(i['company'], company)
 
 
+    def test__unit_of_work(self):
+        DBH.test.truncate()
+        DBH.commit()
+
+        def names():
+            return sorted([x.name for x in Collection(DBH.test).get()])
+
+        # Writes are committed when the unit exits.
+        with unit_of_work(DBH) as db:
+            self.assertEqual(db, DBH)
+            t = DbObject(DBH.test, name='a', number=1111).add()
+            t.name = 'b'
+            t.modify()
+            DbObject(DBH.test, name='c', number=1111).add()
+        DBH.rollback()
+        self.assertEqual(names(), ['b', 'c'])
+
+        # Writes are rolled back on exception.
+        try:
+            with unit_of_work(DBH):
+                DbObject(DBH.test, name='d', number=1111).add()
+                t.remove()
+                raise ValueError('Rollback')
+        except ValueError:
+            pass
+        self.assertEqual(names(), ['b', 'c'])
+        self.assertFalse(in_unit_of_work(DBH))
+
+        # Nested units roll back only their own writes with savepoints.
+        if DBH._dbname == 'mysql':
+            with unit_of_work(DBH):
+                DbObject(DBH.test, name='e', number=1111).add()
+                try:
+                    with unit_of_work(DBH):
+                        DbObject(DBH.test, name='f', number=1111).add()
+                        raise ValueError('Rollback nested')
+                except ValueError:
+                    pass
+                with unit_of_work(DBH):
+                    DbObject(DBH.test, name='g', number=1111).add()
+            self.assertEqual(names(), ['b', 'c', 'e', 'g'])
+
+        DBH.test.truncate()
+        DBH.commit()
+        return
+
+
 def main():
 
     # Suite setup will already be called
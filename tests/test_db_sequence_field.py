@@ -101,6 +101,32 @@ class TestDbSequenceField(unittest.TestCase):
         self.assertEqual(seq.table._tablename, 'testy')
         self.assertEqual(seq.field.name, 'sequence')
 
+    def test_is_tidy(self):
+        seq = DbSequenceField(field=self.db_.testy.sequence)
+
+        # NULL values are not tidy
+        self.assertEqual(seq.is_tidy(), (False, self.records))
+
+        self.reset_list()
+        self.assertEqual(seq.is_tidy(), (True, self.records))
+
+        # Duplicates are not tidy
+        self.reset_list(sequences=[1, 2, 2, 4])
+        self.assertEqual(seq.is_tidy(), (False, self.records))
+
+        # Gaps are not tidy
+        self.reset_list(sequences=[1, 2, 3, 5])
+        self.assertEqual(seq.is_tidy(), (False, self.records))
+
+        # Not starting at 1 is not tidy
+        self.reset_list(sequences=[2, 3, 4, 5])
+        self.assertEqual(seq.is_tidy(), (False, self.records))
+
+        # Empty table is tidy
+        self.db_(self.db_.testy.id > 0).delete()
+        self.db_.commit()
+        self.assertEqual(seq.is_tidy(), (True, 0))
+
     def test_move(self):
 
         # Control - test that a reset returns expected
@@ -247,6 +273,23 @@ class TestDbSequenceField(unittest.TestCase):
         got = self.id_list()
         self.assertEqual(got, expect)
 
+        # untidy sequence is tidied before the move
+
+        self.reset_list(sequences=[10, 20, 20, 40])
+        seq.move(1, 'end')
+        expect = [2, 3, 4, 1]
+        got = self.id_list()
+        self.assertEqual(got, expect)
+        self.assertEqual(seq.is_tidy(), (True, self.records))
+
+        # the sequence stays tidy
+
+        self.reset_list()
+        seq.move(4, 2)
+        rows = self.db_().select(self.db_.testy.ALL,
+                                 orderby=self.db_.testy.sequence)
+        self.assertEqual([x.sequence for x in rows], [1, 2, 3, 4])
+
     def test_tidy(self):
 
         # if sequence = NULL, tidy sets sequences
@@ -277,6 +320,15 @@ class TestDbSequenceField(unittest.TestCase):
         count = self.db_(self.db_.testy.sequence == 1).count()
         self.assertEqual(count, 1)
 
+        # Ties go to the lower id, NULL values go last
+
+        self.reset_list(sequences=[2, 2, 1, 1])
+        self.db_(self.db_.testy.id == 1).update(sequence=None)
+        self.db_.commit()
+        self.assertEqual(seq.tidy(), self.records + 1)
+        self.assertEqual(self.id_list(), [3, 4, 2, 1])
+        self.assertEqual(seq.is_tidy(), (True, self.records))
+
         # Doesn't kak on an empty table
 
         self.db_(self.db_.testy.id > 0).delete()
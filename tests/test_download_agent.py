@@ -9,20 +9,359 @@ Test suite for shared/modules/download_agent.py
 
 from applications.shared.modules.test_runner import LocalTestSuite, \
     ModuleTestSuite
-from applications.shared.modules.download_agent import DownloadAgent, \
-    DynamicMozillaCookieJar, ErrorMessage
+from applications.shared.modules.download_agent import BatchDownloader, \
+    ConnectionPool, DownloadAgent, DynamicMozillaCookieJar, ErrorMessage, \
+    HttpCache, PooledHTTPHandler, PooledResponse, RetryPolicy, StreamDecoder
 from urllib2 import HTTPError, URLError
+import BaseHTTPServer
+import SocketServer
+import StringIO
+import cookielib
+import email.utils
+import gzip
+import httplib
+import json
 import os
 import re
 import shutil
 import socket
 import sys
+import tempfile
+import threading
+import time
 import unittest
+import urllib2
+import zlib
 
 # C0111: *Missing docstring*
 # R0904: *Too many public methods (%s/%s)*
 # pylint: disable=C0111,R0904
 
+LARGE_CONTENT = ''.join(['line {i}\n'.format(i=i) for i in range(30000)])
+
+
+class LocalHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Request handler of the local test server."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        # C0103: *Invalid name "%s" (should match %s)*
+        # pylint: disable=C0103
+        self.server.connections.add(self.client_address)
+        self.server.paths.append(self.path)
+        if self.path == '/sleep':
+            with self.server.lock:
+                self.server.active += 1
+                self.server.max_active = max(self.server.max_active,
+                        self.server.active)
+            time.sleep(0.2)
+            with self.server.lock:
+                self.server.active -= 1
+        length = int(self.headers.get('Content-Length', 0))
+        if length:
+            self.rfile.read(length)
+        if self.path == '/drop':
+            # Close the connection without a response.
+            self.close_connection = 1
+            return
+        body = 'path: {p}\ncookie: {c}\n'.format(p=self.path,
+                c=self.headers.get('Cookie', ''))
+        headers = {}
+        status = 200
+        if self.path in ['/gzip', '/large_gzip']:
+            if self.path == '/large_gzip':
+                body = LARGE_CONTENT
+            out = StringIO.StringIO()
+            gzip_file = gzip.GzipFile(fileobj=out, mode='wb')
+            gzip_file.write(body)
+            gzip_file.close()
+            body = out.getvalue()
+            headers['Content-Encoding'] = 'gzip'
+        elif self.path == '/deflate':
+            body = zlib.compress(body)
+            headers['Content-Encoding'] = 'deflate'
+        elif self.path in ['/range', '/no_range', '/bad_range']:
+            body = LARGE_CONTENT
+            headers['ETag'] = '"r1"'
+            match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+            if_range = self.headers.get('If-Range')
+            if match:
+                self.server.if_ranges.append(if_range)
+            if if_range not in [None, '"r1"']:
+                match = None
+            if self.path == '/bad_range' and match:
+                # Sends the content from the start.
+                status = 206
+                headers['Content-Range'] = 'bytes 0-{e}/{t}'.format(
+                    e=len(body) - 1, t=len(body))
+            elif self.path == '/range' and match:
+                offset = int(match.group(1))
+                if offset >= len(body):
+                    (status, body) = (416, '')
+                else:
+                    status = 206
+                    headers['Content-Range'] = 'bytes {o}-{e}/{t}'.format(
+                        o=offset, e=len(body) - 1, t=len(body))
+                    body = body[offset:]
+        elif self.path == '/cookie':
+            headers['Set-Cookie'] = 'test_cookie=abc; Path=/'
+        elif self.path == '/close':
+            headers['Connection'] = 'close'
+        elif self.path == '/redirect':
+            status = 302
+            headers['Location'] = '/page'
+        elif self.path == '/503':
+            status = 503
+        elif self.path == '/retry_after':
+            status = 503
+            headers['Retry-After'] = '2'
+        elif self.path == '/etag':
+            headers['ETag'] = '"v1"'
+            if self.headers.get('If-None-Match') == '"v1"':
+                (status, body) = (304, '')
+                headers['Cache-Control'] = 'max-age=60'
+        elif self.path == '/last_modified':
+            headers['Last-Modified'] = 'Sat, 01 Jan 2011 00:00:00 GMT'
+            if self.headers.get('If-Modified-Since') \
+                    == headers['Last-Modified']:
+                (status, body) = (304, '')
+        elif self.path == '/max_age':
+            headers['Cache-Control'] = 'max-age=60'
+        elif self.path == '/no_store':
+            headers['Cache-Control'] = 'no-store'
+            headers['ETag'] = '"v1"'
+        self.send_response(status)
+        headers['Content-Length'] = str(len(body))
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def do_CONNECT(self):
+        # C0103: *Invalid name "%s" (should match %s)*
+        # pylint: disable=C0103
+        # Act as a proxy tunneling to this server: later requests on the
+        # connection are served as if sent to the tunnel host.
+        self.server.tunnels.append((self.path,
+                self.headers.get('Proxy-Authorization')))
+        self.send_response(200, 'Connection established')
+        self.end_headers()
+        self.close_connection = 0   # CONNECT is sent as HTTP/1.0
+
+    def log_message(self, *args):
+        pass
+
+
+class RecordingRetryPolicy(RetryPolicy):
+    """Retry policy recording sleeps instead of sleeping."""
+
+    def __init__(self, **kwargs):
+        RetryPolicy.__init__(self, **kwargs)
+        self.sleeps = []
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
+class LocalServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP/1.1 server, on localhost, used for testing."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                LocalHandler)
+        self.connections = set()
+        self.paths = []         # Paths of requests
+        self.tunnels = []       # (host, Proxy-Authorization) of CONNECTs
+        self.if_ranges = []     # If-Range headers of range requests
+        self.lock = threading.Lock()
+        self.active = 0         # Number of /sleep requests in progress
+        self.max_active = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def handle_error(self, request, client_address):
+        # Connections closed by the tests while idle are expected.
+        pass
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{p}{path}'.format(p=self.server_port,
+                path=path)
+
+
+class TestBatchDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalServer()
+        self.pool = ConnectionPool()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test____init__(self):
+        downloader = BatchDownloader()
+        self.assertEqual(downloader.max_workers, BatchDownloader.max_workers)
+        self.assertEqual(downloader.rate, None)
+        self.assertEqual(downloader.agent_kwargs, {})
+        downloader = BatchDownloader(max_workers=3, max_host_workers=1,
+                rate=2, agent_kwargs={'retries': 1})
+        self.assertEqual(downloader.max_workers, 3)
+        self.assertEqual(downloader.max_host_workers, 1)
+        self.assertEqual(downloader.rate, 2)
+        self.assertEqual(downloader.agent_kwargs, {'retries': 1})
+
+    def test__agent(self):
+        downloader = BatchDownloader(agent_kwargs={'retries': 2})
+        agent = downloader.agent('http://www.example.com')
+        self.assertEqual(agent.url, 'http://www.example.com')
+        self.assertEqual(agent.post_data, None)
+        self.assertEqual(agent.retries, 2)
+        agent = downloader.agent(('http://www.example.com', {'a': 1}))
+        self.assertEqual(agent.url, 'http://www.example.com')
+        self.assertEqual(agent.post_data, {'a': 1})
+        da = DownloadAgent(url='http://www.example.com')
+        self.assertTrue(downloader.agent(da) is da)
+
+    def test__download(self):
+        downloader = BatchDownloader(max_workers=4, max_host_workers=2,
+                agent_kwargs={'pool': self.pool})
+        urls = [self.server.url('/sleep')] * 6
+        urls.append((self.server.url('/page'), {'a': 1}))
+        start = time.time()
+        results = list(downloader.download(urls))
+        self.assertTrue(time.time() - start >= 0.6)
+        self.assertEqual(sorted([x[0] for x in results]), range(7))
+        self.assertEqual(self.server.max_active, 2)
+        for (index, agent) in results:
+            self.assertEqual(agent.content, 'path: {p}\ncookie: \n'.format(
+                p='/page' if index == 6 else '/sleep'))
+            self.assertEqual(agent.errors, [])
+            self.assertTrue(agent.seconds >= 0)
+
+        # Errors are retried as classified by ErrorMessage.
+        downloader = BatchDownloader(agent_kwargs={'pool': self.pool,
+            'retries': 1})
+        results = list(downloader.download([self.server.url('/503'),
+            'http://127.0.0.1:1/']))
+        errors = dict((x[0], x[1].errors) for x in results)
+        self.assertEqual(errors[0][:2], ['HTTP error code: 503'] * 2)
+        self.assertEqual(len(errors[1]), 2)
+        self.assertTrue(errors[1][0].startswith("Can't connect"))
+
+        # Rate limit
+        downloader = BatchDownloader(max_host_workers=3, rate=10,
+                agent_kwargs={'pool': self.pool})
+        start = time.time()
+        results = list(downloader.download([self.server.url('/page')] * 3))
+        self.assertEqual(len(results), 3)
+        self.assertTrue(time.time() - start >= 0.2)
+
+        # Stop early
+        downloader = BatchDownloader(max_workers=1,
+                agent_kwargs={'pool': self.pool})
+        for (index, agent) in downloader.download(
+                [self.server.url('/page')] * 10):
+            break
+        self.assertTrue(downloader.stopped)
+
+        # Exceptions reading items or creating agents are raised.
+        def items():
+            yield self.server.url('/page')
+            raise KeyError('bad item')
+
+        downloader = BatchDownloader(agent_kwargs={'pool': self.pool})
+        self.assertRaises(KeyError, list, downloader.download(items()))
+        self.assertTrue(downloader.stopped)
+        downloader = BatchDownloader(agent_kwargs={'pool': self.pool})
+        self.assertRaises(ValueError, list, downloader.download(
+            [self.server.url('/page'), ('too', 'many', 'values')]))
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalServer()
+        self.key = ('http', '127.0.0.1:{p}'.format(p=self.server.server_port))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test____init__(self):
+        pool = ConnectionPool()
+        self.assertEqual(pool.max_connections,
+                ConnectionPool.max_connections)
+        pool = ConnectionPool(max_connections=2, max_idle=1)
+        self.assertEqual(pool.max_connections, 2)
+        self.assertEqual(pool.max_idle, 1)
+
+    def test__clear(self):
+        pool = ConnectionPool()
+        (connection, unused_reused) = pool.get(self.key)
+        connection.connect()
+        pool.release(self.key, connection)
+        self.assertEqual(pool.stats()['idle'], 1)
+        pool.clear()
+        self.assertEqual(pool.stats()['idle'], 0)
+        self.assertEqual(pool.stats()['connections'], 0)
+
+    def test__discard(self):
+        pool = ConnectionPool()
+        (connection, unused_reused) = pool.get(self.key)
+        self.assertEqual(pool.stats()['connections'], 1)
+        pool.discard(self.key, connection)
+        self.assertEqual(pool.stats()['connections'], 0)
+
+    def test__get(self):
+        pool = ConnectionPool(max_connections=1)
+        pool.wait_seconds = 0.1
+        (connection, reused) = pool.get(self.key, timeout=5)
+        self.assertFalse(reused)
+        self.assertEqual(connection.timeout, 5)
+        connection.connect()
+        # At the maximum
+        self.assertRaises(URLError, pool.get, self.key)
+        pool.release(self.key, connection)
+        (connection_2, reused) = pool.get(self.key)
+        self.assertTrue(reused)
+        self.assertTrue(connection_2 is connection)
+        pool.release(self.key, connection_2)
+
+        # Expired idle connections are closed.
+        pool.idle_seconds = -1
+        (connection_3, reused) = pool.get(self.key)
+        self.assertFalse(reused)
+        self.assertFalse(connection_3 is connection)
+
+    def test__release(self):
+        pool = ConnectionPool(max_idle=1)
+        (connection, unused_reused) = pool.get(self.key)
+        (connection_2, unused_reused) = pool.get(self.key)
+        # Not connected, not kept.
+        pool.release(self.key, connection)
+        self.assertEqual(pool.stats()['idle'], 0)
+        (connection, unused_reused) = pool.get(self.key)
+        connection.connect()
+        connection_2.connect()
+        pool.release(self.key, connection)
+        pool.release(self.key, connection_2)
+        # Over max_idle, not kept.
+        self.assertEqual(pool.stats()['idle'], 1)
+        self.assertEqual(pool.stats()['connections'], 1)
+
+    def test__stats(self):
+        pool = ConnectionPool()
+        self.assertEqual(pool.stats(), {'created': 0, 'reused': 0,
+            'connections': 0, 'idle': 0})
+
 
 class TestDownloadAgent(unittest.TestCase):
 
@@ -31,6 +370,316 @@ class TestDownloadAgent(unittest.TestCase):
         self.assertFalse(not da)
         return
 
+    def test__download_retry(self):
+        server = LocalServer()
+        pool = ConnectionPool()
+        host = '127.0.0.1:{p}'.format(p=server.server_port)
+        try:
+            # Exponential backoff
+            policy = RecordingRetryPolicy(jitter=0)
+            da = DownloadAgent(url=server.url('/503'), pool=pool,
+                    retries=3, retry_policy=policy)
+            da.download()
+            self.assertEqual(policy.sleeps, [1.0, 2.0, 4.0])
+            self.assertEqual(da.errors.count('HTTP error code: 503'), 4)
+
+            # Retry-After
+            policy = RecordingRetryPolicy(jitter=0)
+            da = DownloadAgent(url=server.url('/retry_after'), pool=pool,
+                    retries=2, retry_policy=policy)
+            da.download()
+            self.assertEqual(policy.sleeps, [2.0, 2.0])
+            policy = RecordingRetryPolicy(retry_after_max=1)
+            da = DownloadAgent(url=server.url('/retry_after'), pool=pool,
+                    retries=2, retry_policy=policy)
+            da.download()
+            self.assertEqual(policy.sleeps, [])
+
+            # Circuit breaker
+            policy = RecordingRetryPolicy(breaker_failures=2)
+            server.paths = []
+            da = DownloadAgent(url=server.url('/503'), pool=pool,
+                    retries=5, retry_policy=policy)
+            da.download()
+            self.assertEqual(server.paths, ['/503'] * 2)
+            self.assertTrue(
+                'ERROR: Downloads from {h} suspended, host failing.'.format(
+                    h=host) in da.errors)
+            self.assertFalse(policy.allow(host))
+            da = DownloadAgent(url=server.url('/page'), pool=pool,
+                    retry_policy=policy)
+            da.download()
+            self.assertEqual(da.content, None)
+            self.assertEqual(server.paths, ['/503'] * 2)
+            # Once the circuit closes, a success resets it.
+            policy.hosts[host][1] = 0
+            da.download()
+            self.assertEqual(da.content, 'path: /page\ncookie: \n')
+            self.assertEqual(policy.hosts, {})
+
+            # Read timeout
+            policy = RecordingRetryPolicy(read_timeout=0.05)
+            da = DownloadAgent(url=server.url('/sleep'), pool=pool,
+                    retries=1, retry_policy=policy)
+            da.download()
+            self.assertEqual(len(policy.sleeps), 1)
+            self.assertTrue('Timeout error' in da.errors)
+        finally:
+            server.stop()
+
+    def test__download_stream(self):
+        server = LocalServer()
+        pool = ConnectionPool()
+        tmp_dir = tempfile.mkdtemp()
+        filename = os.path.join(tmp_dir, 'download.txt')
+        try:
+            # Deflate
+            da = DownloadAgent(url=server.url('/deflate'), pool=pool)
+            da.download()
+            self.assertEqual(da.content, 'path: /deflate\ncookie: \n')
+
+            # Callback
+            chunks = []
+            da = DownloadAgent(url=server.url('/large_gzip'), pool=pool)
+            da.chunk_size = 8192
+            da.download(target=chunks.append)
+            self.assertEqual(da.content, None)
+            self.assertTrue(len(chunks) > 1)
+            self.assertTrue(max([len(x) for x in chunks]) <= 8192)
+            self.assertEqual(''.join(chunks), LARGE_CONTENT)
+
+            # File
+            with open(filename, 'wb') as f:
+                da = DownloadAgent(url=server.url('/large_gzip'), pool=pool)
+                da.download(target=f)
+            with open(filename, 'rb') as f:
+                self.assertEqual(f.read(), LARGE_CONTENT)
+
+            # Maximum size, checked against the Content-Length.
+            da = DownloadAgent(url=server.url('/range'), pool=pool)
+            da.download(max_bytes=1000)
+            self.assertEqual(da.content, None)
+            self.assertEqual(da.errors, [
+                'ERROR: Content of {u} exceeds 1000 bytes.'.format(
+                    u=server.url('/range'))])
+            # and against the decoded content.
+            chunks = []
+            da = DownloadAgent(url=server.url('/large_gzip'), pool=pool)
+            da.download(target=chunks.append, max_bytes=100000)
+            self.assertEqual(len(da.errors), 1)
+            self.assertTrue(len(''.join(chunks)) <= 100000)
+            da = DownloadAgent(url=server.url('/large_gzip'), pool=pool)
+            da.download(max_bytes=len(LARGE_CONTENT))
+            self.assertEqual(da.content, LARGE_CONTENT)
+            self.assertEqual(pool.stats()['connections'],
+                    pool.stats()['idle'])
+
+            # Resume
+            resume_filename = filename + '.resume'
+
+            def partial(path, size=1000, etag='"r1"'):
+                """Write a partial file and its validators."""
+                with open(filename, 'wb') as f:
+                    f.write(LARGE_CONTENT[:size])
+                with open(resume_filename, 'wb') as f:
+                    f.write(json.dumps({'url': server.url(path),
+                        'etag': etag, 'last_modified': None}))
+
+            for path in ['/range', '/no_range']:
+                partial(path)
+                with open(filename, 'r+b') as f:
+                    da = DownloadAgent(url=server.url(path), pool=pool,
+                            accept_encoding='gzip')
+                    da.download(target=f, resume=True)
+                self.assertEqual(da.errors, [])
+                self.assertEqual(da.response.code,
+                        206 if path == '/range' else 200)
+                with open(filename, 'rb') as f:
+                    self.assertEqual(f.read(), LARGE_CONTENT)
+                self.assertFalse(os.path.exists(resume_filename))
+            # Complete
+            partial('/range', size=len(LARGE_CONTENT))
+            with open(filename, 'r+b') as f:
+                da = DownloadAgent(url=server.url('/range'), pool=pool)
+                da.download(target=f, resume=True)
+                self.assertEqual(da.errors, [])
+            with open(filename, 'rb') as f:
+                self.assertEqual(f.read(), LARGE_CONTENT)
+            self.assertFalse(os.path.exists(resume_filename))
+            # Too large, the validators are kept for resuming.
+            partial('/range')
+            with open(filename, 'r+b') as f:
+                da = DownloadAgent(url=server.url('/range'), pool=pool)
+                da.download(target=f, resume=True,
+                        max_bytes=len(LARGE_CONTENT) - 1)
+            self.assertEqual(len(da.errors), 1)
+            self.assertTrue(os.path.exists(resume_filename))
+            server.if_ranges = []
+            with open(filename, 'r+b') as f:
+                da = DownloadAgent(url=server.url('/range'), pool=pool)
+                da.download(target=f, resume=True)
+            self.assertEqual(server.if_ranges, ['"r1"'])
+            self.assertEqual(da.response.code, 206)
+            with open(filename, 'rb') as f:
+                self.assertEqual(f.read(), LARGE_CONTENT)
+            self.assertFalse(os.path.exists(resume_filename))
+            # The validator no longer matches, the content is sent from the
+            # start.
+            partial('/range', etag='"r0"')
+            with open(filename, 'r+b') as f:
+                da = DownloadAgent(url=server.url('/range'), pool=pool)
+                da.download(target=f, resume=True)
+            self.assertEqual(server.if_ranges[-1], '"r0"')
+            self.assertEqual(da.response.code, 200)
+            with open(filename, 'rb') as f:
+                self.assertEqual(f.read(), LARGE_CONTENT)
+            self.assertFalse(os.path.exists(resume_filename))
+            # Without a strong validator, eg the validators are missing, of
+            # another url or a weak ETag, no range is requested, the file is
+            # downloaded from the start.
+            for validators in [None, '/no_range', '/range']:
+                partial(validators or '/range',
+                        etag='W/"r1"' if validators else '"r1"')
+                if not validators:
+                    os.remove(resume_filename)
+                with open(filename, 'r+b') as f:
+                    f.seek(500)
+                    f.write('changed')
+                server.if_ranges = []
+                with open(filename, 'r+b') as f:
+                    da = DownloadAgent(url=server.url('/range'), pool=pool)
+                    da.download(target=f, resume=True)
+                self.assertEqual(server.if_ranges, [])
+                self.assertEqual(da.response.code, 200)
+                with open(filename, 'rb') as f:
+                    self.assertEqual(f.read(), LARGE_CONTENT)
+            # The Content-Range does not continue the file.
+            partial('/bad_range')
+            with open(filename, 'r+b') as f:
+                da = DownloadAgent(url=server.url('/bad_range'), pool=pool)
+                da.download(target=f, resume=True)
+            self.assertEqual(da.errors, [])
+            with open(filename, 'rb') as f:
+                self.assertEqual(f.read(), LARGE_CONTENT)
+            self.assertFalse(os.path.exists(resume_filename))
+
+            da = DownloadAgent(url=server.url('/range'), pool=pool)
+            self.assertRaises(ValueError, da.download, target=chunks.append,
+                    resume=True)
+        finally:
+            server.stop()
+            shutil.rmtree(tmp_dir)
+
+    def test__download_local(self):
+        server = LocalServer()
+        pool = ConnectionPool()
+        try:
+            opener = urllib2._opener        # pylint: disable=W0212
+            da = DownloadAgent(url=server.url('/page'), pool=pool)
+            da.download()
+            self.assertEqual(da.content, 'path: /page\ncookie: \n')
+            # The global opener is not changed.
+            self.assertTrue(urllib2._opener is opener)  # pylint: disable=W0212
+
+            # Connections are reused across agents.
+            for path in ['/gzip', '/redirect', '/page']:
+                da = DownloadAgent(url=server.url(path), pool=pool)
+                da.download()
+            self.assertEqual(da.content, 'path: /page\ncookie: \n')
+            self.assertEqual(len(server.connections), 1)
+            self.assertEqual(pool.stats()['created'], 1)
+            self.assertEqual(pool.stats()['reused'], 4)
+
+            # Gzip
+            da = DownloadAgent(url=server.url('/gzip'), pool=pool)
+            da.download()
+            self.assertEqual(da.content, 'path: /gzip\ncookie: \n')
+
+            # Cookies
+            cookie_jar = cookielib.CookieJar()
+            da = DownloadAgent(url=server.url('/cookie'), pool=pool,
+                    cookie_jar=cookie_jar)
+            da.download()
+            da = DownloadAgent(url=server.url('/page'), pool=pool,
+                    cookie_jar=cookie_jar)
+            da.download()
+            self.assertEqual(da.content,
+                    'path: /page\ncookie: test_cookie=abc\n')
+
+            # POST
+            da = DownloadAgent(url=server.url('/page'), pool=pool,
+                    post_data={'a': 1})
+            da.download()
+            self.assertEqual(da.content, 'path: /page\ncookie: \n')
+
+            # HTTP errors free their connection.
+            da = DownloadAgent(url=server.url('/503'), pool=pool)
+            da.download()
+            self.assertEqual(da.errors[0], 'HTTP error code: 503')
+            stats = pool.stats()
+            self.assertEqual(stats['connections'], stats['idle'])
+
+            # Connection: close responses are not kept.
+            da = DownloadAgent(url=server.url('/close'), pool=pool)
+            da.download()
+            self.assertEqual(pool.stats()['idle'], 0)
+            self.assertEqual(pool.stats()['connections'], 0)
+        finally:
+            server.stop()
+
+    def test__download_cache(self):
+        server = LocalServer()
+        cache = HttpCache(tempfile.mkdtemp())
+        try:
+            def download(path, post_data=None):
+                da = DownloadAgent(url=server.url(path), cache=cache,
+                        post_data=post_data)
+                da.download()
+                return da
+
+            # Revalidated with If-None-Match
+            da = download('/etag')
+            self.assertFalse(da.cached)
+            self.assertEqual(da.content, 'path: /etag\ncookie: \n')
+            da = download('/etag')
+            self.assertTrue(da.cached)
+            self.assertEqual(da.errors, [])
+            self.assertEqual(da.content, 'path: /etag\ncookie: \n')
+            # The 304 made the entry fresh, no request is sent.
+            server.paths = []
+            da = download('/etag')
+            self.assertTrue(da.cached)
+            self.assertEqual(server.paths, [])
+
+            # Revalidated with If-Modified-Since
+            download('/last_modified')
+            da = download('/last_modified')
+            self.assertTrue(da.cached)
+            self.assertEqual(server.paths, ['/last_modified'] * 2)
+
+            # Fresh
+            download('/max_age')
+            da = download('/max_age')
+            self.assertTrue(da.cached)
+            self.assertEqual(server.paths.count('/max_age'), 1)
+
+            # Not cached
+            for path in ['/no_store', '/page']:
+                download(path)
+                da = download(path)
+                self.assertFalse(da.cached)
+            da = download('/etag', post_data={'a': 1})
+            self.assertFalse(da.cached)
+
+            stats = cache.stats()
+            self.assertEqual(stats['hits'], 4)
+            self.assertEqual(stats['misses'], 7)
+            self.assertEqual(stats['entries'], 3)
+            self.assertEqual(stats['bytes_saved'], 21 * 2 + 30 + 24)
+        finally:
+            server.stop()
+            shutil.rmtree(cache.path)
+
     def test_download(self):
         tests = [
             {
@@ -112,6 +761,390 @@ class TestDynamicMozillaCookieJar(unittest.TestCase):
         return
 
 
+class TestHttpCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = HttpCache(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.cache.path)
+
+    def _info(self, headers):
+        message = 'HTTP/1.1 200 OK\r\n' + ''.join(
+            ['{k}: {v}\r\n'.format(k=k, v=v) for (k, v) in headers.items()])
+        return httplib.HTTPMessage(StringIO.StringIO(message))
+
+    def test____init__(self):
+        self.assertEqual(self.cache.max_bytes, HttpCache.max_bytes)
+        path = os.path.join(self.cache.path, 'sub')
+        cache = HttpCache(path, max_bytes=100)
+        self.assertTrue(os.path.isdir(path))
+        self.assertEqual(cache.max_bytes, 100)
+
+    def test__attach(self):
+        url = 'http://www.example.com'
+        # No entry, not attached.
+        self.cache.attach(url, 'scrubbed', 'abc')
+        self.assertEqual(self.cache.attachment(url, 'scrubbed'), None)
+        self.cache.put(url, self._info({'ETag': '"1"'}), 'content')
+        self.cache.attach(url, 'scrubbed', 'abc')
+        self.assertEqual(self.cache.attachment(url, 'scrubbed'), 'abc')
+        self.assertEqual(self.cache.stats()['bytes'], 10)
+        self.cache.attach(url, 'scrubbed', 'abcd')
+        self.assertEqual(self.cache.stats()['bytes'], 11)
+        # Replacing the entry removes attachments.
+        self.cache.put(url, self._info({'ETag': '"2"'}), 'content')
+        self.assertEqual(self.cache.attachment(url, 'scrubbed'), None)
+
+    def test__clear(self):
+        self.cache.put('http://a.com', self._info({'ETag': '"1"'}), 'a')
+        self.cache.clear()
+        self.assertEqual(self.cache.entry('http://a.com'), None)
+        self.assertEqual(os.listdir(self.cache.path), [])
+
+    def test__entry(self):
+        url = 'http://www.example.com'
+        self.assertEqual(self.cache.entry(url), None)
+        self.cache.put(url, self._info({'ETag': '"1"',
+            'Last-Modified': 'Sat, 01 Jan 2011 00:00:00 GMT'}), 'content')
+        entry = self.cache.entry(url)
+        self.assertEqual(entry['url'], url)
+        self.assertEqual(entry['etag'], '"1"')
+        self.assertEqual(entry['last_modified'],
+                'Sat, 01 Jan 2011 00:00:00 GMT')
+        self.assertEqual(entry['expires'], 0)
+        self.assertEqual(entry['size'], 7)
+        self.assertEqual(self.cache.content(url), 'content')
+
+        # Entries persist.
+        cache = HttpCache(self.cache.path)
+        self.assertEqual(cache.entry(url), entry)
+        self.assertEqual(cache.stats()['bytes'], 7)
+
+    def test__fresh(self):
+        self.assertFalse(self.cache.fresh(None))
+        self.assertFalse(self.cache.fresh({'expires': 0}))
+        self.assertFalse(self.cache.fresh({'expires': time.time() - 1}))
+        self.assertTrue(self.cache.fresh({'expires': time.time() + 60}))
+
+    def test__hit(self):
+        url = 'http://www.example.com'
+        self.cache.put(url, self._info({'ETag': '"1"'}), 'content')
+        entry = self.cache.entry(url)
+        self.cache.hit(url, entry)
+        self.cache.hit(url, entry, info=self._info({'ETag': '"2"',
+            'Cache-Control': 'max-age=60'}))
+        entry = self.cache.entry(url)
+        self.assertEqual(entry['etag'], '"2"')
+        self.assertTrue(self.cache.fresh(entry))
+        stats = self.cache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['bytes_saved'], 14)
+
+    def test__key(self):
+        self.assertEqual(len(self.cache.key('http://www.example.com')), 40)
+        self.assertNotEqual(self.cache.key('http://a.com'),
+                self.cache.key('http://b.com'))
+
+    def test__put(self):
+        url = 'http://www.example.com'
+        self.assertFalse(self.cache.put(url, self._info({}), 'content'))
+        self.assertFalse(self.cache.put(url, self._info({'ETag': '"1"',
+            'Cache-Control': 'no-store'}), 'content'))
+        self.assertTrue(self.cache.put(url, self._info({'ETag': '"1"'}),
+            'content'))
+        self.assertTrue(self.cache.put(url,
+            self._info({'Cache-Control': 'max-age=60'}), 'content'))
+        self.assertTrue(self.cache.put(url, self._info({
+            'Date': 'Sat, 01 Jan 2011 00:00:00 GMT',
+            'Expires': 'Sat, 01 Jan 2011 00:01:00 GMT'}), 'content'))
+        self.assertTrue(self.cache.fresh(self.cache.entry(url)))
+        self.assertEqual(self.cache.stats()['misses'], 5)
+
+        # Responses varying by request or user are not stored.
+        for headers in [{'Vary': 'Cookie'}, {'Vary': 'Accept-Encoding, *'},
+                {'Set-Cookie': 'a=1'}, {'Cache-Control': 'private'}]:
+            headers['ETag'] = '"1"'
+            self.assertFalse(self.cache.put(url, self._info(headers),
+                'content'))
+        self.assertEqual(self.cache.entry(url), None)
+        self.assertTrue(self.cache.put(url, self._info({'ETag': '"1"',
+            'Vary': 'Accept-Encoding'}), 'content'))
+
+        # Least recently used entries are evicted.
+        cache = HttpCache(self.cache.path, max_bytes=20)
+        cache.clear()
+        info = self._info({'ETag': '"1"'})
+        cache.put('http://a.com', info, 'a' * 8)
+        time.sleep(0.01)
+        cache.put('http://b.com', info, 'b' * 8)
+        time.sleep(0.01)
+        cache.hit('http://a.com', cache.entry('http://a.com'))
+        cache.put('http://c.com', info, 'c' * 8)
+        self.assertNotEqual(cache.entry('http://a.com'), None)
+        self.assertEqual(cache.entry('http://b.com'), None)
+        self.assertNotEqual(cache.entry('http://c.com'), None)
+        self.assertEqual(cache.stats()['bytes'], 16)
+        # Too large to cache
+        self.assertFalse(cache.put('http://d.com', info, 'd' * 21))
+
+        # Files stored by other processes are counted before evicting.
+        cache.clear()
+        other = HttpCache(self.cache.path, max_bytes=20)
+        cache.put('http://a.com', info, 'a' * 8)
+        time.sleep(0.01)
+        other.put('http://b.com', info, 'b' * 8)
+        time.sleep(0.01)
+        cache.put('http://c.com', info, 'c' * 8)
+        self.assertEqual(cache.stats()['bytes'], 16)
+        cache.rescan_seconds = 0
+        cache.put('http://c.com', info, 'c' * 8)
+        self.assertEqual(cache.entry('http://a.com'), None)
+        self.assertNotEqual(cache.entry('http://b.com'), None)
+        self.assertEqual(cache.stats()['bytes'], 16)
+
+    def test__request_headers(self):
+        self.assertEqual(self.cache.request_headers({'etag': None,
+            'last_modified': None}), {})
+        self.assertEqual(self.cache.request_headers({'etag': '"1"',
+            'last_modified': 'Sat, 01 Jan 2011 00:00:00 GMT'}),
+            {'If-None-Match': '"1"',
+             'If-Modified-Since': 'Sat, 01 Jan 2011 00:00:00 GMT'})
+
+    def test__stats(self):
+        self.assertEqual(self.cache.stats(), {'hits': 0, 'misses': 0,
+            'bytes_saved': 0, 'entries': 0, 'bytes': 0})
+
+
+class TestPooledHTTPHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalServer()
+        self.pool = ConnectionPool()
+        self.opener = urllib2.build_opener(PooledHTTPHandler(self.pool))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test__pooled_open(self):
+        response = self.opener.open(self.server.url('/page'), timeout=5)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.info()['Content-Length'], '21')
+        self.assertEqual(response.read(), 'path: /page\ncookie: \n')
+        self.assertEqual(self.pool.stats()['idle'], 1)
+
+        # A connection closed by the host while idle is replaced.
+        (connection, released) = self.pool.idle.values()[0][0]
+        connection.sock.shutdown(socket.SHUT_RDWR)
+        response = self.opener.open(self.server.url('/page'), timeout=5)
+        self.assertEqual(response.read(), 'path: /page\ncookie: \n')
+        self.assertEqual(self.pool.stats()['created'], 2)
+
+        # No host
+        self.assertRaises(URLError, self.opener.open, 'http:///page')
+
+        # A request sent on a reused connection without a response is
+        # resent only if its method is idempotent.
+        for (data, count) in [(None, 2), ('a=1', 1)]:
+            self.opener.open(self.server.url('/page'), timeout=5).read()
+            self.server.paths = []
+            self.assertRaises(URLError, self.opener.open,
+                    self.server.url('/drop'), data, 5)
+            self.assertEqual(self.server.paths, ['/drop'] * count)
+
+    def test__pooled_open_tunnel(self):
+        handler = PooledHTTPHandler(self.pool)
+        for unused in range(2):
+            req = urllib2.Request(self.server.url('/page'),
+                    headers={'Proxy-Authorization': 'Basic abc'})
+            req.timeout = 5
+            req._tunnel_host = 'www.example.com:80'
+            response = handler.pooled_open(req)
+            self.assertEqual(response.read(), 'path: /page\ncookie: \n')
+        # The connection was tunneled once, then reused.
+        self.assertEqual(self.server.tunnels,
+                [('www.example.com:80', 'Basic abc')])
+        self.assertEqual(self.pool.idle.keys(), [('http',
+            '127.0.0.1:{p}'.format(p=self.server.server_port),
+            'www.example.com:80')])
+
+
+class TestPooledResponse(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalServer()
+        self.pool = ConnectionPool()
+        self.key = ('http', '127.0.0.1:{p}'.format(p=self.server.server_port))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _response(self, path='/page'):
+        (connection, unused_reused) = self.pool.get(self.key)
+        connection.request('GET', path)
+        return PooledResponse(connection.getresponse(), connection,
+                self.pool, self.key)
+
+    def test__close(self):
+        response = self._response()
+        response.close()
+        self.assertEqual(self.pool.stats()['connections'], 0)
+        response = self._response()
+        response.read()
+        response.close()
+        self.assertEqual(self.pool.stats()['idle'], 1)
+
+    def test__read(self):
+        response = self._response()
+        self.assertEqual(response.read(4), 'path')
+        self.assertEqual(self.pool.stats()['idle'], 0)
+        self.assertEqual(response.read(), ': /page\ncookie: \n')
+        self.assertEqual(self.pool.stats()['idle'], 1)
+
+    def test__readline(self):
+        response = self._response()
+        self.assertEqual(response.readline(), 'path: /page\n')
+        self.assertEqual(response.readline(3), 'coo')
+        self.assertEqual(response.read(), 'kie: \n')
+        self.assertEqual(response.readline(), '')
+        self.assertEqual(self.pool.stats()['idle'], 1)
+
+    def test__readlines(self):
+        response = self._response()
+        self.assertEqual(response.readlines(),
+                ['path: /page\n', 'cookie: \n'])
+        self.assertEqual(self.pool.stats()['idle'], 1)
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def _http_error(self, code, headers=None):
+        message = httplib.HTTPMessage(StringIO.StringIO(''.join(
+            ['{k}: {v}\r\n'.format(k=k, v=v) for (k, v) in
+             (headers or {}).items()])))
+        return HTTPError('http://www.example.com', code, 'msg', message,
+                None)
+
+    def test____init__(self):
+        policy = RetryPolicy()
+        self.assertEqual(policy.connect_timeout, RetryPolicy.connect_timeout)
+        policy = RetryPolicy(connect_timeout=3, read_timeout=30)
+        self.assertEqual(policy.connect_timeout, 3)
+        self.assertEqual(policy.read_timeout, 30)
+        self.assertRaises(TypeError, RetryPolicy, timeout=3)
+
+    def test__allow(self):
+        policy = RetryPolicy(breaker_failures=2, breaker_seconds=60)
+        self.assertTrue(policy.allow('a.com'))
+        policy.failure('a.com')
+        self.assertTrue(policy.allow('a.com'))
+        policy.failure('a.com')
+        self.assertFalse(policy.allow('a.com'))
+        self.assertTrue(policy.allow('b.com'))
+        policy.hosts['a.com'][1] = time.time() - 1
+        self.assertTrue(policy.allow('a.com'))
+
+    def test__delay(self):
+        policy = RetryPolicy(backoff_base=1, backoff_factor=2,
+                backoff_max=5, jitter=0)
+        self.assertEqual([policy.delay(x) for x in range(1, 5)],
+                [1, 2, 4, 5])
+        policy.jitter = 0.5
+        for unused_i in range(20):
+            delay = policy.delay(3)
+            self.assertTrue(2 <= delay <= 4)
+        self.assertEqual(policy.delay(1, self._http_error(503,
+            {'Retry-After': '30'})), 30)
+        policy.retry_after_max = 10
+        self.assertEqual(policy.delay(1, self._http_error(503,
+            {'Retry-After': '30'})), None)
+        self.assertTrue(policy.delay(1, self._http_error(503)) <= 1)
+
+    def test__failure(self):
+        policy = RetryPolicy(breaker_failures=3, breaker_seconds=60)
+        policy.failure('a.com')
+        self.assertEqual(policy.hosts['a.com'], [1, 0])
+        policy.failure('a.com')
+        policy.failure('a.com')
+        self.assertEqual(policy.hosts['a.com'][0], 3)
+        self.assertTrue(policy.hosts['a.com'][1] > time.time() + 59)
+
+    def test__host_failure(self):
+        policy = RetryPolicy()
+        self.assertTrue(policy.host_failure(URLError(socket.timeout())))
+        self.assertTrue(policy.host_failure(self._http_error(503)))
+        self.assertFalse(policy.host_failure(self._http_error(404)))
+        self.assertFalse(policy.host_failure(self._http_error(429)))
+
+    def test__retry_after(self):
+        policy = RetryPolicy()
+        self.assertEqual(policy.retry_after(URLError('reason')), None)
+        self.assertEqual(policy.retry_after(self._http_error(503)), None)
+        self.assertEqual(policy.retry_after(self._http_error(503,
+            {'Retry-After': '120'})), 120)
+        self.assertEqual(policy.retry_after(self._http_error(503,
+            {'Retry-After': 'Sat, 01 Jan 2011 00:00:00 GMT'})), 0)
+        retry_after = policy.retry_after(self._http_error(503,
+            {'Retry-After': email.utils.formatdate(time.time() + 60,
+                usegmt=True)}))
+        self.assertTrue(55 < retry_after <= 60)
+        self.assertEqual(policy.retry_after(self._http_error(503,
+            {'Retry-After': 'invalid'})), None)
+
+    def test__sleep(self):
+        start = time.time()
+        RetryPolicy().sleep(0.01)
+        self.assertTrue(time.time() - start >= 0.01)
+
+    def test__success(self):
+        policy = RetryPolicy(breaker_failures=1)
+        policy.failure('a.com')
+        self.assertFalse(policy.allow('a.com'))
+        policy.success('a.com')
+        self.assertTrue(policy.allow('a.com'))
+        self.assertEqual(policy.hosts, {})
+
+
+class TestStreamDecoder(unittest.TestCase):
+
+    def _decode(self, decoder, data, piece_size=100):
+        chunks = []
+        for i in range(0, len(data), piece_size):
+            chunks.extend(decoder.decode(data[i:i + piece_size]))
+        chunks.extend(decoder.decode(''))
+        return chunks
+
+    def test____init__(self):
+        self.assertEqual(StreamDecoder('').decompressor, None)
+        self.assertEqual(StreamDecoder('br').decompressor, None)
+        for encoding in ['gzip', 'x-gzip', ' GZIP', 'deflate']:
+            self.assertFalse(StreamDecoder(encoding).decompressor is None)
+
+    def test__decode(self):
+        content = LARGE_CONTENT
+        self.assertEqual(''.join(self._decode(StreamDecoder(''), content)),
+                content)
+
+        out = StringIO.StringIO()
+        gzip_file = gzip.GzipFile(fileobj=out, mode='wb')
+        gzip_file.write(content)
+        gzip_file.close()
+        chunks = self._decode(StreamDecoder('gzip', chunk_size=1000),
+                out.getvalue(), piece_size=5000)
+        self.assertEqual(''.join(chunks), content)
+        self.assertTrue(max([len(x) for x in chunks]) <= 1000)
+
+        self.assertEqual(''.join(self._decode(StreamDecoder('deflate'),
+            zlib.compress(content))), content)
+        raw = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = raw.compress(content) + raw.flush()
+        self.assertEqual(''.join(self._decode(StreamDecoder('deflate'),
+            data)), content)
+
+        decoder = StreamDecoder('gzip')
+        self.assertRaises(zlib.error, list, decoder.decode('not gzip'))
+
+
 class TestErrorMessage(unittest.TestCase):
 
     def test____init__(self):
@@ -135,16 +1168,16 @@ class TestErrorMessage(unittest.TestCase):
             self.assertTrue(error_msg.identified)
             self.assertTrue(len(error_msg.messages) > 0)
 
-        code = 503
-        try:
-            raise HTTPError('http://www.example.com', code, None, None,
-                            None)
-        except HTTPError, err:
-            error_msg = ErrorMessage(err)
-            error_msg.identify()
-            self.assertTrue(error_msg.retry)
-            self.assertTrue(error_msg.identified)
-            self.assertTrue(len(error_msg.messages) > 0)
+        for code in [429, 503]:
+            try:
+                raise HTTPError('http://www.example.com', code, None, None,
+                                None)
+            except HTTPError, err:
+                error_msg = ErrorMessage(err)
+                error_msg.identify()
+                self.assertTrue(error_msg.retry)
+                self.assertTrue(error_msg.identified)
+                self.assertTrue(len(error_msg.messages) > 0)
 
         reason = socket.timeout()
         try:
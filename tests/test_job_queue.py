@@ -8,16 +8,19 @@ Test suite for shared/modules/job_queue.py
 
 """
 
+import datetime
 import os
 import sys
+import tempfile
 import time
 import unittest
 
 from applications.shared.modules.test_runner import LocalTestSuite, \
     ModuleTestSuite
-from applications.shared.modules.job_queue import Job, Queue, \
-        QueueEmptyError, QueueLockedError, QueueLockedExtendedError, \
-        trigger_queue_handler
+from applications.shared.modules.job_queue import Executor, \
+        ForkedProcess, Job, Queue, QueueDaemon, QueueEmptyError, \
+        QueueLockedError, QueueLockedExtendedError, percentile, \
+        queue_socket_path, trigger_queue_handler, wake, worker_id
 from gluon.shell import env
 
 # C0111: *Missing docstring*
@@ -36,12 +39,232 @@ if not os.path.exists(TMP_DIR):
     os.makedirs(TMP_DIR)
 
 
+def _write_script(name, text):
+    """Write a python script to TMP_DIR and return the filename."""
+    script_name = os.path.join(TMP_DIR, name)
+    with open(script_name, 'w') as f:
+        f.write(text.strip())
+    os.chmod(script_name, 0700)
+    return script_name
+
+
+class TestExecutor(unittest.TestCase):
+
+    def _remove_jobs(self):
+        for j in Job(DBH.job).set_.get():
+            j.remove()
+
+    def test____init__(self):
+        executor = Executor(Queue(DBH.job))
+        self.assertTrue(executor)
+        self.assertEqual(executor.max_workers, Executor.max_workers)
+        self.assertEqual(executor.priority_limits, {})
+        self.assertEqual(executor.worker, worker_id())
+
+        executor = Executor(Queue(DBH.job), max_workers=2,
+                priority_limits={1: 1}, timeout=5, worker='test_worker')
+        self.assertEqual(executor.max_workers, 2)
+        self.assertEqual(executor.priority_limits, {1: 1})
+        self.assertEqual(executor.timeout, 5)
+        self.assertEqual(executor.worker, 'test_worker')
+
+    def test___reap(self):
+        queue = Queue(DBH.job)
+        self._remove_jobs()
+        script = _write_script('test___reap.py', """
+import time
+time.sleep(10)
+""")
+        Job(DBH.job, start='2010-01-01 10:00:00', priority=0, status='a',
+                command=script).add()
+        executor = Executor(queue)
+        job = executor.claim()
+        executor._start(job)
+        running = executor.running[job.id]
+        self.assertEqual(executor._reap(), 0)
+        self.assertEqual(running['process'].poll(), None)
+
+        # The claim is lost, the lease can't be renewed, the job is killed.
+        DBH(DBH.job.id == job.id).update(worker='test_worker_2')
+        DBH.commit()
+        running['renewed'] = 0
+        self.assertEqual(executor._reap(), 0)
+        self.assertEqual(executor.running, {})
+        self.assertEqual(running['process'].poll(), -9)
+        got = Job(DBH.job).set_.get(id=job.id).first()
+        self.assertEqual(got.status, 'r')
+        self.assertEqual(got.worker, 'test_worker_2')
+        self._remove_jobs()
+
+    def test___start(self):
+        queue = Queue(DBH.job)
+        self._remove_jobs()
+        Job(DBH.job, start='2010-01-01 10:00:00', priority=0, status='a',
+                command='test___start.py').add()
+        executor = Executor(queue)
+        job = executor.claim()
+
+        # The claim is lost, the job is not started.
+        DBH(DBH.job.id == job.id).update(worker='test_worker_2')
+        DBH.commit()
+        executor._start(job)
+        self.assertEqual(executor.running, {})
+        got = Job(DBH.job).set_.get(id=job.id).first()
+        self.assertEqual(got.started_on, None)
+        self.assertEqual(got.worker, 'test_worker_2')
+        self._remove_jobs()
+
+    def test__claim(self):
+        queue = Queue(DBH.job)
+        self._remove_jobs()
+        job_1 = Job(DBH.job, start='2010-01-01 10:00:00', priority=1,
+                status='a').add()
+        job_2 = Job(DBH.job, start='2010-01-01 10:00:00', priority=1,
+                status='a').add()
+        job_3 = Job(DBH.job, start='2010-01-01 10:00:00', priority=0,
+                status='a').add()
+
+        executor = Executor(queue, priority_limits={1: 1})
+        job = executor.claim()
+        self.assertEqual(job.id, job_1.id)
+        executor.running[job.id] = dict(job=job)
+        # Priority 1 is at its limit, the lower priority job is claimed.
+        job = executor.claim()
+        self.assertEqual(job.id, job_3.id)
+        executor.running[job.id] = dict(job=job)
+        self.assertRaises(QueueEmptyError, executor.claim)
+        del executor.running[job_1.id]
+        job = executor.claim()
+        self.assertEqual(job.id, job_2.id)
+        self._remove_jobs()
+
+    def test__run(self):
+        queue = Queue(DBH.job)
+        self._remove_jobs()
+        ok_script = _write_script('test__run_ok.py', """
+import sys
+print 'Hello', ' '.join(sys.argv[1:])
+""")
+        fail_script = _write_script('test__run_fail.py', """
+import sys
+sys.stderr.write('Failed')
+sys.exit(3)
+""")
+        slow_script = _write_script('test__run_slow.py', """
+import time
+time.sleep(10)
+""")
+
+        for fork in [False, True]:
+            jobs = []
+            for command in ['{s} World'.format(s=ok_script), fail_script,
+                    slow_script]:
+                jobs.append(Job(DBH.job, start='2010-01-01 10:00:00',
+                    priority=0, status='a', command=command).add())
+
+            executor = Executor(queue, max_workers=2, timeout=2, fork=fork)
+            self.assertEqual(executor.run(), 3)
+            self.assertEqual(executor.running, {})
+
+            got = Job(DBH.job).set_.get(id=jobs[0].id).first()
+            self.assertEqual(got.status, 'd')
+            self.assertEqual(got.exit_status, 0)
+            self.assertEqual(got.stdout, 'Hello World\n')
+            self.assertEqual(got.stderr, '')
+
+            got = Job(DBH.job).set_.get(id=jobs[1].id).first()
+            self.assertEqual(got.status, 'd')
+            self.assertEqual(got.exit_status, 3)
+            self.assertEqual(got.stderr, 'Failed')
+
+            got = Job(DBH.job).set_.get(id=jobs[2].id).first()
+            self.assertEqual(got.status, 'd')
+            self.assertEqual(got.exit_status, -9)
+            self.assertTrue('Killed, timeout' in got.stderr)
+            self._remove_jobs()
+
+        # A job that fails to start is finished with the error.
+        job = Job(DBH.job, start='2010-01-01 10:00:00', priority=0,
+                status='a', command='{s} "unclosed'.format(s=ok_script)).add()
+        executor = Executor(queue)
+        executor.run()
+        self.assertEqual(executor.running, {})
+        got = Job(DBH.job).set_.get(id=job.id).first()
+        self.assertEqual(got.status, 'd')
+        self.assertEqual(got.exit_status, Executor.start_failed_status)
+        self.assertTrue('Job failed to start' in got.stderr)
+        self._remove_jobs()
+
+
+class TestForkedProcess(unittest.TestCase):
+
+    def test____init__(self):
+        script = _write_script('test__forked.py', """
+import sys
+print ' '.join(sys.argv)
+sys.exit(2)
+""")
+        job = Job(DBH.job, command='{s} -v 123'.format(s=script))
+        stdout = tempfile.TemporaryFile()
+        stderr = tempfile.TemporaryFile()
+        process = ForkedProcess(job, stdout, stderr)
+        self.assertTrue(process.pid > 0)
+        self.assertEqual(process.wait(), 2)
+        self.assertEqual(process.poll(), 2)
+        stdout.seek(0)
+        self.assertEqual(stdout.read(), '{s} -v 123\n'.format(s=script))
+
+        # Test env
+        script = _write_script('test__forked_env.py', """
+print test_value
+print db._adapter.connection is parent_connection, \\
+    db(db.job.command == test_value).count()
+""")
+        job = Job(DBH.job, command=script).add()
+        stdout = tempfile.TemporaryFile()
+        process = ForkedProcess(job, stdout, stderr, env={
+            'test_value': script, 'db': DBH,
+            'parent_connection': DBH._adapter.connection})
+        self.assertEqual(process.wait(), 0)
+        stdout.seek(0)
+        # The child has a connection of its own, the parent's still works.
+        self.assertEqual(stdout.read(), '{s}\nFalse 1\n'.format(s=script))
+        self.assertTrue(job.remove())
+
+    def test__kill(self):
+        script = _write_script('test__forked_slow.py', """
+import time
+time.sleep(10)
+""")
+        job = Job(DBH.job, command=script)
+        stdout = tempfile.TemporaryFile()
+        process = ForkedProcess(job, stdout, stdout)
+        self.assertEqual(process.poll(), None)
+        process.kill()
+        self.assertEqual(process.wait(), -9)
+
+
 class TestJob(unittest.TestCase):
 
     def test____init__(self):
         job = Job(DBH.job)
         self.assertTrue(job)
 
+    def test___add_args(self):
+        job = Job(DBH.job, command='pwd')
+        args = job._add_args()
+        self.assertTrue(job.queued_on)
+        self.assertEqual(args['queued_on'], job.queued_on)
+
+        queued_on = datetime.datetime(2010, 1, 1, 10, 0, 0)
+        job = Job(DBH.job, command='pwd', queued_on=queued_on)
+        self.assertEqual(job._add_args()['queued_on'], queued_on)
+
+    def test__command_args(self):
+        job = Job(DBH.job, command='some_script.py -v -a "a b" 123')
+        self.assertEqual(job.command_args(),
+                ['python', 'some_script.py', '-v', '-a', 'a b', '123'])
+
     def test__run(self):
         job = Job(DBH.job)
         # No command defined, should fail.
@@ -104,6 +327,92 @@ class TestQueue(unittest.TestCase):
         queue = Queue(DBH.job)
         self.assertTrue(queue)
 
+    def _remove_jobs(self):
+        for j in Job(DBH.job).set_.get():
+            j.remove()
+
+    def test__claim(self):
+        queue = Queue(DBH.job)
+        self._remove_jobs()
+        self.assertRaises(QueueEmptyError, queue.claim)
+
+        job_1 = Job(DBH.job, start='2010-01-01 10:00:00', priority=0,
+                status='a').add()
+        job_2 = Job(DBH.job, start='2010-01-01 10:00:01', priority=1,
+                status='a').add()
+        job_3 = Job(DBH.job, start='2999-12-31 23:59:59', priority=2,
+                status='a').add()
+
+        # Highest priority job is claimed first
+        job = queue.claim(worker='test_worker_1')
+        self.assertEqual(job.id, job_2.id)
+        self.assertEqual(job.status, 'r')
+        self.assertEqual(job.worker, 'test_worker_1')
+        self.assertTrue(job.lease_expires > datetime.datetime.now())
+        self.assertTrue(job.claimed_on)
+        got = Job(DBH.job).set_.get(id=job_2.id).first()
+        self.assertEqual(got.status, 'r')
+        self.assertEqual(got.worker, 'test_worker_1')
+
+        # A claimed job is not claimed again
+        job = queue.claim(worker='test_worker_2')
+        self.assertEqual(job.id, job_1.id)
+        self.assertEqual(job.worker, 'test_worker_2')
+
+        # Future jobs are not claimed
+        self.assertRaises(QueueEmptyError, queue.claim)
+
+        # Default worker
+        job_3.start = '2010-01-01 10:00:00'
+        job_3.modify()
+        job = queue.claim()
+        self.assertEqual(job.id, job_3.id)
+        self.assertEqual(job.worker, worker_id())
+        self._remove_jobs()
+
+        # Another worker claims every candidate of the batch first.
+        class RacedQueue(Queue):
+            raced = False
+
+            def jobs(self, *args, **kwargs):
+                candidates = Queue.jobs(self, *args, **kwargs)
+                if not self.raced:
+                    self.raced = True
+                    for unused_job in candidates:
+                        Queue(self.tbl_).claim(worker='test_worker_2',
+                                query=kwargs.get('query'))
+                return candidates
+
+        jobs = []
+        for priority in [1, 1, 1, 2]:
+            jobs.append(Job(DBH.job, start='2010-01-01 10:00:00',
+                priority=priority, status='a').add())
+        queue = RacedQueue(DBH.job)
+        queue.claim_batch = 2
+        job = queue.claim(worker='test_worker_1',
+                query=(DBH.job.priority == 1))
+        self.assertEqual(job.id, jobs[2].id)
+        self.assertEqual(job.worker, 'test_worker_1')
+        workers = dict([(x.id, x.worker) for x in Job(DBH.job).set_.get()])
+        self.assertEqual([workers[x.id] for x in jobs],
+                ['test_worker_2', 'test_worker_2', 'test_worker_1', None])
+        self._remove_jobs()
+
+    def test__finish(self):
+        queue = Queue(DBH.job)
+        self._remove_jobs()
+        Job(DBH.job, start='2010-01-01 10:00:00', status='a').add()
+        job = queue.claim(worker='test_worker_1')
+        self.assertTrue(queue.finish(job))
+        got = Job(DBH.job).set_.get(id=job.id).first()
+        self.assertEqual(got.status, 'd')
+        self.assertEqual(got.worker, None)
+        self.assertEqual(got.lease_expires, None)
+        self.assertTrue(got.finished_on)
+        # A job that is no longer claimed is not updated
+        self.assertFalse(queue.finish(job, status='a'))
+        self._remove_jobs()
+
     def test__jobs(self):
         queue = Queue(DBH.job)
 
@@ -193,6 +502,128 @@ class TestQueue(unittest.TestCase):
         queue.unlock(filename=lock_file)
         self.assertFalse(os.path.exists(lock_file))
 
+    def test__mark_started(self):
+        queue = Queue(DBH.job)
+        self._remove_jobs()
+        Job(DBH.job, start='2010-01-01 10:00:00', status='a').add()
+        job = queue.claim(worker='test_worker_1')
+        self.assertTrue(queue.mark_started(job))
+        got = Job(DBH.job).set_.get(id=job.id).first()
+        self.assertTrue(got.started_on)
+        queue.finish(job)
+        self.assertFalse(queue.mark_started(job))
+        self._remove_jobs()
+
+    def test__reclaim(self):
+        queue = Queue(DBH.job)
+        self._remove_jobs()
+        job_1 = Job(DBH.job, start='2010-01-01 10:00:00', status='a').add()
+        job = queue.claim(worker='test_worker_1', lease_seconds=1)
+        self.assertEqual(job.id, job_1.id)
+        self.assertEqual(queue.reclaim(), 0)  # Lease is valid
+        time.sleep(2)
+        self.assertEqual(queue.reclaim(), 1)  # Lease expired
+        got = Job(DBH.job).set_.get(id=job_1.id).first()
+        self.assertEqual(got.status, 'a')
+        self.assertEqual(got.worker, None)
+
+        # Expired jobs are reclaimed by claim()
+        job = queue.claim(worker='test_worker_1', lease_seconds=1)
+        time.sleep(2)
+        job = queue.claim(worker='test_worker_2')
+        self.assertEqual(job.id, job_1.id)
+        self.assertEqual(job.worker, 'test_worker_2')
+        # The first worker lost the claim
+        job.worker = 'test_worker_1'
+        self.assertFalse(queue.finish(job))
+        self._remove_jobs()
+
+    def test__release(self):
+        queue = Queue(DBH.job)
+        self._remove_jobs()
+        job_1 = Job(DBH.job, start='2010-01-01 10:00:00', status='a').add()
+        job = queue.claim(worker='test_worker_1')
+        self.assertTrue(queue.release(job))
+        self.assertEqual(job.status, 'a')
+        job = queue.claim(worker='test_worker_2')
+        self.assertEqual(job.id, job_1.id)
+        self._remove_jobs()
+
+    def test__renew(self):
+        queue = Queue(DBH.job)
+        self._remove_jobs()
+        Job(DBH.job, start='2010-01-01 10:00:00', status='a').add()
+        job = queue.claim(worker='test_worker_1', lease_seconds=1)
+        self.assertTrue(queue.renew(job, lease_seconds=9999))
+        # Renewing to the same lease, within the second, changes no rows.
+        self.assertTrue(queue.renew(job, lease_seconds=9999))
+        time.sleep(2)
+        self.assertEqual(queue.reclaim(), 0)
+        got = Job(DBH.job).set_.get(id=job.id).first()
+        self.assertEqual(got.status, 'r')
+        self.assertEqual(got.worker, 'test_worker_1')
+        # A job that is no longer claimed is not renewed
+        self.assertTrue(queue.finish(job))
+        self.assertFalse(queue.renew(job))
+        self._remove_jobs()
+
+    def test__stats(self):
+        queue = Queue(DBH.job)
+        self._remove_jobs()
+        stats = queue.stats()
+        self.assertEqual(stats['depth'], {})
+        self.assertEqual(stats['finished'], 0)
+        self.assertEqual(stats['failure_rate'], 0.0)
+        self.assertEqual(stats['wait_p50'], None)
+        self.assertEqual(stats['run_p95'], None)
+
+        now = datetime.datetime.now().replace(microsecond=0)
+        ago = lambda s: now - datetime.timedelta(seconds=s)
+        # Ready jobs
+        Job(DBH.job, start=ago(10), priority=0, status='a').add()
+        Job(DBH.job, start=ago(10), priority=1, status='a').add()
+        Job(DBH.job, start=ago(10), priority=1, status='a').add()
+        # Scheduled job
+        Job(DBH.job, start=now + datetime.timedelta(days=1), priority=1,
+                status='a').add()
+        # Running job
+        Job(DBH.job, start=ago(10), priority=1, status='r').add()
+        # Finished jobs (wait, run, exit_status)
+        for wait, run, exit_status in [(1, 10, 0), (2, 20, 0), (3, 30, 1),
+                (4, 40, 0)]:
+            Job(DBH.job, start=ago(100), queued_on=ago(100),
+                    claimed_on=ago(100 - wait),
+                    started_on=ago(100 - wait),
+                    finished_on=ago(100 - wait - run),
+                    exit_status=exit_status, status='d').add()
+        # Finished outside the window
+        Job(DBH.job, start=ago(9000), queued_on=ago(9000),
+                claimed_on=ago(9000), started_on=ago(9000),
+                finished_on=ago(8000), exit_status=1, status='d').add()
+
+        stats = queue.stats(seconds=3600)
+        self.assertEqual(stats['depth'], {0: 1, 1: 2})
+        self.assertEqual(stats['scheduled'], 1)
+        self.assertEqual(stats['running'], 1)
+        self.assertEqual(stats['finished'], 4)
+        self.assertEqual(stats['failed'], 1)
+        self.assertAlmostEqual(stats['failure_rate'], 0.25)
+        self.assertAlmostEqual(stats['throughput_per_minute'], 4 / 60.0)
+        self.assertEqual(stats['wait_p50'], 2)
+        self.assertEqual(stats['wait_p95'], 4)
+        self.assertEqual(stats['run_p50'], 20)
+        self.assertEqual(stats['run_p95'], 40)
+
+        # Jobs that fail to start are failures.
+        for command in ['', 'test__stats.py "unclosed']:
+            Job(DBH.job, start=ago(10), priority=2, status='a',
+                    command=command).add()
+        Executor(queue, priority_limits={0: 0, 1: 0}).run()
+        stats = queue.stats(seconds=3600)
+        self.assertEqual(stats['finished'], 6)
+        self.assertEqual(stats['failed'], 3)
+        self._remove_jobs()
+
     def test__top_job(self):
         queue = Queue(DBH.job)
         if len(queue.jobs()) > 0:
@@ -220,40 +651,97 @@ class TestQueue(unittest.TestCase):
         pass
 
 
+class TestQueueDaemon(unittest.TestCase):
+
+    def _daemon(self, handler):
+        daemon = QueueDaemon(handler, os.path.join(TMP_DIR, 'test.sock'))
+        daemon.coalesce_seconds = 0.5
+        daemon.poll_seconds = 0.5
+        return daemon
+
+    def test____init__(self):
+        daemon = self._daemon(lambda: None)
+        self.assertTrue(daemon)
+
+    def test__close(self):
+        daemon = self._daemon(lambda: None)
+        daemon.listen()
+        self.assertTrue(os.path.exists(daemon.socket_path))
+        daemon.close()
+        self.assertFalse(os.path.exists(daemon.socket_path))
+        self.assertEqual(daemon.sock, None)
+        daemon.close()      # Closing twice is harmless
+
+    def test__listen(self):
+        daemon = self._daemon(lambda: None)
+        daemon.listen()
+        self.assertTrue(os.path.exists(daemon.socket_path))
+        # Stale socket file is replaced
+        daemon.sock.close()
+        daemon.listen()
+        self.assertTrue(wake(daemon.socket_path))
+        daemon.close()
+
+    def test__run(self):
+        calls = []
+
+        def handler():
+            calls.append(1)
+            if len(calls) == 2:
+                raise ValueError('Handler errors are ignored.')
+
+        daemon = self._daemon(handler)
+        daemon.listen()
+        for unused_i in range(5):
+            wake(daemon.socket_path)
+        start = time.time()
+        daemon.run(max_runs=1)
+        # Triggers are coalesced into one handler call
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(time.time() - start < daemon.poll_seconds + 0.4)
+        # Without triggers the handler is called every poll_seconds.
+        daemon.run(max_runs=2)
+        self.assertEqual(len(calls), 3)
+        daemon.close()
+
+    def test__wait(self):
+        daemon = self._daemon(lambda: None)
+        daemon.listen()
+        self.assertEqual(daemon.wait(0.1), 0)
+        wake(daemon.socket_path)
+        wake(daemon.socket_path)
+        start = time.time()
+        self.assertEqual(daemon.wait(0.1), 2)
+        self.assertTrue(time.time() - start >= daemon.coalesce_seconds)
+        daemon.close()
+
+
 class TestFunctions(unittest.TestCase):
 
+    def test__percentile(self):
+        self.assertEqual(percentile([], 50), None)
+        self.assertEqual(percentile([5], 50), 5)
+        self.assertEqual(percentile([5], 95), 5)
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 0), 1)
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 95), 95)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([1, 2, 3, 4], 50), 2)
+
+    def test__queue_socket_path(self):
+        request = APP_ENV['request']
+        self.assertEqual(queue_socket_path(request), os.path.join('.',
+            request.folder, 'private', 'job_queue.sock'))
+
     def test__trigger_queue_handler(self):
-        """
-        Note: this test requires private/bin/queue_trigger.sh exists with this
-        line:
-        echo 'queue_trigger.sh success' > $TMP_DIR/test__trigger_queue_handler.txt
-        """
         request = APP_ENV['request']
-        expect_content = 'queue_trigger.sh success'
-        tmp_file = os.path.join(TMP_DIR, 'test__trigger_queue_handler.txt')
-        if os.path.exists(tmp_file):
-            os.unlink(tmp_file)
-        self.assertFalse(os.path.exists(tmp_file))
-
-        # Create a queue_trigger.sh script.
-        trigger_script = os.path.join(request.folder, 'private/bin', 'queue_trigger.sh')
-        if os.path.exists(trigger_script):
-            self.fail('Refusing to overwrite existing file: {f}'.format(f=trigger_script))
-
-        text = """#!/bin/bash
-# queue_trigger.sh
-# This script is used for testing: test__trigger_queue_handler
-exec 1> >(logger -p "local7.error" -t "${{0##*/}} (ERROR)" )
-exec 2>&1
-echo '{txt}' > {tmp}
-""".format(txt=expect_content, tmp=tmp_file)
-
-        f = open(trigger_script, 'w')
-        f.write(text)
-        f.close()
-        os.chmod(trigger_script, 0700)
-
-        @trigger_queue_handler(request)
+        socket_path = os.path.join(TMP_DIR, 'test__trigger.sock')
+        daemon = QueueDaemon(lambda: None, socket_path)
+        daemon.coalesce_seconds = 0.2
+        daemon.listen()
+
+        @trigger_queue_handler(request, socket_path=socket_path)
         def test_function(arg, kwarg=''):
             """Test function docstring"""
             return 'arg: {arg}, kwarg: {kwarg}'.format(arg=arg, kwarg=kwarg)
@@ -266,20 +754,25 @@ echo '{txt}' > {tmp}
         expect = 'arg: 111, kwarg: aaa'
         self.assertEqual(test_function(111, kwarg='aaa'), expect)
 
-        # decorator runs script in background. Pause a bit for that to
-        # complete.
-        time.sleep(2)
+        # Test that the daemon was woken
+        self.assertEqual(daemon.wait(1), 1)
 
-        # Test that queue_trigger.sh was called
-        # * file exists
-        # * file has content.
-        self.assertTrue(os.path.exists(tmp_file))
-        f = open(tmp_file)
-        got = f.read().strip()
-        f.close()
-        self.assertEqual(got, expect_content)
+        # Function works if no daemon is listening.
+        daemon.close()
+        self.assertEqual(test_function(111, kwarg='aaa'), expect)
 
-        os.unlink(trigger_script)
+    def test__wake(self):
+        socket_path = os.path.join(TMP_DIR, 'test__wake.sock')
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.assertFalse(wake(socket_path))
+        daemon = QueueDaemon(lambda: None, socket_path)
+        daemon.listen()
+        self.assertTrue(wake(socket_path))
+        daemon.close()
+
+    def test__worker_id(self):
+        self.assertEqual(worker_id().split(':')[-1], str(os.getpid()))
 
 
 def main():
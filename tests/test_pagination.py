@@ -9,12 +9,16 @@ Test suite for shared/modules/pagination.py
 
 from applications.shared.modules.test_runner import LocalTestSuite, \
     ModuleTestSuite
-from applications.shared.modules.pagination import Navigator, PageList, \
-        Report, ReportColumnSet
+from applications.shared.modules.pagination import JqGridData, Navigator, \
+        PageList, Report, ReportColumnSet, escape_like, like
+from gluon.dal import BaseAdapter, DAL, Field
 from gluon.globals import Request
-from gluon.html import DIV, TD
+from gluon.html import A, DIV, TD, TR, XML
 from BeautifulSoup import BeautifulSoup
+import json
+import shutil
 import sys
+import tempfile
 import unittest
 
 ROW_CLASSES = ['row_odd', 'row_even']
@@ -24,6 +28,171 @@ ROW_CLASSES = ['row_odd', 'row_even']
 # pylint: disable=C0111,R0904
 
 
+class DbReportTest(Report):
+    """Class sub-classing Report, of a database table, used for testing."""
+
+    def __init__(self, request, sqldb):
+        Report.__init__(self, request, 'some_function', sqldb, [
+            ('ID', 'id', 'id', 0),
+            ('Name', 'name', 'name', 0),
+            ('Age', 'age', 'age', 0),
+            ('Edit', lambda r: A('edit', _href='/e/{i}'.format(i=r['id'])),
+                '', None),
+            ])
+
+    def order_field(self, order_by):
+        return self.sqldb.client[order_by]
+
+    def rows(self, page, items_per_page, order_by, order_dir, query=None):
+        orderby = [self.sqldb.client[order_by], self.sqldb.client.id]
+        if int(order_dir):
+            orderby = [~x for x in orderby]
+        if query is None:
+            query = self.sql_query()
+        return self.sqldb(query).select(orderby=orderby,
+                limitby=(page * items_per_page, (page + 1) * items_per_page))
+
+    def sql_query(self):
+        return self.sqldb.client.id > 0
+
+
+class TestJqGridData(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DAL('sqlite:memory:')
+        self.db.define_table('client', Field('name'),
+                Field('age', 'integer'))
+        for (i, x) in enumerate(sim_data()):
+            self.db.client.insert(name=x['name'], age=i % 5)
+        self.request = sim_request()
+        self.grid = JqGridData(DbReportTest(self.request, self.db))
+
+    def test____init__(self):
+        report = sim_report()
+        grid = JqGridData(report, id_field='client.id')
+        self.assertTrue(grid.report is report)
+        self.assertEqual(grid.id_field, 'client.id')
+
+    def test___order_bys(self):
+        self.assertEqual(self.grid._order_bys(), ['id', 'name', 'age'])
+
+    def test__cells(self):
+        grid = JqGridData(ReportTest(sim_request(), 'some_function', None,
+            sim_columns() + [('Edit', lambda r: A('<e>', _href='/e'), '',
+                None)]))
+        row = {'id': 3, 'name': 'A & B'}
+        self.assertEqual(grid.cells(row),
+                [3, 'A &amp; B', '<a href="/e">&lt;e&gt;</a>'])
+        row = {'id': 3, 'name': None}
+        self.assertEqual(grid.cells(row),
+                [3, '', '<a href="/e">&lt;e&gt;</a>'])
+
+    def test__data(self):
+        self.request.vars.update({'page': '2', 'rows': '10', 'sidx': 'name',
+            'sord': 'desc'})
+        data = self.grid.data()
+        self.assertEqual(data['page'], 2)
+        self.assertEqual(data['total'], 3)
+        self.assertEqual(data['records'], 26)
+        self.assertEqual(len(data['rows']), 10)
+        self.assertEqual(data['rows'][0]['id'], 16)
+        self.assertEqual(data['rows'][0]['cell'][:3], [16, 'Pppppp', 0])
+
+        # Filtered, sorted by age then id
+        self.request.vars.clear()
+        self.request.vars.update({'_search': 'true', 'sidx': 'age',
+            'filters': json.dumps({'groupOp': 'AND', 'rules': [
+                {'field': 'age', 'op': 'eq', 'data': '2'},
+                {'field': 'name', 'op': 'bw', 'data': 'M'},
+                ]})})
+        data = self.grid.data()
+        self.assertEqual(data['records'], 1)
+        self.assertEqual(data['rows'][0]['cell'][1], 'Mmmmmm')
+
+        # A page past the last page returns the last page.
+        self.request.vars.clear()
+        self.request.vars.update({'page': '9', 'rows': '10'})
+        data = self.grid.data()
+        self.assertEqual(data['page'], 3)
+        self.assertEqual(len(data['rows']), 6)
+
+    def test__filter_query(self):
+        grid = self.grid
+        self.assertEqual(grid.filter_query(None), None)
+        self.assertEqual(grid.filter_query({'rules': []}), None)
+
+        def ids(filters):
+            query = grid.filter_query(filters)
+            return [x.id for x in self.db(query).select(
+                    orderby=self.db.client.id)]
+
+        rule = lambda f, o, d: {'field': f, 'op': o, 'data': d}
+        self.assertEqual(ids({'rules': [rule('age', 'eq', '4')]}),
+                [5, 10, 15, 20, 25])
+        self.assertEqual(ids({'rules': [rule('id', 'le', '3')]}),
+                [1, 2, 3])
+        self.assertEqual(ids({'rules': [rule('name', 'cn', 'zz')]}), [26])
+        self.assertEqual(ids({'rules': [rule('id', 'in', '2, 4')]}), [2, 4])
+        self.assertEqual(ids({'groupOp': 'OR', 'rules': [
+            rule('id', 'eq', '1'), rule('id', 'eq', '26')]}), [1, 26])
+        self.assertEqual(ids({'groupOp': 'AND',
+            'rules': [rule('id', 'gt', '20')],
+            'groups': [{'groupOp': 'OR', 'rules': [rule('id', 'eq', '21'),
+                rule('id', 'eq', '2')]}]}), [21])
+
+        self.assertRaises(ValueError, grid.filter_query,
+                {'rules': [rule('_fake_', 'eq', '1')]})
+        self.assertRaises(ValueError, grid.filter_query,
+                {'rules': [rule('id', '_fake_', '1')]})
+
+        # LIKE wildcards in the data are literal.
+        self.db.client.insert(name='A_b%c!d')
+        self.assertEqual(ids({'rules': [rule('name', 'cn', '_')]}), [27])
+        self.assertEqual(ids({'rules': [rule('name', 'cn', '%')]}), [27])
+        self.assertEqual(ids({'rules': [rule('name', 'bw', 'A_')]}), [27])
+        self.assertEqual(ids({'rules': [rule('name', 'ew', '!d')]}), [27])
+        self.assertEqual(len(ids({'rules': [rule('name', 'nc', '_')]})), 26)
+
+    def test__json(self):
+        self.request.vars.update({'rows': '2'})
+        data = json.loads(self.grid.json())
+        self.assertEqual(data['records'], 26)
+        self.assertEqual(data['rows'][1]['cell'][:3], [2, 'Bbbbbb', 1])
+        self.assertFalse(' ' in self.grid.json().replace('<a href', ''))
+
+    def test__orderby(self):
+        client = self.db.client
+        self.assertEqual([str(x) for x in self.grid.orderby('name', 'asc')],
+                [str(client.name), str(client.id)])
+        self.assertEqual([str(x) for x in self.grid.orderby('id', 'desc')],
+                [str(~client.id)])
+        # Invalid sidx defaults to id
+        self.assertEqual([str(x) for x in self.grid.orderby('_fake_', '')],
+                [str(client.id)])
+        # The id is not resolved with order_field().
+        grid = JqGridData(Report(self.request, 'some_function', self.db,
+            sim_columns()), id_field='client.id')
+        self.assertEqual([str(x) for x in grid.orderby('_fake_', 'desc')],
+                [str(~client.id)])
+
+    def test__params(self):
+        self.assertEqual(self.grid.params(), {'page': 1, 'rows': 20,
+            'sidx': '', 'sord': 'asc', 'filters': None})
+        self.request.vars.update({'page': '3', 'rows': '99999',
+            'sidx': 'name', 'sord': 'desc', '_search': 'true',
+            'searchField': 'name', 'searchOper': 'cn', 'searchString': 'a'})
+        self.assertEqual(self.grid.params(), {'page': 3,
+            'rows': JqGridData.max_rows, 'sidx': 'name', 'sord': 'desc',
+            'filters': {'groupOp': 'AND', 'rules': [
+                {'field': 'name', 'op': 'cn', 'data': 'a'}]}})
+        self.request.vars.update({'filters': '{"rules": []}'})
+        self.assertEqual(self.grid.params()['filters'], {'rules': []})
+        self.request.vars.update({'filters': '[1]'})
+        self.assertRaises(ValueError, self.grid.params)
+        self.request.vars.update({'filters': '{'})
+        self.assertRaises(ValueError, self.grid.params)
+
+
 class TestNavigator(unittest.TestCase):
 
     def test____init__(self):
@@ -261,7 +430,7 @@ class ReportTest(Report):
         Report.__init__(self, request, report_function, sqldb, columns,
                 row_classes)
 
-    def rows(self, page, items_per_page, order_by, order_dir):
+    def rows(self, page, items_per_page, order_by, order_dir, query=None):
         order_by = 'id' if not order_by else order_by
         data = sim_data()
         reverse = True if order_dir else False
@@ -274,6 +443,31 @@ class ReportTest(Report):
         pass
 
 
+class KeysetReportTest(ReportTest):
+    """Class sub-classing Report used for testing keyset pagination."""
+
+    pagination = 'keyset'
+
+    def keyset_rows(self, items_per_page, order_by, order_dir, seek_value,
+            seek_id, backward=False):
+        order_by = 'id' if not order_by else order_by
+        data = sim_data()
+        key = lambda x: (x[order_by], x['id'])
+        descending = bool(int(order_dir)) != bool(backward)
+        if seek_id is None:
+            rows = data
+        else:
+            boundary = (type(data[0][order_by])(seek_value), int(seek_id))
+            if descending:
+                rows = [x for x in data if key(x) < boundary]
+            else:
+                rows = [x for x in data if key(x) > boundary]
+        rows = sorted(rows, key=key, reverse=descending)[:items_per_page]
+        if backward:
+            rows.reverse()
+        return rows
+
+
 class TestReport(unittest.TestCase):
 
     def test____init__(self):
@@ -288,6 +482,165 @@ class TestReport(unittest.TestCase):
                 sim_columns())
         self.assertTrue(report)
 
+    def test___export_order(self):
+        request = sim_request()
+        report = ReportTest(request, 'some_function', None, sim_columns())
+        self.assertEqual(report._export_order('id', 0), ('id', 0))
+        self.assertEqual(report._export_order('name', 1), ('name', 1))
+        self.assertEqual(report._export_order('_fake_', 'x'), ('id', 0))
+        request.vars.order_by = 'name'
+        request.vars.order_dir = '1'
+        self.assertEqual(report._export_order('id', 0), ('name', 1))
+
+    def test___page_vars(self):
+        request = sim_request()
+        request.vars.order_by = 'name'
+        request.vars.seek = 'next'
+        request.vars.seek_id = '4'
+        request.vars.seek_value = 'Eeeeee'
+        report = ReportTest(request, 'some_function', None, sim_columns())
+        self.assertEqual(report._page_vars({'page': 2}),
+                {'order_by': 'name', 'page': 2})
+        seek_vars = {'seek': 'prev', 'seek_id': 1, 'seek_value': 'Bbbbbb'}
+        self.assertEqual(report._page_vars({'page': 2}, seek_vars=seek_vars),
+                {'order_by': 'name', 'page': 2, 'seek': 'prev', 'seek_id': 1,
+                 'seek_value': 'Bbbbbb'})
+
+    def test___row_value(self):
+        report = sim_report()
+        row = sim_data()[1]
+        self.assertEqual(report._row_value(row, 'name'), 'Bbbbbb')
+        # Rows of a single table select are not nested.
+        self.assertEqual(report._row_value(row, 'table2.name'), 'Bbbbbb')
+        row = sim_data2()[1]
+        self.assertEqual(report._row_value(row, 'table2.name'), 'Bbbbbb')
+        self.assertEqual(report._row_value(row, 'table1.id'), 1)
+        self.assertRaises(KeyError, report._row_value, row, 'name')
+
+    def test___seek_vars(self):
+        report = sim_report()
+        row = sim_data()[1]
+        self.assertEqual(report._seek_vars(row, 'name', 'next'),
+                {'seek': 'next', 'seek_id': 1, 'seek_value': 'Bbbbbb'})
+        row = {'id': 2, 'table1': {'id': 3, 'name': 'Cccccc'}}
+        self.assertEqual(report._seek_vars(row, 'table1.name', 'prev'),
+                {'seek': 'prev', 'seek_id': 3, 'seek_value': 'Cccccc'})
+        # NULL values are sought in the NULL partition.
+        row = {'id': 2, 'name': None}
+        self.assertEqual(report._seek_vars(row, 'name', 'next'),
+                {'seek': 'next', 'seek_id': 2, 'seek_null': 1})
+        row = {'id': 2}
+        self.assertEqual(report._seek_vars(row, 'name', 'next'), None)
+
+    def test__count(self):
+        report = sim_report()
+        self.assertEqual(report.count(), len(sim_data()))
+        # Without an sqldb, the cached and approximate strategies count
+        # exactly.
+        for strategy in ['exact', 'cached', 'approximate']:
+            report.count_strategy = strategy
+            self.assertEqual(report.count(), len(sim_data()))
+        report.count_strategy = 'has_next'
+        self.assertEqual(report.count(), None)
+
+    def test__export(self):
+        columns = sim_columns() + [('Upper', lambda r: r['name'].upper(),
+            '', None)]
+        report = ReportTest(sim_request(), 'some_function', None, columns)
+        report.export_chunk_size = 10
+        self.assertRaises(ValueError, report.export, '_fake_')
+
+        chunks = list(report.export('csv'))
+        self.assertEqual(len(chunks), 3)
+        lines = ''.join(chunks).splitlines()
+        self.assertEqual(lines[0], '"ID","Name"')
+        self.assertEqual(lines[1], '0,"Aaaaaa"')
+        self.assertEqual(lines[26], '25,"Zzzzzz"')
+        self.assertEqual(len(lines), 27)
+
+        chunks = list(report.export('csv', order_by='name', order_dir=1))
+        lines = ''.join(chunks).splitlines()
+        self.assertEqual(lines[1], '25,"Zzzzzz"')
+
+        chunks = list(report.export('ndjson'))
+        self.assertEqual(len(chunks), 3)
+        lines = ''.join(chunks).splitlines()
+        self.assertEqual(len(lines), 26)
+        self.assertEqual(json.loads(lines[1]), {'id': 1, 'name': 'Bbbbbb'})
+
+        # Keyset chunks
+        report = KeysetReportTest(sim_request(), 'some_function', None,
+                sim_columns())
+        report.export_chunk_size = 10
+        lines = ''.join(report.export('csv')).splitlines()
+        self.assertEqual([int(x.split(',')[0]) for x in lines[1:]],
+                range(0, 26))
+
+        # The export is iterated after the connections of the request are
+        # closed, as gluon.main does before sending the response body.
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            db = DAL('sqlite://export.db', folder=tmp_dir)
+            db.define_table('client', Field('name'), Field('age', 'integer'))
+            for x in sim_data():
+                db.client.insert(name=x['name'], age=x['id'])
+            db.commit()
+            report = DbReportTest(sim_request(), db)
+            report.export_chunk_size = 10
+            export = report.export('csv')
+            BaseAdapter.close_all_instances('commit')
+            lines = ''.join(export).splitlines()
+            self.assertEqual(len(lines), 27)
+            self.assertEqual(lines[26], '26,"Zzzzzz",25')
+            self.assertEqual(db._adapter.connection, None)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test__export_chunks(self):
+        report = sim_report()
+        chunks = list(report.export_chunks('id', 0, chunk_size=10))
+        self.assertEqual([len(x) for x in chunks], [10, 10, 6])
+        chunks = list(report.export_chunks('id', 0, chunk_size=13))
+        self.assertEqual([len(x) for x in chunks], [13, 13])
+
+        report = KeysetReportTest(sim_request(), 'some_function', None,
+                sim_columns())
+        chunks = list(report.export_chunks('name', 1, chunk_size=10))
+        self.assertEqual([len(x) for x in chunks], [10, 10, 6])
+        self.assertEqual([x['id'] for y in chunks for x in y],
+                range(25, -1, -1))
+
+        # Rows with NULL order_by values are exported.
+        db = DAL('sqlite:memory:')
+        db.define_table('client', Field('name'), Field('age', 'integer'))
+        for (i, x) in enumerate(sim_data()):
+            db.client.insert(name=x['name'], age=None if i % 4 else i % 3)
+        report = DbReportTest(sim_request(), db)
+        for order_dir in [0, 1]:
+            chunks = list(report.export_chunks('age', order_dir,
+                    chunk_size=4))
+            self.assertEqual([len(x) for x in chunks], [4] * 6 + [2])
+            self.assertEqual([x.id for y in chunks for x in y],
+                    [x.id for x in report.rows(0, 100, 'age', order_dir)])
+
+    def test__export_columns(self):
+        columns = sim_columns() + [('Edit', lambda r: 'edit', '', None)]
+        report = ReportTest(sim_request(), 'some_function', None, columns)
+        self.assertEqual(report.export_columns(),
+                [('ID', 'id'), ('Name', 'name')])
+
+    def test__export_headers(self):
+        report = sim_report()
+        self.assertEqual(report.export_headers('csv'), {
+            'Content-Type': 'text/csv',
+            'Content-Disposition':
+                'attachment; filename="some_function.csv"',
+            })
+        self.assertEqual(report.export_headers('ndjson', 'a"b.json'), {
+            'Content-Type': 'application/x-ndjson',
+            'Content-Disposition': 'attachment; filename="ab.json"',
+            })
+
     def test__format_delimited_list(self):
         report = sim_report()
         row = {'a': 'A', 'b': 'B', 'c': 'C'}
@@ -347,6 +700,67 @@ class TestReport(unittest.TestCase):
         soup = as_soup(next_link)
         self.assertEqual(soup.find('span').string, 'next')
 
+        # Test keyset link
+        page = 2
+        seek_vars = {'seek': 'next', 'seek_id': 9, 'seek_value': 'Jjjjjj'}
+        next_link = report.next_page_link(page, pages, seek_vars=seek_vars)
+        soup = as_soup(next_link)
+        self.assertEqual(soup.find('a')['href'],
+                '/app/cont/some_function?page=3&seek=next&seek_id=9'
+                '&seek_value=Jjjjjj')
+
+    def test__has_next_page(self):
+        # sim_data() has 26 rows.
+        report = sim_report()
+        rows = report.rows(0, 10, 'id', 0)
+        self.assertTrue(report.has_next_page(0, 10, 'id', 0, rows))
+        rows = report.rows(2, 10, 'id', 0)
+        self.assertFalse(report.has_next_page(2, 10, 'id', 0, rows))
+        # Full last page
+        rows = report.rows(1, 13, 'id', 0)
+        self.assertEqual(len(rows), 13)
+        self.assertFalse(report.has_next_page(1, 13, 'id', 0, rows))
+
+        report = KeysetReportTest(sim_request(), 'some_function', None,
+                sim_columns())
+        rows = report.rows(1, 10, 'id', 0)
+        self.assertTrue(report.has_next_page(1, 10, 'id', 0, rows))
+        rows = report.rows(1, 13, 'id', 0)
+        self.assertFalse(report.has_next_page(1, 13, 'id', 0, rows))
+
+    def test__keyset_rows(self):
+        report = sim_report()
+        self.assertRaises(NotImplementedError, report.keyset_rows, 10, 'id',
+                0, 1, 1)
+        self.assertFalse('sql_query' in report.__dict__)
+
+        db = DAL('sqlite:memory:')
+        db.define_table('client', Field('name'), Field('age', 'integer'))
+        for (i, x) in enumerate(sim_data()):
+            db.client.insert(name=x['name'], age=None if i % 4 else i % 3)
+        report = DbReportTest(sim_request(), db)
+        # Paging by keyset returns the rows of rows(), NULLs included.
+        for order_dir in [0, 1]:
+            expect = [x.id for x in report.rows(0, 100, 'age', order_dir)]
+            got = [x.id for x in report.rows(0, 3, 'age', order_dir)]
+            while True:
+                seek_vars = report._seek_vars(
+                    report.rows(0, 100, 'age', order_dir)[len(got) - 1],
+                    'age', 'next')
+                rows = report.keyset_rows(3, 'age', order_dir,
+                        seek_vars.get('seek_value'), seek_vars['seek_id'])
+                if not rows:
+                    break
+                got.extend([x.id for x in rows])
+            self.assertEqual(got, expect)
+            self.assertFalse('sql_query' in report.__dict__)
+
+            # Backward from the last row returns the rows before it.
+            last = report.rows(0, 100, 'age', order_dir)[-1]
+            rows = report.keyset_rows(5, 'age', order_dir, last.age,
+                    last.id, backward=True)
+            self.assertEqual([x.id for x in rows], expect[-6:-1])
+
     def test__numeric_page_links(self):
         report = sim_report()
         page = 2
@@ -356,6 +770,17 @@ class TestReport(unittest.TestCase):
         for l in links:
             self.assertTrue(isinstance(l, TD))
 
+        # Test where the total is unknown
+        links = report.numeric_page_links(page, pages, more=True)
+        self.assertEqual(len(links), pages + 1)
+        self.assertEqual(as_soup(links[-1]).find('span').string, '...')
+
+    def test__order_field(self):
+        report = sim_report()
+        self.assertRaises(NotImplementedError, report.order_field, 'id')
+        self.assertRaises(NotImplementedError, report.order_field,
+                'table1.id')
+
     def test__page_link(self):
         report = sim_report()
         page_number = 5
@@ -368,6 +793,15 @@ class TestReport(unittest.TestCase):
         self.assertEqual(soup.find('a')['href'],
                 '/app/cont/some_function?page={pg}'.format(pg=page_number))
 
+        # Keyset vars of the current page are not carried to page links.
+        report.request.vars.seek = 'next'
+        report.request.vars.seek_id = '9'
+        report.request.vars.seek_value = '9'
+        page_link = report.page_link(page_number, page)
+        soup = as_soup(page_link)
+        self.assertEqual(soup.find('a')['href'],
+                '/app/cont/some_function?page={pg}'.format(pg=page_number))
+
         # Test where the page number is the current page
         page = page_number
         page_link = report.page_link(page_number, page)
@@ -395,6 +829,15 @@ class TestReport(unittest.TestCase):
         soup = as_soup(prev_link)
         self.assertEqual(soup.find('span').string, 'prev')
 
+        # Test keyset link
+        page = 3
+        seek_vars = {'seek': 'prev', 'seek_id': 30, 'seek_value': 30}
+        prev_link = report.prev_page_link(page, seek_vars=seek_vars)
+        soup = as_soup(prev_link)
+        self.assertEqual(soup.find('a')['href'],
+                '/app/cont/some_function?page=2&seek=prev&seek_id=30'
+                '&seek_value=30')
+
     def test__report(self):
         report = sim_report().report()
 
@@ -431,6 +874,132 @@ class TestReport(unittest.TestCase):
         # Verify pages
         self.assertTrue('pages' in report and report['pages'] == 1)
 
+    def test__report_has_next(self):
+        request = sim_request()
+        report = ReportTest(request, 'some_function', None, sim_columns(),
+                ROW_CLASSES)
+        report.count_strategy = 'has_next'
+        params = {'items_per_page': 10}
+
+        result = report.report(page_parameters=params)
+        self.assertEqual(result['pages'], 2)
+        soup = as_soup(result['page_links'])
+        self.assertEqual(soup.find('a', text='next').parent['href'],
+                '/app/cont/some_function?page=1')
+        self.assertEqual(soup.findAll('td')[-2].span.string, '...')
+
+        # Last page
+        request.vars.page = '2'
+        result = report.report(page_parameters=params)
+        self.assertEqual(result['pages'], 3)
+        soup = as_soup(result['results'])
+        self.assertEqual(len(soup.findAll('tr')), 7)   # Header + 6 rows
+        soup = as_soup(result['page_links'])
+        self.assertEqual(soup.findAll('td')[-1].span.string, 'next')
+        self.assertNotEqual(soup.findAll('td')[-2].span.string, '...')
+
+    def test__report_keyset(self):
+        def got_ids(report):
+            soup = as_soup(report['results'])
+            return [int(x.findAll('td')[0].string)
+                    for x in soup.findAll('tr')[1:]]
+
+        def link_vars(report, text):
+            soup = as_soup(report['page_links'])
+            link = soup.find('a', text=text).parent
+            query = link['href'].split('?')[1]
+            return dict([x.split('=') for x in query.split('&')])
+
+        request = sim_request()
+        report = KeysetReportTest(request, 'some_function', None,
+                sim_columns(), ROW_CLASSES)
+        params = {'items_per_page': 10}
+
+        # First page, selected by offset.
+        result = report.report(page_parameters=params)
+        self.assertEqual(got_ids(result), range(0, 10))
+        self.assertEqual(link_vars(result, 'next'),
+                {'page': '1', 'seek': 'next', 'seek_id': '9',
+                 'seek_value': '9'})
+        # Page number links are offset links.
+        self.assertEqual(link_vars(result, '3'), {'page': '2'})
+
+        # Next page, selected by keyset.
+        request.vars.update(link_vars(result, 'next'))
+        result = report.report(page_parameters=params)
+        self.assertEqual(got_ids(result), range(10, 20))
+        self.assertEqual(link_vars(result, 'prev'),
+                {'page': '0', 'seek': 'prev', 'seek_id': '10',
+                 'seek_value': '10'})
+        self.assertEqual(link_vars(result, '3'), {'page': '2'})
+
+        # Prev page, selected by keyset.
+        request.vars.clear()
+        request.vars.update(link_vars(result, 'prev'))
+        result = report.report(page_parameters=params)
+        self.assertEqual(got_ids(result), range(0, 10))
+
+        # Descending order
+        request.vars.clear()
+        request.vars.update({'order_dir': '1', 'page': '1', 'seek': 'next',
+            'seek_id': '16', 'seek_value': '16'})
+        result = report.report(page_parameters=params)
+        self.assertEqual(got_ids(result), range(15, 5, -1))
+
+        # Offset pagination ignores keyset vars.
+        report.pagination = 'offset'
+        request.vars.clear()
+        request.vars.update({'page': '1', 'seek': 'next', 'seek_id': '16',
+            'seek_value': '16'})
+        result = report.report(page_parameters=params)
+        self.assertEqual(got_ids(result), range(10, 20))
+        self.assertEqual(link_vars(result, 'next'), {'page': '2'})
+
+    def test__row_renderer(self):
+        def helper_html(report, row, index):
+            # The rows as rendered with gluon.html helpers.
+            tds = []
+            for column in report.column_set.sorted():
+                if callable(column['callback']):
+                    formatted = column['callback'](row)
+                else:
+                    formatted = row
+                    try:
+                        for f in column['callback'].split('.'):
+                            formatted = formatted[f]
+                    except KeyError:
+                        formatted = 'n/a'
+                if not str(formatted) or formatted == None:
+                    formatted = column['empty'] or XML('&nbsp;')
+                tds.append(TD(formatted, _class='results_table_cell col_'
+                    + column['order_by'].replace('.', '_')))
+            tr_params = {}
+            if report.row_classes:
+                tr_params['_class'] = report.row_classes[
+                        index % len(report.row_classes)]
+            return TR(tds, **tr_params).xml()
+
+        columns = [
+            ('ID', 'table1.id', 'table1.id', 0),
+            ('Name', 'table2.name', 'table2.name', 0, '-', None),
+            ('Link', lambda r: A(r['table2']['name'], _href='/a?b=1&c=2'),
+                'table2.link', None),
+            ('List', lambda r: ['<', XML('<b>x</b>')], '', None),
+            ('Missing', 'table3.name', 'table3.name', 0),
+            ('Empty', lambda r: '', 'table2.empty', None),
+            ]
+        data = sim_data2()
+        data[1]['table2']['name'] = 'A & <B> "C" \'D\''
+        data[2]['table2']['name'] = ''
+        for row_classes in [None, ROW_CLASSES]:
+            report = ReportTest(sim_request(), 'some_function', None,
+                    columns, row_classes)
+            render = report.row_renderer()
+            for (i, row) in enumerate(data):
+                html = []
+                render(html.append, row, i)
+                self.assertEqual(''.join(html), helper_html(report, row, i))
+
     def test__rows(self):
         report = Report(sim_request(), 'some_function', None,
                 sim_columns())
@@ -503,6 +1072,27 @@ class TestReportColumnSet(unittest.TestCase):
         self.assertEqual(sorted_set[1]['heading'], 'ID')
 
 
+class TestFunctions(unittest.TestCase):
+
+    def test__escape_like(self):
+        self.assertEqual(escape_like('abc'), 'abc')
+        self.assertEqual(escape_like('a%b_c!d'), 'a!%b!_c!!d')
+
+    def test__like(self):
+        db = DAL('sqlite:memory:')
+        db.define_table('client', Field('name'))
+        for name in ['A%c', 'Abc', 'aBd', 'x_!%y', 'xa!%y']:
+            db.client.insert(name=name)
+        ids = lambda q: [x.id for x in db(q).select(orderby=db.client.id)]
+        self.assertEqual(ids(like(db.client.name, 'a%')), [1, 2, 3])
+        self.assertEqual(ids(like(db.client.name, 'A!%%')), [1])
+        self.assertEqual(ids(~like(db.client.name, '%!%%')), [2, 3])
+        self.assertEqual(ids(like(db.client.name,
+            '%' + escape_like('_!%') + '%')), [4])
+        self.assertEqual(str(like(db.client.name, 'a!%%')),
+                "(client.name LIKE 'a!%%' ESCAPE '!')")
+
+
 def sim_columns():
     return [
         ('ID',   'id', 'id',     0),